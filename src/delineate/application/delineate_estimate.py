@@ -30,12 +30,14 @@ completion rate parameter as required.
 import contextlib
 import sys
 import os
+import random
 import argparse
 import subprocess
 import math
 import itertools
 import collections
 import json
+import dendropy
 from dendropy.dataio import nexusprocessing
 from dendropy.model import birthdeath
 import delineate
@@ -47,6 +49,10 @@ from delineate import utility
 
 # Support Functions {{{1
 
+# number of partition states of a subtree above which it is flagged as
+# making the space of partitions blow up by '--dry-run'
+_PLAN_MAX_NODE_STATES = 10**6
+
 def _node_label_compose_fn(node, key):
     return node.annotations.get_value(key, None)
 
@@ -68,13 +74,221 @@ def sorted_dict(d):
     for k in sorted(d.keys()):
         d2[k] = d[k]
     return d2
+
+def _format_count(n):
+    # counts can be far too large to convert to floats
+    digits = str(n)
+    if len(digits) <= 15:
+        return digits
+    return "{}.{}e+{}".format(digits[0], digits[1:3], len(digits) - 1)
+
+def _estimate_partition_state_bytes(num_lineages, underflow_protection):
+    # a dictionary entry, its key (taking the number of subsets to be half
+    # the number of lineages), the mask of the open subset, and its value
+    value_bytes = 104 if underflow_protection == "decimal" else 24
+    return 50 + (56 + 8 * (num_lineages // 2)) + (28 + 4 * (num_lineages // 30)) + value_bytes
+
+def log_partition_estimation_plan(controller, tree, partition_map_schedule):
+    """
+    Logs the exact numbers of partition states that enumerating all the
+    partitions would build and hold, with the estimated memory required, and
+    the nodes at which the number of states first exceeds
+    `_PLAN_MAX_NODE_STATES`, without building any.
+    """
+    tree.partition_map_schedule = partition_map_schedule
+    node_state_counts, peak_num_states, num_states_formed, num_partitions = tree.calc_partition_map_state_counts()
+    num_lineages = len(tree.taxon_namespace)
+    num_constrained_lineages = sum(1 for nd in tree.leaf_node_iter() if getattr(nd, "known_tipward_sp", None) is not None)
+    controller.logger.info("Number of lineages: {} ({} constrained)".format(num_lineages, num_constrained_lineages))
+    controller.logger.info("Number of partitions: {}".format(_format_count(num_partitions)))
+    controller.logger.info("Peak number of partition states held ('{}' schedule): {}".format(
+        partition_map_schedule, _format_count(peak_num_states)))
+    for other_schedule in ("postorder", "min-memory"):
+        if other_schedule != partition_map_schedule:
+            tree.partition_map_schedule = other_schedule
+            controller.logger.info("Peak number of partition states held ('{}' schedule): {}".format(
+                other_schedule, _format_count(tree.calc_partition_map_state_counts()[1])))
+    tree.partition_map_schedule = partition_map_schedule
+    state_bytes = _estimate_partition_state_bytes(num_lineages, tree.underflow_protection)
+    num_bytes = peak_num_states * state_bytes
+    if num_bytes < 10**15:
+        num_megabytes = "{:.1f}".format(num_bytes / 2**20)
+    else:
+        num_megabytes = _format_count(num_bytes // 2**20)
+    controller.logger.info("Estimated peak memory required for partition states: {} MB".format(num_megabytes))
+    controller.logger.info("Number of partition states formed (relative running time): {}".format(
+        _format_count(num_states_formed)))
+    num_flagged = 0
+    for nd in tree.postorder_node_iter():
+        if nd not in node_state_counts or node_state_counts[nd][0] <= _PLAN_MAX_NODE_STATES:
+            continue
+        if any(node_state_counts.get(c, (0,))[0] > _PLAN_MAX_NODE_STATES for c in nd.child_nodes()):
+            continue
+        leaf_labels = [leaf.taxon.label for leaf in nd.leaf_iter()]
+        num_unconstrained = sum(1 for leaf in nd.leaf_iter() if getattr(leaf, "known_tipward_sp", None) is None)
+        controller.logger.warning("Partition states exceed {} at the subtree of {} lineages ({} unconstrained) including {}: {}".format(
+            _PLAN_MAX_NODE_STATES,
+            len(leaf_labels),
+            num_unconstrained,
+            ", ".join(leaf_labels[:3]) + (", ..." if len(leaf_labels) > 3 else ""),
+            _format_count(node_state_counts[nd][0])))
+        num_flagged += 1
+    if num_flagged:
+        controller.logger.warning("Constraining more lineages in (or splitting) the subtrees above would reduce the partition states")
 # }}}1
 
 # Species Partition Estimation {{{1
+def execute_tree_sample_partition_estimation(args):
+    controller = control.get_controller(
+            name="delineate-estimate",
+            args=args)
+    for option, is_set in (
+            ("--sample", args.sample_size),
+            ("--report-mle-only", args.report_mle_only),
+            ("--report-probability-threshold", args.report_constrained_probability_threshold is not None),
+            ("--report-cumulative-probability-threshold", args.report_constrained_cumulative_probability_threshold is not None),
+            ("--beam-epsilon", args.beam_epsilon is not None),
+            ("--partition-map-schedule", args.partition_map_schedule is not None),
+            ("--dry-run", args.dry_run),
+            ):
+        if is_set:
+            controller.logger.error("ERROR: '{}' cannot be used with '--tree-sample'".format(option))
+            controller.logger.critical("Terminating due to error")
+            sys.exit(1)
+    if args.burnin < 0 or args.thin < 1:
+        controller.logger.error("ERROR: '--burnin' must be at least 0 and '--thin' at least 1")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    if args.speciation_completion_rate is not None:
+        controller.speciation_completion_rate = args.speciation_completion_rate
+    speciation_completion_rate = controller.speciation_completion_rate
+    if speciation_completion_rate is None and not controller.has_species_constraints:
+        controller.logger.error("ERROR: With no constraints given, speciation completion rate must be specified either by command argument '--speciation-completion-rate'")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    if controller.has_species_constraints:
+        species_constraints = model._Partition.compile_lookup_key(controller.species_leafset_constraint_labels)
+        check_labels = _check_labels_in_tree(
+                labels=controller.constrained_lineage_leaf_labels,
+                tree=controller.tree)
+        if check_labels:
+            raise ValueError("Lineage labels not normalized or invalid: {}".format(check_labels))
+    else:
+        species_constraints = None
+    lineage_labels = [txn.label for txn in controller.tree.taxon_namespace]
+    estimator = estimate.TreeSamplePartitionProbabilityEstimator(
+            lineage_labels=lineage_labels,
+            species_leafset_labels=species_constraints,
+            speciation_completion_rate=speciation_completion_rate,
+            speciation_completion_rate_estimation_initial=controller.speciation_completion_rate_estimation_initial,
+            speciation_completion_rate_estimation_min=controller.speciation_completion_rate_estimation_min,
+            speciation_completion_rate_estimation_max=controller.speciation_completion_rate_estimation_max,
+            underflow_protection=args.underflow_protection,
+            is_calc_conspecificity=args.conspecificity_matrix,
+            num_processes=args.num_processes)
+    controller.logger.info("Reading trees from '{}' (burn-in: {}, thinning: {})".format(args.tree_file, args.burnin, args.thin))
+    trees = itertools.islice(
+            dendropy.Tree.yield_from_files(
+                files=[args.tree_file],
+                schema=args.tree_format,
+                preserve_underscores=args.preserve_underscores),
+            args.burnin,
+            None,
+            args.thin)
+    estimator.add_trees(trees)
+    if not estimator.num_trees:
+        controller.logger.error("ERROR: No trees left after burn-in and thinning")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    controller.logger.info("Partition probabilities integrated over {} trees".format(estimator.num_trees))
+
+    result_dict = collections.OrderedDict()
+    extra_fields = utility.parse_fieldname_and_value(args.extra_info_field_value)
+    if extra_fields:
+        result_dict.update(extra_fields)
+    result_dict["lineages"] = lineage_labels
+    result_dict["num_trees"] = estimator.num_trees
+    result_dict["burnin"] = args.burnin
+    result_dict["thinning"] = args.thin
+    if speciation_completion_rate is not None:
+        result_dict["speciation_completion_rate"] = speciation_completion_rate
+        result_dict["speciation_completion_rate_source"] = "specified"
+        result_dict["speciation_completion_rate_variance"] = 0.0
+    else:
+        result_dict["speciation_completion_rate"], result_dict["speciation_completion_rate_variance"] = \
+                estimator.estimate_speciation_completion_rate()
+        result_dict["speciation_completion_rate_source"] = "estimated"
+    result_dict["speciation_completion_rate_estimation_initial"] = controller.speciation_completion_rate_estimation_initial
+    result_dict["speciation_completion_rate_estimation_min"] = controller.speciation_completion_rate_estimation_min
+    result_dict["speciation_completion_rate_estimation_max"] = controller.speciation_completion_rate_estimation_max
+    result_dict["species_constraints"] = controller.species_leafset_constraint_labels
+    partition_probabilities = estimator.estimate_partition_probabilities()
+    result_dict["num_partitions"] = len(partition_probabilities)
+    result_dict["partitions"] = []
+    cumulative_probability = 0.0
+    num_partitions_in_confidence_interval = 0
+    for key, prob, variance in partition_probabilities:
+        p = collections.OrderedDict()
+        lineage_species_name_map = controller.compile_postanalysis_lineage_species_name_map(
+                postanalysis_species_leafset_labels=list(list(s) for s in key))
+        p["lineage_species_name_map"] = sorted_dict(lineage_species_name_map)
+        species_lineage_name_map = {}
+        for lineage in lineage_species_name_map:
+            species_lineage_name_map.setdefault(lineage_species_name_map[lineage], []).append(lineage)
+        p["species_leafsets"] = sorted_dict(species_lineage_name_map)
+        p["constrained_probability"] = prob
+        p["constrained_probability_variance"] = variance
+        # as for a single tree, checked before adding the probability
+        p["is_in_confidence_interval"] = cumulative_probability <= 0.95 and prob > 0.0
+        if p["is_in_confidence_interval"]:
+            num_partitions_in_confidence_interval += 1
+        cumulative_probability += prob
+        p["constrained_cumulative_probability"] = cumulative_probability
+        result_dict["partitions"].append(p)
+    result_dict["num_partitions_in_confidence_interval"] = num_partitions_in_confidence_interval
+    if args.conspecificity_matrix:
+        conspecificity, conspecificity_variance = estimator.estimate_conspecificity_probability_matrix()
+        result_dict["conspecificity"] = collections.OrderedDict()
+        result_dict["conspecificity"]["lineages"] = lineage_labels
+        result_dict["conspecificity"]["probability"] = conspecificity.tolist()
+        result_dict["conspecificity"]["variance"] = conspecificity_variance.tolist()
+    out_path, outf = open_output_file(
+            args=args,
+            suffix=".delimitation-results",
+            extension="json")
+    with outf:
+        json.dump(result_dict, outf, indent=4, separators=(',', ': '))
+        controller.logger.info("JSON-formatted results written to: '{}'".format(out_path))
+    controller.logger.info("Operation complete")
+    controller.logger.info("Terminating normally")
+
 def execute_species_partition_estimation(args):
+    if args.tree_sample:
+        execute_tree_sample_partition_estimation(args)
+        return
     controller = control.get_controller(
             name="delineate-estimate",
             args=args)
+    # the options of the enumeration of all partitions, which is not done
+    # when only some of the partitions are reported
+    for option, is_set in (
+            ("--beam-epsilon", args.beam_epsilon is not None),
+            ("--partition-map-schedule", args.partition_map_schedule is not None),
+            ):
+        if not is_set:
+            continue
+        for other_option, is_other_set in (
+                ("--sample", args.sample_size),
+                ("--report-mle-only", args.report_mle_only),
+                ("--report-probability-threshold", args.report_constrained_probability_threshold is not None),
+                ("--report-cumulative-probability-threshold", args.report_constrained_cumulative_probability_threshold is not None),
+                ):
+            if is_other_set:
+                controller.logger.error("ERROR: '{}' cannot be used with '{}'".format(option, other_option))
+                controller.logger.critical("Terminating due to error")
+                sys.exit(1)
+    if args.partition_map_schedule is None:
+        args.partition_map_schedule = "postorder"
     if args.speciation_completion_rate is not None:
         controller.speciation_completion_rate = args.speciation_completion_rate
     speciation_completion_rate = controller.speciation_completion_rate
@@ -88,8 +302,16 @@ def execute_species_partition_estimation(args):
                 tree=tree)
         if check_labels:
             raise ValueError("Lineage labels not normalized or invalid: {}".format(check_labels))
+    if args.dry_run:
+        log_partition_estimation_plan(controller, tree, args.partition_map_schedule)
+        controller.logger.info("Dry run: no partitions calculated")
+        controller.logger.info("Terminating normally")
+        return
+    if controller.has_species_constraints:
         induced_tree = tree.extract_tree_with_taxa_labels(
                 labels=controller.constrained_lineage_leaf_labels)
+        if tree.is_use_log_value_type:
+            induced_tree.underflow_protection = tree.underflow_protection
         speciation_completion_rate_estimation_initial = controller.speciation_completion_rate_estimation_initial
         speciation_completion_rate_estimation_min = controller.speciation_completion_rate_estimation_min
         speciation_completion_rate_estimation_max = controller.speciation_completion_rate_estimation_max
@@ -146,7 +368,64 @@ def execute_species_partition_estimation(args):
         speciation_completion_rate_estimate_lnl = 0.0
     tree.speciation_completion_rate = speciation_completion_rate
 
-    partition_probability_map = tree.calc_label_partition_probability_map()
+    if args.beam_epsilon is not None and not 0.0 < args.beam_epsilon < 1.0:
+        controller.logger.error("ERROR: '--beam-epsilon' must be between 0 and 1")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    is_report_thresholded = (args.report_constrained_probability_threshold is not None
+            or args.report_constrained_cumulative_probability_threshold is not None)
+    sample_frequencies = None
+    num_samples_accepted = None
+    if args.sample_size:
+        # partitions are sampled instead of enumerated, and the distinct
+        # partitions sampled reported in decreasing order of probability
+        if args.random_seed is None:
+            args.random_seed = random.randint(0, sys.maxsize)
+        if args.simulate:
+            controller.logger.info("Simulating speciation events for {} samples (random seed: {})".format(args.sample_size, args.random_seed))
+            mc = estimate.SpeciesPartitionMonteCarloEstimator(
+                    tree=tree,
+                    num_processes=args.num_processes)
+            mc.simulate(args.sample_size, random_seed=args.random_seed)
+            num_samples_accepted = mc.num_accepted
+            controller.logger.info("{} of {} samples consistent with species constraints".format(num_samples_accepted, args.sample_size))
+            sample_frequencies = dict((k, (freq, se)) for k, freq, se in mc.estimate_partition_probabilities())
+        else:
+            controller.logger.info("Sampling {} partitions (random seed: {})".format(args.sample_size, args.random_seed))
+            rng = random.Random(args.random_seed)
+            sample_counts = collections.Counter(tree.sample_label_partitions(args.sample_size, rng=rng))
+            num_samples_accepted = args.sample_size
+            sample_frequencies = {}
+            for k, count in sample_counts.items():
+                freq = count / num_samples_accepted
+                sample_frequencies[k] = (freq, math.sqrt(freq * (1.0 - freq) / num_samples_accepted))
+        partition_probabilities = sorted(
+                ((k, tree.calc_joint_probability_of_species(k)) for k in sample_frequencies),
+                key=lambda x: x[1],
+                reverse=True)
+        cond_prob = tree.calc_probability_of_constraints()
+    elif args.report_mle_only:
+        # no need to enumerate the partitions
+        mle_partition, mle_partition_probability = tree.calc_max_probability_partition()
+        partition_probabilities = [(mle_partition, mle_partition_probability)]
+        cond_prob = tree.calc_probability_of_constraints()
+    elif is_report_thresholded:
+        # partitions are enumerated lazily, in decreasing order of
+        # probability, only as far as the report thresholds reach
+        cond_prob = tree.calc_probability_of_constraints()
+        if args.report_constrained_probability_threshold is not None:
+            min_probability = tree.as_working_value_type(args.report_constrained_probability_threshold) * cond_prob
+        else:
+            min_probability = None
+        partition_probabilities = tree.iter_label_partition_probabilities(min_probability=min_probability)
+    else:
+        tree.partition_map_schedule = args.partition_map_schedule
+        tree.partition_beam_epsilon = args.beam_epsilon
+        partition_probabilities = tree.calc_label_partition_probability_map().items()
+        if tree.peak_num_live_partition_states is not None:
+            controller.logger.info("Peak number of partition states held: {}".format(tree.peak_num_live_partition_states))
+        if tree.pruned_partition_probability is not None:
+            controller.logger.info("Total probability of partitions pruned: no more than {}".format(tree.pruned_partition_probability))
 
     result_dict = collections.OrderedDict()
     row = []
@@ -167,35 +446,41 @@ def execute_species_partition_estimation(args):
     result_dict["lineage_tree_birth_rate"] = controller.tree.birth_rate
     result_dict["constrained_lineage_tree"] = constrained_tree
     result_dict["species_constraints"] = species_constraints_desc
-    species_partition_info = []
     probability_index = 2
-    for k in partition_probability_map:
-        kentry = (
-                k,
-                list(list(s) for s in k),
-                partition_probability_map[k],
-                )
-        species_partition_info.append(kentry)
-    # species_partition_info = [(
-    #         k,
-    #         list(list(s) for s in k),
-    #         partition_probability_map[k],
-    #         math.log(partition_probability_map[k])) for k in partition_probability_map]
-    species_partition_info.sort(key=lambda x: x[probability_index], reverse=True)
-    assert species_partition_info[0][probability_index] >= species_partition_info[-1][probability_index], \
-            sys.stderr.write("{} >= {}: False\n".format(species_partition_info[0][probability_index], species_partition_info[-1][probability_index]))
-    result_dict["num_partitions"] = len(species_partition_info)
+    species_partition_info = ((
+            k,
+            list(list(s) for s in k),
+            prob) for k, prob in partition_probabilities)
+    if sample_frequencies is not None or args.report_mle_only or is_report_thresholded:
+        # not all partitions are enumerated
+        result_dict["num_partitions"] = None
+    else:
+        species_partition_info = list(species_partition_info)
+        # species_partition_info = [(
+        #         k,
+        #         list(list(s) for s in k),
+        #         partition_probability_map[k],
+        #         math.log(partition_probability_map[k])) for k in partition_probability_map]
+        species_partition_info.sort(key=lambda x: x[probability_index], reverse=True)
+        assert species_partition_info[0][probability_index] >= species_partition_info[-1][probability_index], \
+                sys.stderr.write("{} >= {}: False\n".format(species_partition_info[0][probability_index], species_partition_info[-1][probability_index]))
+        result_dict["num_partitions"] = len(species_partition_info)
+        cond_prob = sum([i[probability_index] for i in species_partition_info])
     # max_log_likelihood = species_partition_info[0][log_likelihood_index]
     # result_dict["max_log_likelihood"] = max_log_likelihood
     result_dict["num_partitions_in_confidence_interval"] = 0
     result_dict["report_mle_only"] = args.report_mle_only
     result_dict["report_constrained_probability_threshold"] = args.report_constrained_probability_threshold
     result_dict["report_constrained_cumulative_probability_threshold"] = args.report_constrained_cumulative_probability_threshold
+    result_dict["sample_size"] = args.sample_size
+    result_dict["random_seed"] = args.random_seed
+    result_dict["num_samples_accepted"] = num_samples_accepted
+    result_dict["beam_epsilon"] = args.beam_epsilon
+    result_dict["pruned_probability"] = tree.pruned_partition_probability
     result_dict["partitions"] = []
     cumulative_probability = tree.as_working_value_type(0.0)
     cumulative_probability_given_constr = tree.as_working_value_type(0.0)
     num_partitions_in_confidence_interval = 0
-    cond_prob = sum([i[probability_index] for i in species_partition_info])
     if cond_prob == 0:
         raise ValueError("0 conditional probability")
     try:
@@ -285,6 +570,8 @@ def execute_species_partition_estimation(args):
             p["unconstrained_probability"] = tree.as_float(prob)
             bpc = prob / cond_prob
             p["constrained_probability"] = tree.as_float(bpc)
+            if sample_frequencies is not None:
+                p["sample_frequency"], p["sample_frequency_se"] = sample_frequencies[key]
             if args.report_constrained_probability_threshold is not None and p["constrained_probability"] < args.report_constrained_probability_threshold:
                 break
             # if args.report_unconstrained_probability_threshold is not None and p["unconstrained_probability"] < args.report_unconstrained_probability_threshold:
@@ -364,12 +651,40 @@ def execute_species_partition_estimation(args):
             else:
                 json.dump(result_dict, outf, indent=4, separators=(',', ': '))
             controller.logger.info("JSON-formatted results written to: '{}'".format(out_path))
+    if args.conspecificity_matrix:
+        conspecificity = tree.calc_conspecificity_probability_matrix()
+        lineage_labels = [nd.taxon.label for nd in tree.leaf_node_iter()]
+        out_path, outf = open_output_file(
+                args=args,
+                suffix=".conspecificity",
+                extension="tsv")
+        with outf:
+            outf.write("\t".join(["lineage"] + lineage_labels))
+            outf.write("\n")
+            for lineage_label, row in zip(lineage_labels, conspecificity):
+                outf.write("\t".join([lineage_label] + ["{:.8g}".format(v) for v in row]))
+                outf.write("\n")
+            controller.logger.info("Lineage pair conspecificity probabilities written to: '{}'".format(out_path))
     controller.logger.info("Operation complete")
     controller.logger.info("Terminating normally")
 # }}}1
 
 # Speciation Completion Rate Parameter Estimation {{{1
 def execute_speciation_completion_rate_estimation(args):
+    if args.multi and (args.per_tree or args.bootstrap):
+        sys.exit("ERROR: '--multi' cannot be used with '--per-tree' or '--bootstrap'")
+    if args.per_tree or args.bootstrap:
+        execute_replicate_speciation_completion_rate_estimation(args)
+        return
+    for option, is_set in (
+            ("--resume", args.resume),
+            ("--random-seed", args.random_seed is not None),
+            ):
+        if is_set:
+            sys.exit("ERROR: '{}' can only be used with '--per-tree' or '--bootstrap'".format(option))
+    if args.multi:
+        execute_shared_speciation_completion_rate_estimation(args)
+        return
     controller = control.get_controller(
             name="delineate-estimate",
             args=args)
@@ -380,21 +695,410 @@ def execute_speciation_completion_rate_estimation(args):
         sys.exit(1)
     # species_constraints = model._Partition.compile_lookup_key(controller.species_leafset_constraint_labels)
     species_leafset_labels = model._Partition.compile_lookup_key(controller.species_leafset_constraint_labels)
-    speciation_completion_rate_estimation_initial = controller.speciation_completion_rate_estimation_initial
-    speciation_completion_rate_estimation_min = controller.speciation_completion_rate_estimation_min
-    speciation_completion_rate_estimation_max = controller.speciation_completion_rate_estimation_max
-    controller.logger.info("Speciation completion rate estimation window minimum: {}".format(speciation_completion_rate_estimation_min))
-    controller.logger.info("Speciation completion rate estimation window maximum: {}".format(speciation_completion_rate_estimation_max))
-    controller.logger.info("Speciation completion rate estimation initial: {}".format(speciation_completion_rate_estimation_initial))
+    if args.dry_run:
+        # each evaluation of the likelihood is a single pass over the tree
+        controller.logger.info("Number of lineages: {}".format(len(tree.taxon_namespace)))
+        controller.logger.info("Number of species: {}".format(len(species_leafset_labels)))
+        controller.logger.info("Number of nodes visited per likelihood evaluation: {}".format(
+            sum(1 for nd in tree.postorder_node_iter())))
+        controller.logger.info("Dry run: no speciation completion rate estimated")
+        controller.logger.info("Terminating normally")
+        return
     mle = estimate.SpeciationCompletionRateMaximumLikelihoodEstimator(
             tree=tree,
             species_leafset_labels=species_leafset_labels,
-            initial_speciation_rate=speciation_completion_rate_estimation_initial,
-            min_speciation_rate=speciation_completion_rate_estimation_min,
-            max_speciation_rate=speciation_completion_rate_estimation_max,
+            initial_speciation_rate=controller.speciation_completion_rate_estimation_initial,
+            min_speciation_rate=controller.speciation_completion_rate_estimation_min,
+            max_speciation_rate=controller.speciation_completion_rate_estimation_max,
             )
-    speciation_completion_rate_estimate, speciation_completion_rate_estimate_lnl = mle.estimate_speciation_rate()
+    tree_info = None
+    if args.tree_info:
+        tree.calc_node_ages()
+        tree_info = [("num_tips", len(tree.taxon_namespace)), ("root_age", tree.seed_node.age)]
+    report_speciation_completion_rate_estimate(controller, args, mle, tree_info)
+
+def _compile_tree_species_leafset_labels(tree, species_leafset_constraint_labels):
+    """
+    Returns the species partition of the lineages of `tree` given by the
+    species constraints (restricted to those lineages), as a lookup key, or
+    None if any lineage of the tree is not constrained.
+    """
+    leaf_labels = set(nd.taxon.label for nd in tree.leaf_node_iter())
+    species_leafsets = []
+    num_constrained = 0
+    for leafset in species_leafset_constraint_labels:
+        tree_leafset = [label for label in leafset if label in leaf_labels]
+        if tree_leafset:
+            species_leafsets.append(tree_leafset)
+            num_constrained += len(tree_leafset)
+    if num_constrained < len(leaf_labels):
+        return None
+    return model._Partition.compile_lookup_key(species_leafsets)
+
+def execute_shared_speciation_completion_rate_estimation(args):
+    controller = control.Controller(
+            name="delineate-estimate",
+            is_case_sensitive=getattr(args, "is_case_sensitive", False))
+    controller.parse_configuration_file(
+            constraints_filepath=args.constraints_file,
+            delimiter=None)
+    if not controller.has_species_constraints:
+        controller.logger.error("ERROR: Species constraints must be fully specifed for rates estimation, but no constraints were found.")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    if args.burnin < 0 or args.thin < 1:
+        controller.logger.error("ERROR: '--burnin' must be at least 0 and '--thin' at least 1")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    controller.logger.info("Reading trees from '{}' (burn-in: {}, thinning: {})".format(args.tree_file, args.burnin, args.thin))
+    trees = []
+    species_leafset_labels_list = []
+    birth_rates = []
+    for tree_idx, tree in enumerate(itertools.islice(
+            dendropy.Tree.yield_from_files(
+                files=[args.tree_file],
+                schema=args.tree_format,
+                preserve_underscores=args.preserve_underscores),
+            args.burnin,
+            None,
+            args.thin)):
+        species_leafset_labels = _compile_tree_species_leafset_labels(tree, controller.species_leafset_constraint_labels)
+        if species_leafset_labels is None:
+            controller.logger.error("ERROR: Species constraints must be fully specifed for rates estimation, but not all lineages of tree {} are constrained.".format(tree_idx + 1))
+            controller.logger.critical("Terminating due to error")
+            sys.exit(1)
+        trees.append(tree)
+        species_leafset_labels_list.append(species_leafset_labels)
+        birth_rates.append(birthdeath.fit_pure_birth_model_to_tree(tree=tree)["birth_rate"])
+    if not trees:
+        controller.logger.error("ERROR: No trees left after burn-in and thinning")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    num_lineages = sum(sum(1 for nd in tree.leaf_node_iter()) for tree in trees)
+    controller.logger.info("Number of trees: {} ({} lineages)".format(len(trees), num_lineages))
+    if args.dry_run:
+        controller.logger.info("Number of nodes visited per likelihood evaluation: {}".format(
+            sum(sum(1 for nd in tree.postorder_node_iter()) for tree in trees)))
+        controller.logger.info("Dry run: no speciation completion rate estimated")
+        controller.logger.info("Terminating normally")
+        return
+    # as for a single tree, the default window follows the pure birth rates
+    # of the trees
+    if args.speciation_completion_rate_estimation_initial is not None:
+        controller.speciation_completion_rate_estimation_initial = args.speciation_completion_rate_estimation_initial
+    else:
+        controller.speciation_completion_rate_estimation_initial = 0.01 * sum(birth_rates) / len(birth_rates)
+    controller.speciation_completion_rate_estimation_min = args.speciation_completion_rate_estimation_min
+    if args.speciation_completion_rate_estimation_max is not None:
+        controller.speciation_completion_rate_estimation_max = args.speciation_completion_rate_estimation_max
+    else:
+        controller.speciation_completion_rate_estimation_max = 10 * max(birth_rates)
+    with estimate.SharedSpeciationCompletionRateMaximumLikelihoodEstimator(
+            trees=trees,
+            species_leafset_labels_list=species_leafset_labels_list,
+            initial_speciation_rate=controller.speciation_completion_rate_estimation_initial,
+            min_speciation_rate=controller.speciation_completion_rate_estimation_min,
+            max_speciation_rate=controller.speciation_completion_rate_estimation_max,
+            underflow_protection=args.underflow_protection,
+            num_processes=args.num_processes,
+            ) as mle:
+        tree_info = None
+        if args.tree_info:
+            tree_info = [("num_trees", len(trees)), ("num_tips", num_lineages)]
+        report_speciation_completion_rate_estimate(controller, args, mle, tree_info)
+
+def _compose_speciation_rate_window(controller, args, tree):
+    # as for a single tree (see `control.get_controller()`), the window is
+    # given by the arguments or the configuration file, or else follows the
+    # pure birth rate of the tree
+    window = {}
+    for param in (
+            "speciation_completion_rate_estimation_initial",
+            "speciation_completion_rate_estimation_min",
+            "speciation_completion_rate_estimation_max",
+            ):
+        value = controller.config_d.get(param, None)
+        av = getattr(args, param, None)
+        if av is not None:
+            value = av
+        window[param] = value
+    if window["speciation_completion_rate_estimation_initial"] is None or window["speciation_completion_rate_estimation_max"] is None:
+        birth_rate = birthdeath.fit_pure_birth_model_to_tree(tree=tree)["birth_rate"]
+        if window["speciation_completion_rate_estimation_initial"] is None:
+            window["speciation_completion_rate_estimation_initial"] = 0.01 * birth_rate
+        if window["speciation_completion_rate_estimation_max"] is None:
+            window["speciation_completion_rate_estimation_max"] = 10 * birth_rate
+    if window["speciation_completion_rate_estimation_min"] is None:
+        window["speciation_completion_rate_estimation_min"] = 1e-8
+    return (window["speciation_completion_rate_estimation_initial"],
+            window["speciation_completion_rate_estimation_min"],
+            window["speciation_completion_rate_estimation_max"])
+
+def _read_completed_replicate_ids(out_path, header_row, field_separator):
+    """
+    Returns the identifiers (the first field) of the rows of the results of
+    the replicates already written to `out_path` by an interrupted run,
+    whether the file is empty, and the incomplete row at its end, if any
+    (None otherwise), which is truncated from the file. If given,
+    `header_row` must match that of the file.
+    """
+    if not os.path.exists(out_path):
+        return set(), True, None
+    with open(out_path) as src:
+        text = src.read()
+    complete_text = text[:text.rfind("\n") + 1]
+    incomplete_row = None
+    if complete_text != text:
+        incomplete_row = text[len(complete_text):]
+        with open(out_path, "w") as dest:
+            dest.write(complete_text)
+    rows = [line.split(field_separator) for line in complete_text.splitlines()]
+    if header_row is not None and rows:
+        if rows[0] != header_row:
+            raise ValueError("Header row of '{}' does not match the options given".format(out_path))
+        rows = rows[1:]
+    completed_ids = set()
+    for row in rows:
+        if len(row) != len(header_row if header_row is not None else rows[0]):
+            raise ValueError("Rows of '{}' do not match the options given".format(out_path))
+        completed_ids.add(row[0])
+    return completed_ids, not complete_text, incomplete_row
+
+def execute_replicate_speciation_completion_rate_estimation(args):
+    if args.per_tree:
+        controller = control.Controller(
+                name="delineate-estimate",
+                is_case_sensitive=getattr(args, "is_case_sensitive", False))
+        controller.parse_configuration_file(
+                constraints_filepath=args.constraints_file,
+                delimiter=None)
+        replicate_field = "tree"
+    else:
+        controller = control.get_controller(
+                name="delineate-estimate",
+                args=args)
+        replicate_field = "replicate"
+    for option, is_set in (
+            ("--profile", args.profile),
+            ("--append", args.append),
+            ("--bootstrap", args.per_tree and args.bootstrap),
+            ):
+        if is_set:
+            controller.logger.error("ERROR: '{}' cannot be used with '{}'".format(option, "--per-tree" if args.per_tree else "--bootstrap"))
+            controller.logger.critical("Terminating due to error")
+            sys.exit(1)
+    if args.resume and args.output_prefix == "-":
+        controller.logger.error("ERROR: '--resume' requires the results to be written to a file")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    if args.resume and args.bootstrap and args.random_seed is None:
+        # the replicates are only the same as those of the interrupted run
+        # if simulated from the same seed
+        controller.logger.error("ERROR: '--resume' with '--bootstrap' requires the '--random-seed' of the interrupted run")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    if not controller.has_species_constraints:
+        controller.logger.error("ERROR: Species constraints must be fully specifed for rates estimation, but no constraints were found.")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    if args.burnin < 0 or args.thin < 1 or args.bootstrap < 0:
+        controller.logger.error("ERROR: '--burnin' and '--bootstrap' must be at least 0 and '--thin' at least 1")
+        controller.logger.critical("Terminating due to error")
+        sys.exit(1)
+    estimator = estimate.ReplicateSpeciationCompletionRateEstimator(
+            underflow_protection=args.underflow_protection,
+            method=args.optimizer,
+            is_calc_standard_error=args.standard_error,
+            is_calc_confidence_interval=args.intervals,
+            confidence_interval_method=args.interval_method,
+            num_processes=args.num_processes)
     extra_fields = utility.parse_fieldname_and_value(args.extra_info_field_value)
+    header_row = [replicate_field]
+    if args.tree_info:
+        header_row.extend(["num_tips", "root_age"])
+    header_row.extend(extra_fields)
+    header_row.append("speciation_completion_rate")
+    header_row.append("speciation_completion_rate_estimate_lnl")
+    if args.standard_error:
+        header_row.append("speciation_completion_rate_se")
+    if args.intervals:
+        header_row.append("ci_low")
+        header_row.append("ci_high")
+    out_path = compose_output_path(
+            args=args,
+            suffix=".rate-results",
+            extension="tsv")
+    completed_ids = set()
+    is_new_output = True
+    if args.resume and not args.dry_run:
+        try:
+            completed_ids, is_new_output, incomplete_row = _read_completed_replicate_ids(
+                    out_path=out_path,
+                    header_row=None if args.no_header_row else header_row,
+                    field_separator=args.output_field_separator)
+        except ValueError as e:
+            controller.logger.error("ERROR: Cannot resume: {}".format(e))
+            controller.logger.critical("Terminating due to error")
+            sys.exit(1)
+        if incomplete_row is not None:
+            controller.logger.warning("WARNING: Incomplete last row of '{}' discarded: '{}'".format(out_path, incomplete_row))
+        controller.logger.info("Resuming: results for {} {}s already in '{}'".format(len(completed_ids), replicate_field, out_path))
+    def _compose_row_prefix(replicate_id, tree):
+        row_prefix = ["{}".format(replicate_id)]
+        if args.tree_info:
+            tree.calc_node_ages()
+            row_prefix.append("{}".format(sum(1 for nd in tree.leaf_node_iter())))
+            row_prefix.append("{}".format(tree.seed_node.age))
+        row_prefix.extend(extra_fields[field] for field in extra_fields)
+        return row_prefix
+    if args.per_tree:
+        controller.logger.info("Reading trees from '{}' (burn-in: {}, thinning: {})".format(args.tree_file, args.burnin, args.thin))
+        trees = itertools.islice(
+                dendropy.Tree.yield_from_files(
+                    files=[args.tree_file],
+                    schema=args.tree_format,
+                    preserve_underscores=args.preserve_underscores),
+                args.burnin,
+                None,
+                args.thin)
+        if args.dry_run:
+            num_trees = 0
+            num_nodes = 0
+            for tree in trees:
+                num_trees += 1
+                num_nodes += sum(1 for nd in tree.postorder_node_iter())
+            controller.logger.info("Number of trees: {}".format(num_trees))
+            controller.logger.info("Number of nodes visited per likelihood evaluation, summed over the trees: {}".format(num_nodes))
+            controller.logger.info("Dry run: no speciation completion rate estimated")
+            controller.logger.info("Terminating normally")
+            return
+        def _iter_replicates():
+            for tree_idx, tree in enumerate(trees):
+                # trees are identified by their position in the tree file
+                tree_id = "{}".format(args.burnin + tree_idx * args.thin + 1)
+                if tree_id in completed_ids:
+                    continue
+                species_leafset_labels = _compile_tree_species_leafset_labels(tree, controller.species_leafset_constraint_labels)
+                if species_leafset_labels is None:
+                    controller.logger.error("ERROR: Species constraints must be fully specifed for rates estimation, but not all lineages of tree {} are constrained.".format(tree_id))
+                    controller.logger.critical("Terminating due to error")
+                    sys.exit(1)
+                yield (_compose_row_prefix(tree_id, tree),
+                        estimator.compose_tree_replicate(
+                            tree=tree,
+                            species_leafset_labels=species_leafset_labels,
+                            speciation_rate_window=_compose_speciation_rate_window(controller, args, tree)))
+    else:
+        tree = controller.tree
+        if args.dry_run:
+            controller.logger.info("Number of lineages: {}".format(len(tree.taxon_namespace)))
+            controller.logger.info("Number of bootstrap replicates: {}".format(args.bootstrap))
+            controller.logger.info("Number of nodes visited per likelihood evaluation: {}".format(
+                sum(1 for nd in tree.postorder_node_iter())))
+            controller.logger.info("Dry run: no speciation completion rate estimated")
+            controller.logger.info("Terminating normally")
+            return
+        speciation_rate_window = (
+                controller.speciation_completion_rate_estimation_initial,
+                controller.speciation_completion_rate_estimation_min,
+                controller.speciation_completion_rate_estimation_max)
+        mle = estimate.SpeciationCompletionRateMaximumLikelihoodEstimator(
+                tree=tree,
+                species_leafset_labels=model._Partition.compile_lookup_key(controller.species_leafset_constraint_labels),
+                initial_speciation_rate=speciation_rate_window[0],
+                min_speciation_rate=speciation_rate_window[1],
+                max_speciation_rate=speciation_rate_window[2])
+        speciation_completion_rate_estimate, speciation_completion_rate_estimate_lnl = mle.estimate_speciation_rate(method=args.optimizer)
+        controller.logger.info("Speciation completion rate estimate: {} (log-likelihood: {})".format(
+            speciation_completion_rate_estimate, speciation_completion_rate_estimate_lnl))
+        if args.random_seed is None:
+            args.random_seed = random.randint(0, sys.maxsize)
+        controller.logger.info("Simulating species partitions for {} parametric bootstrap replicates (random seed: {})".format(
+            args.bootstrap, args.random_seed))
+        # all the replicates are of the same tree
+        tree_row_fields = _compose_row_prefix(None, tree)[1:]
+        def _iter_replicates():
+            for replicate_idx in range(1, args.bootstrap + 1):
+                replicate_id = "{}".format(replicate_idx)
+                if replicate_id in completed_ids:
+                    continue
+                yield ([replicate_id] + tree_row_fields,
+                        estimator.compose_bootstrap_replicate(
+                            tree=tree,
+                            speciation_completion_rate=speciation_completion_rate_estimate,
+                            random_seed=args.random_seed,
+                            replicate_idx=replicate_idx,
+                            speciation_rate_window=speciation_rate_window))
+    out_path, out = open_output_file(
+            args=args,
+            suffix=".rate-results",
+            extension="tsv",
+            is_append=not is_new_output)
+    num_written = 0
+    with out:
+        output_field_separator = args.output_field_separator
+        if is_new_output and not args.no_header_row:
+            out.write(output_field_separator.join(header_row))
+            out.write("\n")
+        for row_prefix, speciation_rate, lnl, standard_error, confidence_interval in estimator.iter_estimates(_iter_replicates()):
+            row = list(row_prefix)
+            row.append("{}".format(speciation_rate))
+            row.append("{}".format(lnl))
+            if args.standard_error:
+                row.append("{}".format(standard_error))
+            if args.intervals:
+                row.append("{}".format(confidence_interval[0]))
+                row.append("{}".format(confidence_interval[1]))
+            out.write(output_field_separator.join(row))
+            out.write("\n")
+            # each replicate is written out as soon as it is done, so an
+            # interrupted run can be resumed
+            out.flush()
+            num_written += 1
+        controller.logger.info("Results for {} {}s written to: '{}'".format(num_written, replicate_field, out_path))
+    controller.logger.info("Operation complete")
+    controller.logger.info("Terminating normally")
+
+def report_speciation_completion_rate_estimate(controller, args, mle, tree_info=None):
+    """
+    Estimates the speciation completion rate with `mle`, with the profile,
+    standard error and confidence intervals requested, and writes the
+    results, preceded by the (field, value) pairs of `tree_info`, if given.
+    """
+    controller.logger.info("Speciation completion rate estimation window minimum: {}".format(mle.min_speciation_rate))
+    controller.logger.info("Speciation completion rate estimation window maximum: {}".format(mle.max_speciation_rate))
+    controller.logger.info("Speciation completion rate estimation initial: {}".format(mle.initial_speciation_rate))
+    profile = None
+    if args.profile:
+        controller.logger.info("Calculating likelihood profile over {} speciation completion rates".format(args.profile))
+        profile_rates = mle.compose_speciation_rate_grid(
+                num_rates=args.profile,
+                scale=args.profile_scale)
+        profile = (profile_rates, mle.calc_speciation_rate_profile(profile_rates))
+    speciation_completion_rate_estimate, speciation_completion_rate_estimate_lnl = mle.estimate_speciation_rate(
+            profile=profile,
+            method=args.optimizer)
+    extra_fields = utility.parse_fieldname_and_value(args.extra_info_field_value)
+    if profile is not None:
+        profile_path, profile_out = open_output_file(
+                args=args,
+                suffix=".rate-profile",
+                extension="tsv")
+        with profile_out:
+            output_field_separator = args.output_field_separator
+            if not args.no_header_row:
+                header_row = list(extra_fields)
+                header_row.append("speciation_completion_rate")
+                header_row.append("lnl")
+                profile_out.write(output_field_separator.join(header_row))
+                profile_out.write("\n")
+            for speciation_completion_rate, lnl in zip(*profile):
+                row = [extra_fields[field] for field in extra_fields]
+                row.append("{}".format(speciation_completion_rate))
+                row.append("{}".format(lnl))
+                profile_out.write(output_field_separator.join(row))
+                profile_out.write("\n")
+            controller.logger.info("Likelihood profile written to: '{}'".format(profile_path))
     out_path, out = open_output_file(
             args=args,
             suffix=".rate-results",
@@ -403,30 +1107,34 @@ def execute_speciation_completion_rate_estimation(args):
         output_field_separator = args.output_field_separator
         if not args.no_header_row:
             header_row = []
-            if args.tree_info:
-                header_row.append("num_tips")
-                header_row.append("root_age")
+            if tree_info is not None:
+                header_row.extend(field for field, _ in tree_info)
             header_row.extend(extra_fields)
             header_row.append("speciation_completion_rate")
             header_row.append("speciation_completion_rate_estimate_lnl")
+            if args.standard_error:
+                header_row.append("speciation_completion_rate_se")
             if args.intervals:
                 header_row.append("ci_low")
                 header_row.append("ci_high")
             out.write(output_field_separator.join(header_row))
             out.write("\n")
         row = []
-        if args.tree_info:
-            row.append("{}".format(len(tree.taxon_namespace)))
-            tree.calc_node_ages()
-            row.append("{}".format(tree.seed_node.age))
+        if tree_info is not None:
+            row.extend("{}".format(value) for _, value in tree_info)
         for field in extra_fields:
             row.append(extra_fields[field])
         row.append("{}".format(speciation_completion_rate_estimate))
         row.append("{}".format(speciation_completion_rate_estimate_lnl))
+        if args.standard_error:
+            row.append("{}".format(mle.estimate_standard_error(
+                mle_speciation_rate=speciation_completion_rate_estimate)))
         if args.intervals:
             ci_low, ci_high = mle.estimate_confidence_interval(
                 mle_speciation_rate=speciation_completion_rate_estimate,
-                max_lnl=speciation_completion_rate_estimate_lnl)
+                max_lnl=speciation_completion_rate_estimate_lnl,
+                method=args.interval_method,
+                num_processes=args.num_processes)
             row.append("{}".format(ci_low))
             row.append("{}".format(ci_high))
         out.write(output_field_separator.join(row))
@@ -483,9 +1191,12 @@ def add_estimation_options(parser, estimation_options=None):
     if not estimation_options:
         estimation_options = parser.add_argument_group("Estimation Options")
     estimation_options.add_argument("-u", "--underflow-protection",
-            action="store_true",
+            nargs="?",
+            const="log",
             default=False,
-            help="Try to protect against underflow by using special number handling classes (slow).",)
+            choices=["log", "decimal"],
+            help="Try to protect against underflow, either by calculating in log space ('log', the default"
+                 " if no mode is given) or by using special number handling classes ('decimal'; slow).",)
     estimation_options.add_argument(
             "--speciation-completion-rate-estimation-min",
             "--smin",
@@ -510,28 +1221,48 @@ def add_estimation_options(parser, estimation_options=None):
             dest="speciation_completion_rate_estimation_initial",
             default=None,
             help="If estimating speciation completion rate, initial value for optimizer [default: 0.01 x lineage tree pure birth rate].")
+    estimation_options.add_argument("--dry-run",
+            action="store_true",
+            default=False,
+            help="Only read the tree and constraints and report the cost of the run: for 'partitions', the exact"
+                 " number of partitions and peak number of partition states held, the memory this requires,"
+                 " and the subtrees at which the number of states blows up; then exit without calculating.")
     parser._estimation_options = estimation_options
     return estimation_options
 
+def compose_output_path(args,
+        suffix,
+        extension,
+        ):
+    if args.output_prefix == "-":
+        return "<STDOUT>"
+    if args.output_prefix is None:
+        args.output_prefix = utility.compose_output_prefix(
+                input_filepath=args.constraints_file,
+                default="delineate",
+                )
+    if suffix is None:
+        suffix = ""
+    return "{}{}.{}".format(
+            args.output_prefix,
+            suffix,
+            extension)
+
 def open_output_file(args,
         suffix,
         extension,
+        is_append=None,
         ):
+    outpath = compose_output_path(
+            args=args,
+            suffix=suffix,
+            extension=extension)
     if args.output_prefix == "-":
-        return "<STDOUT>", sys.stdout
+        return outpath, sys.stdout
     else:
-        if args.output_prefix is None:
-            args.output_prefix = utility.compose_output_prefix(
-                    input_filepath=args.constraints_file,
-                    default="delineate",
-                    )
-        if suffix is None:
-            suffix = ""
-        outpath = "{}{}.{}".format(
-                args.output_prefix,
-                suffix,
-                extension)
-        if getattr(args, "append", False):
+        if is_append is None:
+            is_append = getattr(args, "append", False)
+        if is_append:
             fmode = "a"
         else:
             fmode = "w"
@@ -593,6 +1324,22 @@ def main():
             default=None,
             help="The speciation completion rate. If specified, then the speciation completion rate "
                  " will *not* be estimated, but fixed to this.",)
+    c1_parser._estimation_options.add_argument("--partition-map-schedule",
+            choices=["postorder", "min-memory"],
+            default=None,
+            help="Order in which the partitions of the lineages of each subtree are built when all partitions"
+                 " are enumerated: the postorder of the tree ('postorder'), or, to reduce the peak memory"
+                 " required (e.g., on deep, unbalanced trees), with the subtrees with the most partitions"
+                 " first ('min-memory') [default: 'postorder'].",)
+    c1_parser._estimation_options.add_argument("--beam-epsilon",
+            metavar="#.##",
+            default=None,
+            type=float,
+            help="When all partitions are enumerated, drop the partitions of the lineages of each subtree with a"
+                 " probability less than this times that of the most probable as they are built (and so all"
+                 " partitions of the whole tree they are part of). This is approximate, but the total"
+                 " (unconstrained) probability of the partitions dropped is bounded, and the bound reported"
+                 " as 'pruned_probability' in the results [default: no pruning].",)
 
     report_options = c1_parser.add_argument_group("Report Options")
     report_options.add_argument("-P", "--report-cumulative-probability-threshold",
@@ -600,23 +1347,77 @@ def main():
             metavar="#.##",
             default=None,
             type=float,
-            help="Do not report on partitions outside of this constrained (conditional) cumulative probability.")
+            help="Do not report on partitions outside of this constrained (conditional) cumulative probability"
+                 " (partitions are then enumerated in decreasing order of probability, only as far as needed).")
     report_options.add_argument("--report-mle-only",
             dest="report_mle_only",
             action="store_true",
             default=False,
-            help="Only report maximum likelihood estimate.",)
+            help="Only report maximum likelihood estimate (which is then found directly, without enumerating all partitions).",)
     report_options.add_argument("-p", "--report-probability-threshold",
             dest="report_constrained_probability_threshold",
             metavar="#.##",
             default=None,
             type=float,
-            help="Do not report on partitions with individual constrained (conditional) probability below this threshold.")
+            help="Do not report on partitions with individual constrained (conditional) probability below this threshold"
+                 " (partitions are then enumerated in decreasing order of probability, only as far as needed).")
+    report_options.add_argument("--sample",
+            dest="sample_size",
+            metavar="#",
+            default=None,
+            type=int,
+            help="Instead of enumerating partitions, draw this many independent samples from the (constrained)"
+                 " distribution of partitions, and only report on the distinct partitions sampled, with their"
+                 " sample frequencies.")
+    report_options.add_argument("--random-seed",
+            metavar="#",
+            default=None,
+            type=int,
+            help="Seed for the random number generator used with '--sample' [default: random].")
+    report_options.add_argument("--simulate",
+            action="store_true",
+            default=False,
+            help="With '--sample', draw the samples by forward simulation of speciation events on each edge"
+                 " (rejecting those inconsistent with the species constraints) instead of from the exact"
+                 " distribution; for very large trees.")
+    report_options.add_argument("--processes",
+            dest="num_processes",
+            metavar="#",
+            default=1,
+            type=int,
+            help="Number of processes to spread the simulation of samples over with '--simulate', or the trees"
+                 " over with '--tree-sample' [default: %(default)s].")
+
+    tree_sample_options = c1_parser.add_argument_group("Tree Sample Options")
+    tree_sample_options.add_argument("--tree-sample",
+            action="store_true",
+            default=False,
+            help="Treat the tree file as a sample of trees (e.g., from the posterior distribution of the"
+                 " population tree), and report the probabilities of the partitions (and, with"
+                 " '--conspecificity-matrix', of each pair of lineages being conspecific) averaged over the"
+                 " trees, with their variances across the trees, in a single JSON file. Trees are read one at"
+                 " a time, and the speciation completion rate, if not specified, is estimated on each tree.")
+    tree_sample_options.add_argument("--burnin",
+            metavar="#",
+            default=0,
+            type=int,
+            help="With '--tree-sample', number of trees at the start of the tree file to discard [default: %(default)s].")
+    tree_sample_options.add_argument("--thin",
+            metavar="#",
+            default=1,
+            type=int,
+            help="With '--tree-sample', only use every this-many-th tree after the burn-in [default: %(default)s].")
 
     output_options = c1_parser._output_options
     output_options.add_argument("-I", "--tree-info",
             action="store_true",
             help="Output additional information about the tree.",)
+    output_options.add_argument("--conspecificity-matrix",
+            action="store_true",
+            default=False,
+            help="Calculate the (constrained) marginal probability of each pair of lineages being"
+                 " conspecific directly, without enumerating partitions, and write the matrix of"
+                 " probabilities to a '.conspecificity.tsv' file.",)
     trees_options = c1_parser.add_argument_group("Tree Output Options")
     trees_options.add_argument("--no-translate-tree-tokens",
             action="store_true",
@@ -650,6 +1451,93 @@ def main():
     estimation_options.add_argument("-i", "--intervals", "--confidence-intervals",
             action="store_true",
             help="Calculate confidence intervals.",)
+    estimation_options.add_argument("--interval-method",
+            choices=["minimize", "root"],
+            default="minimize",
+            help="Search for the confidence interval bounds by bounded minimization of the distance of the"
+                 " log-likelihood from its target over the window on either side of the estimate ('minimize'),"
+                 " or by Brent's root-finding method, bracketed by the rates already evaluated by the optimizer"
+                 " and likelihood profile, and reusing their evaluations ('root'; much faster). With '--processes'"
+                 " above 1, the two bounds of a single tree are searched for at the same time [default: %(default)s].",)
+    estimation_options.add_argument("--standard-error",
+            action="store_true",
+            default=False,
+            help="Calculate the standard error of the speciation completion rate estimate from the"
+                 " curvature of the log-likelihood (much faster than '--intervals').",)
+    estimation_options.add_argument("--optimizer",
+            choices=["brent", "newton"],
+            default="brent",
+            help="Optimizer for the speciation completion rate estimate: derivative-free bounded Brent"
+                 " search ('brent'), or safeguarded Newton's method using analytic derivatives of the"
+                 " log-likelihood ('newton'; usually requires far fewer likelihood evaluations)"
+                 " [default: %(default)s].",)
+    estimation_options.add_argument("--profile",
+            metavar="#",
+            type=int,
+            default=0,
+            help="Calculate the log-likelihood profile of the species partition over a grid of this"
+                 " many speciation completion rates spanning the estimation window, write it to a"
+                 " '.rate-profile.tsv' file, and use it to warm-start the optimizer.",)
+    estimation_options.add_argument("--profile-scale",
+            choices=["log", "linear"],
+            default="log",
+            help="Spacing of the speciation completion rates of the likelihood profile grid [default: %(default)s].",)
+    multi_options = c2_parser.add_argument_group("Multiple Tree Options")
+    multi_options.add_argument("--multi",
+            action="store_true",
+            default=False,
+            help="Treat the tree file as a set of trees (e.g., independent clades, or a sample of trees of the"
+                 " same lineages), and estimate a single speciation completion rate shared by all of them, by"
+                 " maximizing the log-likelihood summed over the trees. The species constraints, restricted to"
+                 " the lineages of each tree, must give the species of every lineage of every tree (lineage"
+                 " names are not normalized, and must match exactly).")
+    multi_options.add_argument("--burnin",
+            metavar="#",
+            default=0,
+            type=int,
+            help="With '--multi' or '--per-tree', number of trees at the start of the tree file to discard [default: %(default)s].")
+    multi_options.add_argument("--thin",
+            metavar="#",
+            default=1,
+            type=int,
+            help="With '--multi' or '--per-tree', only use every this-many-th tree after the burn-in [default: %(default)s].")
+    multi_options.add_argument("--processes",
+            dest="num_processes",
+            metavar="#",
+            default=1,
+            type=int,
+            help="With '--multi', number of worker processes to share the trees out over, each holding its"
+                 " trees for all the evaluations of the likelihood; with '--per-tree' or '--bootstrap', number of"
+                 " processes to spread the trees or replicates over; otherwise, with '--intervals' and"
+                 " '--interval-method root', the bounds are searched for in parallel if above 1"
+                 " [default: %(default)s].")
+    replicate_options = c2_parser.add_argument_group("Replicate Options")
+    replicate_options.add_argument("--per-tree",
+            action="store_true",
+            default=False,
+            help="Treat the tree file as a sample of trees (e.g., from the posterior distribution of the population"
+                 " tree), and estimate the speciation completion rate separately on each tree, writing one row per"
+                 " tree to the results file, identified by the position of the tree in the tree file. The species"
+                 " constraints, restricted to the lineages of each tree, must give the species of every lineage of"
+                 " every tree.")
+    replicate_options.add_argument("--bootstrap",
+            metavar="#",
+            default=0,
+            type=int,
+            help="Estimate the speciation completion rate on the tree, then draw this many parametric bootstrap"
+                 " replicates (species partitions of the lineages simulated on the tree under the estimated rate),"
+                 " and estimate the rate again on each, writing one row per replicate to the results file.")
+    replicate_options.add_argument("--random-seed",
+            metavar="#",
+            default=None,
+            type=int,
+            help="Seed for the random number generator used with '--bootstrap' (must be given to resume a run)"
+                 " [default: random].")
+    replicate_options.add_argument("--resume",
+            action="store_true",
+            default=False,
+            help="With '--per-tree' or '--bootstrap', continue an interrupted run with the same options, keeping the"
+                 " complete rows already in the results file and only estimating the trees or replicates missing.")
     output_options = c2_parser._output_options
     output_options.add_argument( "--no-header-row",
             action="store_true",
@@ -88,6 +88,9 @@ class Registry(object):
             self.preanalysis_constrained_lineage_species_map = OrderedCaselessDict()
         self.extra_tree_lineage_names = []
         self.extra_configuration_lineages = []
+        # dense integer indexes of the (normalized) lineage names, shared
+        # with the tree
+        self.lineage_index = None
 
     def normalize_lineage_names(self):
         tree_lineage_set = set(self.tree_lineage_names)
@@ -402,6 +405,10 @@ class Controller(object):
     def species_leafset_constraint_labels(self):
         del self._species_leafset_constraint_labels
 
+    @property
+    def lineage_index(self):
+        return self.registry.lineage_index
+
     @property
     def has_species_constraints(self):
         return SPECIES_LEAFSET_CONSTRAINTS_KEY in self.config_d
@@ -423,7 +430,7 @@ class Controller(object):
                 schema=schema,
                 preserve_underscores=preserve_underscores,
                 )
-        self.tree.is_use_decimal_value_type = underflow_protection
+        self.tree.underflow_protection = underflow_protection
         # self.tree.birth_rate = birthdeath.fit_pure_birth_model_to_tree(
         #         tree=self.tree)["birth_rate"]
         return self.tree
@@ -510,6 +517,8 @@ class Controller(object):
         if self.tree is None:
             raise ValueError("'tree' not set")
         self.registry.tree_lineage_names = [t.label for t in self.tree.taxon_namespace]
+        self.registry.lineage_index = model.LineageIndex(self.registry.tree_lineage_names)
+        self.tree.lineage_index = self.registry.lineage_index
         if "configuration_table" in self.config_d and "lineages" in self.config_d["configuration_table"]:
             self.registry.config_lineage_names = list(self.config_d["configuration_table"]["lineages"])
         else:
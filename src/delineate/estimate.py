@@ -3,24 +3,39 @@
 
 import math
 import sys
+import random
+import collections
 import decimal
+import multiprocessing
+import concurrent.futures
+try:
+    import numpy
+except ImportError:
+    pass
 try:
     import scipy.optimize
 except ImportError:
     pass
+from delineate import model
 
 ci_span = decimal.Decimal(math.exp(1.96))
 
-class SpeciationCompletionRateMaximumLikelihoodEstimator(object):
+# seconds to wait for a result from a worker process before checking that it
+# is still running
+_WORKER_POLL_INTERVAL = 1.0
+
+class _SpeciationCompletionRateEstimator(object):
+    """
+    The search for the maximum likelihood estimate of the speciation
+    completion rate within an estimation window, and for its confidence
+    interval, independent of what the likelihood is of. Derived classes
+    provide `calc_log_likelihood()`.
+    """
 
     def __init__(self,
-            tree,
-            species_leafset_labels,
             initial_speciation_rate,
             min_speciation_rate,
             max_speciation_rate):
-        self.tree = tree
-        self.species_leafset_labels = species_leafset_labels
         self.initial_speciation_rate = initial_speciation_rate
         self.min_speciation_rate = min_speciation_rate
         self.max_speciation_rate = max_speciation_rate
@@ -28,7 +43,11 @@ class SpeciationCompletionRateMaximumLikelihoodEstimator(object):
         assert self.min_speciation_rate <= self.max_speciation_rate
         assert self.min_speciation_rate <= self.initial_speciation_rate
         assert self.max_speciation_rate >= self.initial_speciation_rate
-        self.tree.set_node_constraints(species_leafset_labels=self.species_leafset_labels)
+        # log-likelihoods of the rates evaluated so far, by rate
+        self.log_likelihood_cache = {}
+
+    def calc_log_likelihood(self, speciation_rate):
+        raise NotImplementedError()
 
     def _estimate(self,
             f,
@@ -62,41 +81,109 @@ class SpeciationCompletionRateMaximumLikelihoodEstimator(object):
         # value_estimate_prob = est_result[1]
         # return value_estimate, value_estimate_prob
 
-    def estimate_speciation_rate(self):
-        if len(self.species_leafset_labels) == 1:
-            speciation_completion_rate_estimate = 0.0
-            self.tree.speciation_completion_rate = speciation_completion_rate_estimate
-            speciation_completion_rate_estimate_prob = self.tree.calc_joint_probability_of_species(species_leafset_labels=self.species_leafset_labels)
-        elif self.tree.all_monotypic:
-            speciation_completion_rate_estimate = float('inf')
-            self.tree.speciation_completion_rate = speciation_completion_rate_estimate
-            speciation_completion_rate_estimate_prob = self.tree.calc_joint_probability_of_species(species_leafset_labels=self.species_leafset_labels)
-        else:
-            def f(x, *args):
-                self.tree.speciation_completion_rate = x
-                return -1 * float(self.tree.calc_joint_probability_of_species(species_leafset_labels=self.species_leafset_labels))
-            x1, x2 = self._estimate(f=f,
-                    initial_val=self.initial_speciation_rate,
-                    min_val=self.min_speciation_rate,
-                    max_val=self.max_speciation_rate,
-                    )
-            speciation_completion_rate_estimate = x1
-            speciation_completion_rate_estimate_prob = -1 * x2
-        try:
-            lprob = math.log(speciation_completion_rate_estimate_prob)
-        except ValueError:
-            lprob = float("-inf")
-        return speciation_completion_rate_estimate, lprob
+    def _estimate_newton(self,
+            f,
+            initial_val,
+            min_val,
+            max_val,
+            tol=1e-8,
+            max_iter=100):
+        """
+        Maximizes `f`, which returns a tuple of the value of the objective
+        and its first and second derivatives, by Newton's method on the log
+        of the argument. Steps that do not go uphill or that leave the
+        bracket known to hold the maximum are replaced by bisection of the
+        bracket. Returns the argument and value of the maximum.
+        """
+        assert min_val > 0.0
+        assert min_val <= initial_val <= max_val
+        lo = math.log(min_val)
+        hi = math.log(max_val)
+        u = math.log(initial_val)
+        max_x = None
+        max_fx = float("-inf")
+        for _ in range(max_iter):
+            x = math.exp(u)
+            fx, d1, d2 = f(x)
+            if math.isinf(fx) or math.isnan(d1) or math.isnan(d2):
+                # no gradient to follow; fall back on a derivative-free search
+                x, neg_fx = self._estimate(f=lambda x: -f(x)[0],
+                        initial_val=initial_val,
+                        min_val=min_val,
+                        max_val=max_val)
+                return x, -neg_fx
+            if fx > max_fx:
+                max_x, max_fx = x, fx
+            # derivatives with respect to log(x)
+            g = x * d1
+            h = x * x * d2 + g
+            if g > 0:
+                lo = u
+            elif g < 0:
+                hi = u
+            else:
+                break
+            if h < 0 and lo < u - g / h < hi:
+                next_u = u - g / h
+            else:
+                next_u = (lo + hi) / 2.0
+            if abs(next_u - u) < tol:
+                break
+            u = next_u
+        return max_x, max_fx
+
+    def compose_speciation_rate_grid(self, num_rates, scale="log"):
+        """
+        Returns an array of `num_rates` speciation completion rates spanning
+        the estimation window, spaced evenly on a log (`scale="log"`) or
+        linear (`scale="linear"`) scale.
+        """
+        if scale == "log":
+            return numpy.geomspace(self.min_speciation_rate, self.max_speciation_rate, num_rates)
+        elif scale == "linear":
+            return numpy.linspace(self.min_speciation_rate, self.max_speciation_rate, num_rates)
+        raise ValueError("Unrecognized grid scale: '{}'".format(scale))
+
+    def _profile_bounds(self, profile):
+        # narrow the optimization window to the grid interval around the
+        # best point of the profile
+        speciation_rates, lnls = profile
+        idx = int(numpy.argmax(lnls))
+        min_val = speciation_rates[max(idx - 1, 0)]
+        max_val = speciation_rates[min(idx + 1, len(speciation_rates) - 1)]
+        return float(min_val), float(max_val), float(speciation_rates[idx]), float(lnls[idx])
 
-    def estimate_confidence_interval(self, mle_speciation_rate, max_lnl):
+    def estimate_confidence_interval(self, mle_speciation_rate, max_lnl, method="minimize", num_processes=1):
+        """
+        Returns the lower and upper bounds of the confidence interval of the
+        maximum likelihood estimate of the speciation completion rate,
+        `mle_speciation_rate`, with log-likelihood `max_lnl`: the rates on
+        either side of it at which the log-likelihood falls by 1.96.
+
+        With `method="minimize"`, each bound is found by a bounded
+        minimization of the distance of the log-likelihood from its target
+        over the whole of the window on its side. With `method="root"`, each
+        bound is found as the root of the log-likelihood less its target by
+        Brent's method, bracketed by the closest rates on either side of the
+        bound among those already evaluated (by the optimizer, the
+        likelihood profile, or the other bound), so that usually only a
+        few new evaluations are needed. With `num_processes` greater than 1,
+        the two bounds are then searched for at the same time, in forked
+        processes (where available).
+        """
+        if method == "root":
+            return self._estimate_confidence_interval_roots(
+                    mle_speciation_rate=mle_speciation_rate,
+                    target_lnl=max_lnl - 1.96,
+                    num_processes=num_processes)
+        elif method != "minimize":
+            raise ValueError("Unrecognized confidence interval method: '{}'".format(method))
         def f0(x, *args):
-            self.tree.speciation_completion_rate = x
-            prob = self.tree.calc_joint_probability_of_species(species_leafset_labels=self.species_leafset_labels)
-            try:
-                # sys.stderr.write("{}: {} ({})\n".format(x, abs(max_lnl - 1.96 - math.log(prob)), abs(max_lnl)))
-                return abs(max_lnl - 1.96 - math.log(prob))
-            except ValueError:
+            lprob = self.calc_log_likelihood(x)
+            if lprob == float("-inf"):
                 return sys.float_info.max
+            # sys.stderr.write("{}: {} ({})\n".format(x, abs(max_lnl - 1.96 - lprob), abs(max_lnl)))
+            return abs(max_lnl - 1.96 - lprob)
         min_val = self.min_speciation_rate
         max_val = mle_speciation_rate - 1e-8
         initial_val = min_val + ((max_val - min_val) / 2.0)
@@ -115,3 +202,1187 @@ class SpeciationCompletionRateMaximumLikelihoodEstimator(object):
                 max_val=max_val)
         return ci_low, ci_high
 
+    def _estimate_confidence_interval_roots(self, mle_speciation_rate, target_lnl, num_processes=1):
+        limits = (self.min_speciation_rate, self.max_speciation_rate)
+        if num_processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+            # the forked processes inherit the estimator, with its trees and
+            # cache, so nothing but the bounds and new evaluations is pickled
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=2,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_set_confidence_bound_estimator,
+                    initargs=(self,)) as executor:
+                results = list(executor.map(_estimate_confidence_bound,
+                        [mle_speciation_rate] * 2,
+                        [target_lnl] * 2,
+                        limits))
+            for _, log_likelihood_cache in results:
+                self.log_likelihood_cache.update(log_likelihood_cache)
+            return tuple(bound for bound, _ in results)
+        return tuple(self._estimate_confidence_bound(mle_speciation_rate, target_lnl, limit) for limit in limits)
+
+    def _estimate_confidence_bound(self, mle_speciation_rate, target_lnl, limit):
+        """
+        Returns the rate between `mle_speciation_rate` and `limit` (a bound of
+        the estimation window) at which the log-likelihood falls to
+        `target_lnl`, or `limit`, if it does not fall that far within the
+        window.
+        """
+        def g(x, *args):
+            lnl = self.calc_log_likelihood(x)
+            if lnl == float("-inf"):
+                # Brent's method needs finite values
+                return -sys.float_info.max
+            return lnl - target_lnl
+        is_lower = limit < mle_speciation_rate
+        evaluated = [(x, lnl) for x, lnl in self.log_likelihood_cache.items()
+                if (limit <= x < mle_speciation_rate if is_lower else mle_speciation_rate < x <= limit)]
+        # the closest rate to the estimate known to be beyond the bound ...
+        beyond = [x for x, lnl in evaluated if lnl < target_lnl]
+        if beyond:
+            far = max(beyond) if is_lower else min(beyond)
+        elif g(limit) >= 0:
+            return limit
+        else:
+            far = limit
+        # ... and the closest rate to it known to be within the bound
+        near = mle_speciation_rate
+        for x, lnl in evaluated:
+            if lnl >= target_lnl and (far < x < near if is_lower else near < x < far):
+                near = x
+        return scipy.optimize.brentq(g, far, near, rtol=1e-10)
+
+class SpeciationCompletionRateMaximumLikelihoodEstimator(_SpeciationCompletionRateEstimator):
+
+    def __init__(self,
+            tree,
+            species_leafset_labels,
+            initial_speciation_rate,
+            min_speciation_rate,
+            max_speciation_rate):
+        _SpeciationCompletionRateEstimator.__init__(self,
+                initial_speciation_rate=initial_speciation_rate,
+                min_speciation_rate=min_speciation_rate,
+                max_speciation_rate=max_speciation_rate)
+        self.tree = tree
+        self.species_leafset_labels = species_leafset_labels
+        self.tree.set_node_constraints(species_leafset_labels=self.species_leafset_labels)
+
+    def calc_speciation_rate_profile(self, speciation_rates):
+        """
+        Returns an array of the log-likelihoods of the species partition under
+        each of the speciation completion rates in `speciation_rates`, all
+        calculated in a single (vectorized) pass over the tree.
+        """
+        speciation_rates = numpy.asarray(speciation_rates, dtype=float)
+        current_speciation_rate = self.tree.speciation_completion_rate
+        self.tree.speciation_completion_rate = speciation_rates
+        try:
+            lnls = self.tree.calc_joint_log_probability_of_species(species_leafset_labels=self.species_leafset_labels)
+        finally:
+            self.tree.speciation_completion_rate = current_speciation_rate
+        self.log_likelihood_cache.update(zip(speciation_rates.tolist(), numpy.asarray(lnls, dtype=float).tolist()))
+        return lnls
+
+    def calc_log_likelihood(self, speciation_rate):
+        """
+        Returns the log-likelihood of the species partition under
+        `speciation_rate`, looking it up in `log_likelihood_cache`, which
+        holds every rate evaluated so far by this estimator (by the
+        optimizer, the likelihood profile, or the confidence interval
+        search), if it has been evaluated before.
+        """
+        speciation_rate = float(speciation_rate)
+        try:
+            return self.log_likelihood_cache[speciation_rate]
+        except KeyError:
+            pass
+        self.tree.speciation_completion_rate = speciation_rate
+        lnl = float(self.tree.calc_joint_log_probability_of_species(species_leafset_labels=self.species_leafset_labels))
+        self.log_likelihood_cache[speciation_rate] = lnl
+        return lnl
+
+    def estimate_speciation_rate(self, profile=None, method="brent"):
+        """
+        Returns the maximum likelihood estimate of the speciation completion
+        rate and its log-likelihood. If given, `profile` is a tuple of an
+        array of rates (in ascending order) and the corresponding
+        log-likelihoods (as returned by `calc_speciation_rate_profile()`),
+        and is used to warm-start the optimizer, which then only searches the
+        grid interval around the best rate of the profile.
+
+        The optimizer is either derivative-free bounded Brent minimization
+        (`method="brent"`) or a safeguarded Newton's method using the
+        analytic derivatives of the log-likelihood (`method="newton"`), which
+        usually converges in far fewer evaluations.
+        """
+        if method not in ("brent", "newton"):
+            raise ValueError("Unrecognized optimization method: '{}'".format(method))
+        if len(self.species_leafset_labels) == 1:
+            speciation_completion_rate_estimate = 0.0
+            self.tree.speciation_completion_rate = speciation_completion_rate_estimate
+            speciation_completion_rate_estimate_prob = self.tree.calc_joint_probability_of_species(species_leafset_labels=self.species_leafset_labels)
+        elif self.tree.all_monotypic:
+            speciation_completion_rate_estimate = float('inf')
+            self.tree.speciation_completion_rate = speciation_completion_rate_estimate
+            speciation_completion_rate_estimate_prob = self.tree.calc_joint_probability_of_species(species_leafset_labels=self.species_leafset_labels)
+        else:
+            initial_val = self.initial_speciation_rate
+            min_val = self.min_speciation_rate
+            max_val = self.max_speciation_rate
+            if profile is not None:
+                min_val, max_val, initial_val, profile_lnl = self._profile_bounds(profile)
+            if method == "newton":
+                def f(x, *args):
+                    self.tree.speciation_completion_rate = x
+                    fx, d1, d2 = self.tree.calc_joint_log_probability_of_species_derivatives(species_leafset_labels=self.species_leafset_labels)
+                    self.log_likelihood_cache[float(x)] = float(fx)
+                    return fx, d1, d2
+                x1, lnl = self._estimate_newton(f=f,
+                        initial_val=initial_val,
+                        min_val=min_val,
+                        max_val=max_val,
+                        )
+                if profile is not None and profile_lnl > lnl:
+                    x1, lnl = initial_val, profile_lnl
+                return x1, lnl
+            if self.tree.is_use_log_value_type:
+                # probabilities may underflow, so optimize the log probability
+                def f(x, *args):
+                    return -1 * self.calc_log_likelihood(x)
+            else:
+                def f(x, *args):
+                    self.tree.speciation_completion_rate = x
+                    prob = float(self.tree.calc_joint_probability_of_species(species_leafset_labels=self.species_leafset_labels))
+                    if prob > 0.0:
+                        # (a probability that underflows a float may still
+                        # have a finite log-likelihood, so is not cached)
+                        self.log_likelihood_cache[float(x)] = math.log(prob)
+                    return -1 * prob
+            if min_val < max_val:
+                x1, x2 = self._estimate(f=f,
+                        initial_val=initial_val,
+                        min_val=min_val,
+                        max_val=max_val,
+                        )
+            else:
+                x1, x2 = initial_val, f(initial_val)
+            if self.tree.is_use_log_value_type:
+                lnl = -1 * x2
+                if profile is not None and profile_lnl > lnl:
+                    # the optimizer never evaluates the bounds themselves
+                    x1, lnl = initial_val, profile_lnl
+                return x1, lnl
+            speciation_completion_rate_estimate = x1
+            speciation_completion_rate_estimate_prob = -1 * x2
+            if profile is not None and math.exp(profile_lnl) > speciation_completion_rate_estimate_prob:
+                speciation_completion_rate_estimate = initial_val
+                speciation_completion_rate_estimate_prob = math.exp(profile_lnl)
+        try:
+            lprob = math.log(speciation_completion_rate_estimate_prob)
+        except ValueError:
+            lprob = float("-inf")
+        return speciation_completion_rate_estimate, lprob
+
+    def estimate_standard_error(self, mle_speciation_rate):
+        """
+        Returns the standard error of the maximum likelihood estimate of the
+        speciation completion rate, `mle_speciation_rate`, given by the
+        curvature of the log-likelihood at the estimate (i.e., the observed
+        information). This only takes a single evaluation, as opposed to the
+        two searches of `estimate_confidence_interval()`, but assumes that the
+        log-likelihood is approximately quadratic around the estimate.
+        Returns NaN if the log-likelihood is not curved downward at the
+        estimate (e.g., if it is at a boundary of the estimation window).
+        """
+        self.tree.speciation_completion_rate = mle_speciation_rate
+        _, _, d2 = self.tree.calc_joint_log_probability_of_species_derivatives(species_leafset_labels=self.species_leafset_labels)
+        if not d2 < 0:
+            return float("nan")
+        return 1.0 / math.sqrt(-d2)
+
+_confidence_bound_estimator = None
+
+def _set_confidence_bound_estimator(mle):
+    global _confidence_bound_estimator
+    _confidence_bound_estimator = mle
+
+def _estimate_confidence_bound(mle_speciation_rate, target_lnl, limit):
+    # runs in a process forked by
+    # `_SpeciationCompletionRateEstimator._estimate_confidence_interval_roots()`;
+    # returns the bound with the log-likelihoods evaluated, to be cached
+    mle = _confidence_bound_estimator
+    bound = mle._estimate_confidence_bound(mle_speciation_rate, target_lnl, limit)
+    return bound, mle.log_likelihood_cache
+
+class _TreeSetLikelihood(object):
+    """
+    A set of trees, each with the species partition of its lineages set as
+    its species constraints, with the log-likelihood of the partitions, or
+    its derivatives, summed over the trees.
+    """
+
+    def __init__(self, tree_strs, species_leafset_labels_list, underflow_protection):
+        self.trees = []
+        for tree_str, species_leafset_labels in zip(tree_strs, species_leafset_labels_list):
+            tree = model.LineageTree.get(
+                    data=tree_str,
+                    schema="newick",
+                    preserve_underscores=True)
+            tree.underflow_protection = underflow_protection
+            tree.set_node_constraints(species_leafset_labels=species_leafset_labels)
+            self.trees.append((tree, species_leafset_labels))
+
+    def evaluate(self, speciation_rate, is_derivatives=False):
+        # sums of the log-likelihoods (or of the tuples of the log-likelihood
+        # and its first and second derivatives), for a rate or an array of
+        # rates (see `calc_joint_log_probability_of_species()`)
+        total = (0.0, 0.0, 0.0) if is_derivatives else 0.0
+        for tree, species_leafset_labels in self.trees:
+            tree.speciation_completion_rate = speciation_rate
+            if is_derivatives:
+                value = tree.calc_joint_log_probability_of_species_derivatives(species_leafset_labels=species_leafset_labels)
+                total = tuple(a + b for a, b in zip(total, value))
+            else:
+                total = total + tree.calc_joint_log_probability_of_species(species_leafset_labels=species_leafset_labels)
+        return total
+
+def _tree_set_likelihood_worker(conn, tree_strs, species_leafset_labels_list, underflow_protection):
+    """
+    Runs a worker process of
+    `SharedSpeciationCompletionRateMaximumLikelihoodEstimator`: builds its
+    share of the trees once, and then evaluates the log-likelihood summed
+    over them for each request received, until sent None. Errors are sent
+    back to be raised by the estimator.
+    """
+    try:
+        tree_set = _TreeSetLikelihood(tree_strs, species_leafset_labels_list, underflow_protection)
+    except Exception as e:
+        conn.send((False, e))
+        return
+    conn.send((True, None))
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        try:
+            conn.send((True, tree_set.evaluate(*request)))
+        except Exception as e:
+            conn.send((False, e))
+    conn.close()
+
+class SharedSpeciationCompletionRateMaximumLikelihoodEstimator(_SpeciationCompletionRateEstimator):
+    """
+    Estimates a single speciation completion rate shared by a set of trees
+    (e.g., independent clades, or a sample of trees of the same lineages),
+    each with its own species partition, by maximizing the log-likelihood
+    summed over the trees.
+
+    With `num_processes` greater than 1, the trees are shared out (by
+    number of lineages) over a pool of persistent worker processes, each
+    of which builds its trees, with their species constraints set, once,
+    and then evaluates the log-likelihood summed over its trees at each
+    rate the optimizer requests; only the rates and the sums are sent
+    between processes. The workers are stopped by `close()` (or on leaving
+    a `with` block).
+    """
+
+    def __init__(self,
+            trees,
+            species_leafset_labels_list,
+            initial_speciation_rate,
+            min_speciation_rate,
+            max_speciation_rate,
+            underflow_protection=False,
+            num_processes=1):
+        _SpeciationCompletionRateEstimator.__init__(self,
+                initial_speciation_rate=initial_speciation_rate,
+                min_speciation_rate=min_speciation_rate,
+                max_speciation_rate=max_speciation_rate)
+        self.species_leafset_labels_list = list(species_leafset_labels_list)
+        tree_strs = [tree.as_string(schema="newick") for tree in trees]
+        if len(tree_strs) != len(self.species_leafset_labels_list):
+            raise ValueError("Number of trees ({}) does not match number of species partitions ({})".format(
+                len(tree_strs), len(self.species_leafset_labels_list)))
+        self.num_trees = len(tree_strs)
+        self.num_processes = max(1, min(num_processes, self.num_trees))
+        self._tree_set = None
+        self._workers = []
+        if self.num_processes == 1:
+            self._tree_set = _TreeSetLikelihood(tree_strs, self.species_leafset_labels_list, underflow_protection)
+            return
+        # the largest trees first, each to the worker with the fewest
+        # lineages so far
+        shares = [[] for _ in range(self.num_processes)]
+        share_sizes = [0] * self.num_processes
+        num_leaves = [sum(len(leafset) for leafset in species_leafset_labels)
+                for species_leafset_labels in self.species_leafset_labels_list]
+        for tree_idx in sorted(range(self.num_trees), key=lambda idx: num_leaves[idx], reverse=True):
+            share_idx = share_sizes.index(min(share_sizes))
+            shares[share_idx].append(tree_idx)
+            share_sizes[share_idx] += num_leaves[tree_idx]
+        try:
+            for share in shares:
+                parent_conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                        target=_tree_set_likelihood_worker,
+                        args=(child_conn,
+                            [tree_strs[idx] for idx in share],
+                            [self.species_leafset_labels_list[idx] for idx in share],
+                            underflow_protection))
+                process.daemon = True
+                process.start()
+                child_conn.close()
+                self._workers.append((process, parent_conn))
+            self._gather()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+                conn.close()
+            except (OSError, ValueError):
+                pass
+        for process, conn in self._workers:
+            process.join()
+        self._workers = []
+
+    def _raise_worker_exited(self, process):
+        process.join()
+        raise RuntimeError("Worker process {} exited unexpectedly (exit code: {})".format(
+            process.pid, process.exitcode))
+
+    def _gather(self):
+        results = []
+        errors = []
+        for process, conn in self._workers:
+            # a worker that dies (e.g., killed for running out of memory)
+            # never sends its result
+            while not conn.poll(_WORKER_POLL_INTERVAL):
+                if not process.is_alive():
+                    break
+            try:
+                is_ok, result = conn.recv()
+            except EOFError:
+                self._raise_worker_exited(process)
+            if is_ok:
+                results.append(result)
+            else:
+                errors.append(result)
+        if errors:
+            raise errors[0]
+        return results
+
+    def _evaluate(self, speciation_rate, is_derivatives=False):
+        if self._tree_set is not None:
+            return self._tree_set.evaluate(speciation_rate, is_derivatives)
+        for process, conn in self._workers:
+            try:
+                conn.send((speciation_rate, is_derivatives))
+            except OSError:
+                self._raise_worker_exited(process)
+        results = self._gather()
+        if is_derivatives:
+            return tuple(sum(values) for values in zip(*results))
+        total = results[0]
+        for result in results[1:]:
+            total = total + result
+        return total
+
+    def calc_log_likelihood(self, speciation_rate):
+        """
+        Returns the log-likelihood of the species partitions of the trees,
+        summed over the trees, under `speciation_rate` (looked up in
+        `log_likelihood_cache`, if evaluated before).
+        """
+        speciation_rate = float(speciation_rate)
+        try:
+            return self.log_likelihood_cache[speciation_rate]
+        except KeyError:
+            pass
+        lnl = float(self._evaluate(speciation_rate))
+        self.log_likelihood_cache[speciation_rate] = lnl
+        return lnl
+
+    def calc_log_likelihood_derivatives(self, speciation_rate):
+        """
+        Returns a tuple of the summed log-likelihood (as given by
+        `calc_log_likelihood()`) and its first and second derivatives with
+        respect to the speciation completion rate.
+        """
+        lnl, d1, d2 = self._evaluate(speciation_rate, is_derivatives=True)
+        self.log_likelihood_cache[float(speciation_rate)] = float(lnl)
+        return lnl, d1, d2
+
+    def calc_speciation_rate_profile(self, speciation_rates):
+        """
+        Returns an array of the summed log-likelihoods under each of the
+        speciation completion rates in `speciation_rates`, calculated in a
+        single (vectorized) pass over each tree.
+        """
+        speciation_rates = numpy.asarray(speciation_rates, dtype=float)
+        lnls = self._evaluate(speciation_rates)
+        self.log_likelihood_cache.update(zip(speciation_rates.tolist(), numpy.asarray(lnls, dtype=float).tolist()))
+        return lnls
+
+    def estimate_speciation_rate(self, profile=None, method="brent"):
+        """
+        Returns the maximum likelihood estimate of the shared speciation
+        completion rate and its summed log-likelihood, as
+        `SpeciationCompletionRateMaximumLikelihoodEstimator.estimate_speciation_rate()`,
+        including the estimate of 0 if the lineages of every tree form a
+        single species, and infinity if every lineage is its own species.
+        """
+        if method not in ("brent", "newton"):
+            raise ValueError("Unrecognized optimization method: '{}'".format(method))
+        if all(len(species_leafset_labels) == 1 for species_leafset_labels in self.species_leafset_labels_list):
+            # no speciation on any tree
+            speciation_completion_rate_estimate = 0.0
+            return speciation_completion_rate_estimate, self.calc_log_likelihood(speciation_completion_rate_estimate)
+        if all(len(leafset) == 1
+                for species_leafset_labels in self.species_leafset_labels_list
+                for leafset in species_leafset_labels):
+            # every lineage of every tree its own species
+            speciation_completion_rate_estimate = float("inf")
+            return speciation_completion_rate_estimate, self.calc_log_likelihood(speciation_completion_rate_estimate)
+        initial_val = self.initial_speciation_rate
+        min_val = self.min_speciation_rate
+        max_val = self.max_speciation_rate
+        if profile is not None:
+            min_val, max_val, initial_val, profile_lnl = self._profile_bounds(profile)
+        if method == "newton":
+            x1, lnl = self._estimate_newton(f=self.calc_log_likelihood_derivatives,
+                    initial_val=initial_val,
+                    min_val=min_val,
+                    max_val=max_val,
+                    )
+        elif min_val < max_val:
+            x1, neg_lnl = self._estimate(f=lambda x, *args: -1 * self.calc_log_likelihood(x),
+                    initial_val=initial_val,
+                    min_val=min_val,
+                    max_val=max_val,
+                    )
+            lnl = -1 * neg_lnl
+        else:
+            x1, lnl = initial_val, self.calc_log_likelihood(initial_val)
+        if profile is not None and profile_lnl > lnl:
+            # the optimizer never evaluates the bounds themselves
+            x1, lnl = initial_val, profile_lnl
+        return x1, lnl
+
+    def estimate_confidence_interval(self, mle_speciation_rate, max_lnl, method="minimize", num_processes=1):
+        """
+        Returns the lower and upper bounds of the confidence interval of the
+        estimate of the shared speciation completion rate, as
+        `SpeciationCompletionRateMaximumLikelihoodEstimator.estimate_confidence_interval()`,
+        but always searching for the bounds one after the other, as each
+        evaluation is already spread over the worker processes.
+        """
+        return _SpeciationCompletionRateEstimator.estimate_confidence_interval(self,
+                mle_speciation_rate=mle_speciation_rate,
+                max_lnl=max_lnl,
+                method=method,
+                num_processes=1)
+
+    def estimate_standard_error(self, mle_speciation_rate):
+        """
+        Returns the standard error of the estimate of the shared speciation
+        completion rate from the curvature of the summed log-likelihood, as
+        `SpeciationCompletionRateMaximumLikelihoodEstimator.estimate_standard_error()`.
+        """
+        _, _, d2 = self.calc_log_likelihood_derivatives(mle_speciation_rate)
+        if not d2 < 0:
+            return float("nan")
+        return 1.0 / math.sqrt(-d2)
+
+def _estimate_replicate_speciation_rate(task):
+    """
+    Estimates the speciation completion rate on one replicate composed by
+    `ReplicateSpeciationCompletionRateEstimator`: a tree, given as a newick
+    string, with either a known species partition or, for a parametric
+    bootstrap replicate, a species partition drawn on the tree under the
+    given rate with its own random number generator. Returns the estimate,
+    its log-likelihood, and its standard error and confidence interval (or
+    None, if not requested).
+    """
+    (tree_str,
+            species_leafset_labels,
+            simulation_speciation_rate,
+            seed,
+            speciation_rate_window,
+            underflow_protection,
+            method,
+            is_calc_standard_error,
+            is_calc_confidence_interval,
+            confidence_interval_method) = task
+    tree = model.LineageTree.get(
+            data=tree_str,
+            schema="newick",
+            preserve_underscores=True)
+    tree.underflow_protection = underflow_protection
+    if species_leafset_labels is None:
+        tree.speciation_completion_rate = simulation_speciation_rate
+        species_leafset_labels = tree.sample_label_partitions(1, rng=random.Random(seed))[0]
+    initial_speciation_rate, min_speciation_rate, max_speciation_rate = speciation_rate_window
+    mle = SpeciationCompletionRateMaximumLikelihoodEstimator(
+            tree=tree,
+            species_leafset_labels=species_leafset_labels,
+            initial_speciation_rate=initial_speciation_rate,
+            min_speciation_rate=min_speciation_rate,
+            max_speciation_rate=max_speciation_rate)
+    speciation_rate, lnl = mle.estimate_speciation_rate(method=method)
+    # a partition of a single species or of all singletons has its
+    # estimate at 0 or infinity, with no curvature or interval around it
+    is_interior = 0.0 < speciation_rate < float("inf")
+    standard_error = None
+    if is_calc_standard_error:
+        standard_error = mle.estimate_standard_error(speciation_rate) if is_interior else float("nan")
+    confidence_interval = None
+    if is_calc_confidence_interval:
+        if is_interior:
+            confidence_interval = mle.estimate_confidence_interval(speciation_rate, lnl, method=confidence_interval_method)
+        else:
+            confidence_interval = (float("nan"), float("nan"))
+    return speciation_rate, lnl, standard_error, confidence_interval
+
+class ReplicateSpeciationCompletionRateEstimator(object):
+    """
+    Estimates the speciation completion rate independently on each of a
+    series of replicates: trees with known species partitions (e.g., a
+    sample of trees from the posterior distribution of the population
+    tree), or parametric bootstrap replicates, each a species partition
+    drawn on the same tree under a given rate, to give the distribution of
+    the estimate.
+
+    Replicates are estimated independently, optionally spread over a pool
+    of `num_processes` processes, with no more than
+    `max_pending_replicates` replicates in flight at any one time, and the
+    estimates are yielded in the order of the replicates as they are done,
+    so they can be written out as they come in.
+    """
+
+    def __init__(self,
+            underflow_protection=False,
+            method="brent",
+            is_calc_standard_error=False,
+            is_calc_confidence_interval=False,
+            confidence_interval_method="minimize",
+            num_processes=1,
+            max_pending_replicates=None):
+        if method not in ("brent", "newton"):
+            raise ValueError("Unrecognized optimization method: '{}'".format(method))
+        if confidence_interval_method not in ("minimize", "root"):
+            raise ValueError("Unrecognized confidence interval method: '{}'".format(confidence_interval_method))
+        self.underflow_protection = underflow_protection
+        self.method = method
+        self.is_calc_standard_error = is_calc_standard_error
+        self.is_calc_confidence_interval = is_calc_confidence_interval
+        self.confidence_interval_method = confidence_interval_method
+        self.num_processes = num_processes
+        if max_pending_replicates is None:
+            max_pending_replicates = 2 * num_processes
+        self.max_pending_replicates = max_pending_replicates
+
+    def _compose_task(self, tree, species_leafset_labels, simulation_speciation_rate, seed, speciation_rate_window):
+        return (tree.as_string(schema="newick"),
+                species_leafset_labels,
+                simulation_speciation_rate,
+                seed,
+                tuple(speciation_rate_window),
+                self.underflow_protection,
+                self.method,
+                self.is_calc_standard_error,
+                self.is_calc_confidence_interval,
+                self.confidence_interval_method)
+
+    def compose_tree_replicate(self, tree, species_leafset_labels, speciation_rate_window):
+        """
+        Returns a replicate of `tree` with the known species partition
+        `species_leafset_labels` (a lookup key; see
+        `model._Partition.compile_lookup_key()`), with the rate estimated
+        within `speciation_rate_window`, a tuple of the initial, minimum and
+        maximum rates.
+        """
+        return self._compose_task(tree, species_leafset_labels, None, None, speciation_rate_window)
+
+    def compose_bootstrap_replicate(self, tree, speciation_completion_rate, random_seed, replicate_idx, speciation_rate_window):
+        """
+        Returns the parametric bootstrap replicate `replicate_idx` of `tree`:
+        a species partition drawn on the tree under
+        `speciation_completion_rate`, with the rate estimated within
+        `speciation_rate_window`. Each replicate draws its partition with its
+        own random number generator, spawned from `random_seed`, so it is the
+        same irrespective of the number of processes or of which other
+        replicates are run.
+        """
+        seed = int(numpy.random.SeedSequence(random_seed, spawn_key=(replicate_idx,)).generate_state(1)[0])
+        return self._compose_task(tree, None, speciation_completion_rate, seed, speciation_rate_window)
+
+    def iter_estimates(self, replicates):
+        """
+        Estimates the rate on each of `replicates`, an iterable of tuples of
+        an identifier and a replicate (as composed by
+        `compose_tree_replicate()` or `compose_bootstrap_replicate()`), which
+        may be a generator, and is only read as far as the replicates in
+        flight require. Yields tuples of the identifier, the estimate, its
+        log-likelihood, and its standard error and confidence interval (None
+        if not requested), in the order of the replicates.
+        """
+        if self.num_processes > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_processes) as executor:
+                pending = collections.deque()
+                for replicate_id, task in replicates:
+                    if len(pending) >= self.max_pending_replicates:
+                        pending_id, future = pending.popleft()
+                        yield (pending_id,) + future.result()
+                    pending.append((replicate_id, executor.submit(_estimate_replicate_speciation_rate, task)))
+                while pending:
+                    pending_id, future = pending.popleft()
+                    yield (pending_id,) + future.result()
+        else:
+            for replicate_id, task in replicates:
+                yield (replicate_id,) + _estimate_replicate_speciation_rate(task)
+
+def _simulate_partition_batch(task):
+    """
+    Simulates speciation events on the edges of a tree compiled by
+    `SpeciesPartitionMonteCarloEstimator` for a batch of draws. Returns the
+    number of draws consistent with the species constraints, the log of the
+    scale of the importance weights of the draws, and, over the
+    draws consistent with the species constraints, the sums of the (scaled)
+    weights and of their squares: in total, for each of the distinct
+    partitions (given as rows of the index of the first leaf of the species
+    of each leaf), for the leaves of each node being exactly a species, and
+    for each pair of leaves being conspecific (None if not requested).
+    """
+    (parent_indexes,
+            prob_sp,
+            log_weights_sp,
+            log_weights_no_sp,
+            leaf_node_indexes,
+            constrained_leaf_indexes,
+            constrained_first_leaf_indexes,
+            species_first_leaf_indexes,
+            batch_size,
+            seed,
+            is_count_conspecificity) = task
+    rng = numpy.random.default_rng(seed)
+    num_nodes = len(parent_indexes)
+    num_leaves = len(leaf_node_indexes)
+    # nodes are in preorder, and the root (first) always starts a species
+    is_sp = rng.random((batch_size, num_nodes)) < prob_sp
+    # topmost node of the species of each node (i.e., the node below the
+    # nearest speciation event above it)
+    top = numpy.empty((batch_size, num_nodes), dtype=numpy.intp)
+    top[:, 0] = 0
+    for idx in range(1, num_nodes):
+        top[:, idx] = numpy.where(is_sp[:, idx], idx, top[:, parent_indexes[idx]])
+    # first and number of leaves connected to each node from below, and
+    # whether there is a speciation event anywhere below each node
+    first_leaf = numpy.full((batch_size, num_nodes), num_leaves, dtype=numpy.intp)
+    first_leaf[:, leaf_node_indexes] = numpy.arange(num_leaves)
+    num_leaves_connected = numpy.zeros((batch_size, num_nodes), dtype=numpy.intp)
+    num_leaves_connected[:, leaf_node_indexes] = 1
+    num_leaves_below = numpy.zeros(num_nodes, dtype=numpy.intp)
+    num_leaves_below[leaf_node_indexes] = 1
+    is_sp_below = numpy.zeros((batch_size, num_nodes), dtype=bool)
+    for idx in range(num_nodes - 1, 0, -1):
+        parent_idx = parent_indexes[idx]
+        numpy.minimum(first_leaf[:, parent_idx],
+                numpy.where(is_sp[:, idx], num_leaves, first_leaf[:, idx]),
+                out=first_leaf[:, parent_idx])
+        num_leaves_connected[:, parent_idx] += numpy.where(is_sp[:, idx], 0, num_leaves_connected[:, idx])
+        num_leaves_below[parent_idx] += num_leaves_below[idx]
+        is_sp_below[:, parent_idx] |= is_sp[:, idx] | is_sp_below[:, idx]
+    species = numpy.take_along_axis(first_leaf, top[:, leaf_node_indexes], axis=1)
+    is_accepted = numpy.ones(batch_size, dtype=bool)
+    if len(constrained_leaf_indexes):
+        is_accepted &= numpy.all(species[:, constrained_leaf_indexes] == species[:, constrained_first_leaf_indexes], axis=1)
+    if len(species_first_leaf_indexes) > 1:
+        constrained_species = numpy.sort(species[:, species_first_leaf_indexes], axis=1)
+        is_accepted &= numpy.all(constrained_species[:, 1:] != constrained_species[:, :-1], axis=1)
+    # the leaves of a node are a species if they are all connected to it, and
+    # no other leaves are connected to the top of its species
+    is_clade_species = ~is_sp_below & (numpy.take_along_axis(num_leaves_connected, top, axis=1) == num_leaves_below)
+    species = species[is_accepted]
+    is_clade_species = is_clade_species[is_accepted]
+    log_weights = numpy.where(is_sp[is_accepted], log_weights_sp, log_weights_no_sp).sum(axis=1)
+    log_weight_scale = log_weights.max() if len(log_weights) else 0.0
+    weights = numpy.exp(log_weights - log_weight_scale)
+    weight_sums = (weights.sum(), numpy.square(weights).sum())
+    partitions, partition_idxs = numpy.unique(species, axis=0, return_inverse=True)
+    partition_idxs = partition_idxs.reshape(-1)
+    partition_weight_sums = (
+            numpy.bincount(partition_idxs, weights=weights, minlength=len(partitions)),
+            numpy.bincount(partition_idxs, weights=numpy.square(weights), minlength=len(partitions)))
+    clade_weight_sums = (weights.dot(is_clade_species), numpy.square(weights).dot(is_clade_species))
+    conspecificity_weight_sums = None
+    if is_count_conspecificity:
+        w1 = numpy.zeros((num_leaves, num_leaves))
+        w2 = numpy.zeros((num_leaves, num_leaves))
+        chunk_size = max(1, (1 << 22) // (num_leaves * num_leaves))
+        for start in range(0, len(species), chunk_size):
+            chunk = species[start:start+chunk_size]
+            is_conspecific = chunk[:, :, None] == chunk[:, None, :]
+            chunk_weights = weights[start:start+chunk_size]
+            w1 += numpy.einsum("k,kij->ij", chunk_weights, is_conspecific)
+            w2 += numpy.einsum("k,kij->ij", numpy.square(chunk_weights), is_conspecific)
+        conspecificity_weight_sums = (w1, w2)
+    return (len(species),
+            log_weight_scale,
+            weight_sums,
+            (partitions, partition_weight_sums),
+            clade_weight_sums,
+            conspecificity_weight_sums)
+
+class SpeciesPartitionMonteCarloEstimator(object):
+    """
+    Estimates the probabilities of the partitions of the lineages of a tree
+    into species, of the leaves of each node being exactly a species, and of
+    each pair of lineages being conspecific, conditional on the species
+    constraints set on the tree (if any), by forward simulation: a
+    speciation event is drawn on each edge independently, with probability
+    `1 - exp(-length * rate)`.
+
+    Two lineages are conspecific if and only if there is no speciation event
+    on the path between them, so with species constraints, no speciation
+    events are drawn on the edges on which they are not allowed (which
+    conditions the draws on the lineages of each constrained species being
+    conspecific exactly), events are drawn with a probability of at least
+    `min_separating_prob_sp` on the edges that separate constrained species
+    (with the draws importance-weighted accordingly), and the draws that
+    still join different constrained species are rejected.
+
+    Draws are simulated in vectorized batches, optionally spread over a pool
+    of `num_processes` processes, so the time taken is linear in the size of
+    the tree and in the number of draws.
+    """
+
+    def __init__(self,
+            tree,
+            batch_size=1000,
+            num_processes=1,
+            min_separating_prob_sp=0.5):
+        self.tree = tree
+        self.batch_size = batch_size
+        self.num_processes = num_processes
+        self.min_separating_prob_sp = min_separating_prob_sp
+        self.nodes = list(tree.preorder_node_iter())
+        node_indexes = dict((nd, idx) for idx, nd in enumerate(self.nodes))
+        self.parent_indexes = numpy.array([0] + [node_indexes[nd.parent_node] for nd in self.nodes[1:]], dtype=numpy.intp)
+        self.leaf_nodes = list(tree.leaf_node_iter())
+        self.leaf_labels = [nd.taxon.label for nd in self.leaf_nodes]
+        self.leaf_node_indexes = numpy.array([node_indexes[nd] for nd in self.leaf_nodes], dtype=numpy.intp)
+        self.clear()
+
+    def clear(self):
+        self.log_prob_no_sp_forced = 0.0
+        self.num_draws = 0
+        self.num_accepted = 0
+        # sums of the importance weights (and of their squares) of the
+        # accepted draws, scaled by exp(-log_weight_scale) (and its square)
+        self.log_weight_scale = None
+        self.weight_sums = None
+        self.partition_weight_sums = {}
+        self.clade_weight_sums = None
+        self.conspecificity_weight_sums = None
+
+    def _compile_constraints(self):
+        # leaves of the constrained species (see
+        # `LineageTree.set_node_constraints()`), with the first leaf of the
+        # species of each, and the first leaf of each species
+        species_first_leaf_indexes = {}
+        constrained_leaf_indexes = []
+        constrained_first_leaf_indexes = []
+        for leaf_idx, nd in enumerate(self.leaf_nodes):
+            sp = getattr(nd, "known_tipward_sp", None)
+            if sp is None:
+                continue
+            first_leaf_idx = species_first_leaf_indexes.setdefault(sp, leaf_idx)
+            constrained_leaf_indexes.append(leaf_idx)
+            constrained_first_leaf_indexes.append(first_leaf_idx)
+        return (numpy.array(constrained_leaf_indexes, dtype=numpy.intp),
+                numpy.array(constrained_first_leaf_indexes, dtype=numpy.intp),
+                numpy.array(sorted(species_first_leaf_indexes.values()), dtype=numpy.intp))
+
+    def _compile_edge_probs(self, speciation_completion_rate):
+        # probabilities of speciation events drawn on the edges subtending
+        # each node (1 for the root), with the log importance weights of
+        # drawing and not drawing one, and the log of the probability of no
+        # speciation events on the edges on which they are not allowed
+        species_below = {}
+        for nd in self.tree.postorder_node_iter():
+            if nd.is_leaf():
+                sp = getattr(nd, "known_tipward_sp", None)
+                species_below[nd] = set() if sp is None else set([sp])
+            else:
+                species_below[nd] = set().union(*(species_below[c] for c in nd.child_nodes()))
+        num_species = dict((nd, len(species)) for nd, species in species_below.items())
+        total_num_species = num_species[self.tree.seed_node]
+        prob_sp = numpy.ones(len(self.nodes))
+        log_weights_sp = numpy.zeros(len(self.nodes))
+        log_weights_no_sp = numpy.zeros(len(self.nodes))
+        log_prob_no_sp_forced = 0.0
+        for idx, nd in enumerate(self.nodes[1:], 1):
+            scaled_brlen = nd.edge.length * speciation_completion_rate
+            if not getattr(nd, "speciation_allowed", True):
+                prob_sp[idx] = 0.0
+                log_prob_no_sp_forced -= scaled_brlen
+                continue
+            prob_sp[idx] = -math.expm1(-scaled_brlen)
+            if 0 < num_species[nd] < total_num_species and 0.0 < prob_sp[idx] < self.min_separating_prob_sp:
+                # separates constrained species
+                log_weights_sp[idx] = math.log(prob_sp[idx]) - math.log(self.min_separating_prob_sp)
+                log_weights_no_sp[idx] = -scaled_brlen - math.log1p(-self.min_separating_prob_sp)
+                prob_sp[idx] = self.min_separating_prob_sp
+        return prob_sp, log_weights_sp, log_weights_no_sp, log_prob_no_sp_forced
+
+    def simulate(self,
+            num_draws,
+            random_seed=None,
+            is_count_conspecificity=False):
+        """
+        Simulates `num_draws` draws under the current speciation completion
+        rate of the tree, adding to the sums over any previous draws under
+        the same rate (unless `clear()` is called first). Each batch of draws
+        gets its own random number generator, spawned from `random_seed`, so
+        the results are the same irrespective of the number of processes.
+        """
+        speciation_completion_rate = self.tree.speciation_completion_rate
+        if speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        edge_probs = self._compile_edge_probs(speciation_completion_rate)
+        self.log_prob_no_sp_forced = edge_probs[-1]
+        constraints = self._compile_constraints()
+        batch_sizes = [self.batch_size] * (num_draws // self.batch_size)
+        if num_draws % self.batch_size:
+            batch_sizes.append(num_draws % self.batch_size)
+        seeds = numpy.random.SeedSequence(random_seed).spawn(len(batch_sizes))
+        tasks = [(self.parent_indexes,) + edge_probs[:-1] + (self.leaf_node_indexes,) + constraints
+                + (batch_size, seed, is_count_conspecificity)
+                for batch_size, seed in zip(batch_sizes, seeds)]
+        if self.num_processes > 1 and len(tasks) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_processes) as executor:
+                self._add_batch_results(executor.map(_simulate_partition_batch, tasks))
+        else:
+            self._add_batch_results(map(_simulate_partition_batch, tasks))
+        self.num_draws += num_draws
+
+    def _add_batch_results(self, batch_results):
+        for batch_result in batch_results:
+            (num_accepted,
+                    log_weight_scale,
+                    weight_sums,
+                    (partitions, partition_weight_sums),
+                    clade_weight_sums,
+                    conspecificity_weight_sums) = batch_result
+            if not num_accepted:
+                continue
+            self.num_accepted += num_accepted
+            # bring the sums of the batch and the running sums to the same scale
+            if self.log_weight_scale is None:
+                self.log_weight_scale = log_weight_scale
+            if log_weight_scale > self.log_weight_scale:
+                self._rescale(math.exp(self.log_weight_scale - log_weight_scale))
+                self.log_weight_scale = log_weight_scale
+            factor = math.exp(log_weight_scale - self.log_weight_scale)
+            def _scaled(sums):
+                return (sums[0] * factor, sums[1] * factor * factor)
+            self.weight_sums = self._add_sums(self.weight_sums, _scaled(weight_sums))
+            for partition, w1, w2 in zip(partitions, *_scaled(partition_weight_sums)):
+                key = partition.tobytes()
+                try:
+                    sums = self.partition_weight_sums[key][1]
+                except KeyError:
+                    self.partition_weight_sums[key] = [partition, (w1, w2)]
+                else:
+                    self.partition_weight_sums[key][1] = (sums[0] + w1, sums[1] + w2)
+            self.clade_weight_sums = self._add_sums(self.clade_weight_sums, _scaled(clade_weight_sums))
+            if conspecificity_weight_sums is not None:
+                self.conspecificity_weight_sums = self._add_sums(self.conspecificity_weight_sums, _scaled(conspecificity_weight_sums))
+
+    def _rescale(self, factor):
+        def _rescaled(sums):
+            return (sums[0] * factor, sums[1] * factor * factor)
+        self.weight_sums = _rescaled(self.weight_sums)
+        for entry in self.partition_weight_sums.values():
+            entry[1] = _rescaled(entry[1])
+        self.clade_weight_sums = _rescaled(self.clade_weight_sums)
+        if self.conspecificity_weight_sums is not None:
+            self.conspecificity_weight_sums = _rescaled(self.conspecificity_weight_sums)
+
+    def _add_sums(self, sums, other):
+        if sums is None:
+            return other
+        return (sums[0] + other[0], sums[1] + other[1])
+
+    def _estimate(self, sums):
+        # self-normalized importance sampling estimates of the proportions
+        # of the accepted draws, with their (delta method) standard errors
+        if not self.num_accepted:
+            raise ValueError("No draws consistent with the species constraints")
+        total_w1, total_w2 = self.weight_sums
+        w1, w2 = sums
+        probs = w1 / total_w1
+        variances = (w2 * (1.0 - 2.0 * probs) + probs * probs * total_w2) / (total_w1 * total_w1)
+        return probs, numpy.sqrt(numpy.maximum(variances, 0.0))
+
+    def estimate_probability_of_constraints(self):
+        """
+        Returns the estimated probability of the species constraints (the
+        probability of no speciation events on the edges on which they are
+        not allowed, times the mean importance weight of the draws that are
+        consistent with the constraints, over all draws), with its standard
+        error.
+        """
+        if not self.num_accepted:
+            return 0.0, 0.0
+        log_factor = self.log_prob_no_sp_forced + self.log_weight_scale
+        total_w1, total_w2 = self.weight_sums
+        mean = total_w1 / self.num_draws
+        variance = max(total_w2 / self.num_draws - mean * mean, 0.0) / self.num_draws
+        return math.exp(log_factor + math.log(mean)), math.exp(log_factor) * math.sqrt(variance)
+
+    def estimate_partition_probabilities(self):
+        """
+        Returns a list of tuples of the partitions drawn, as lookup keys (see
+        `model._Partition.compile_lookup_key()`), their estimated
+        probabilities and the standard errors of the estimates, in
+        decreasing order of probability.
+        """
+        partitions = list(self.partition_weight_sums.values())
+        probs, ses = self._estimate((
+                numpy.array([sums[0] for _, sums in partitions]),
+                numpy.array([sums[1] for _, sums in partitions])))
+        results = []
+        for (partition, _), prob, se in zip(partitions, probs, ses):
+            species_leafsets = {}
+            for label, sp in zip(self.leaf_labels, partition):
+                species_leafsets.setdefault(sp, set()).add(label)
+            key = frozenset(frozenset(leafset) for leafset in species_leafsets.values())
+            results.append((key, float(prob), float(se)))
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results
+
+    def estimate_clade_marginal_probabilities_of_species(self):
+        """
+        Returns a dictionary mapping each node to a tuple of the estimated
+        probability that its leaves are exactly the leaves of one species
+        (as given, without species constraints, by
+        `LineageTree.calc_clade_marginal_probabilities_of_species()`) and the
+        standard error of the estimate.
+        """
+        probs, ses = self._estimate(self.clade_weight_sums)
+        return dict((nd, (float(prob), float(se))) for nd, prob, se in zip(self.nodes, probs, ses))
+
+    def estimate_conspecificity_probability_matrix(self):
+        """
+        Returns a tuple of the n x n NumPy arrays of the estimated probability
+        of each pair of lineages being conspecific (as given by
+        `LineageTree.calc_conspecificity_probability_matrix()`, in the same
+        order), and of the standard errors of the estimates. Only available
+        if the draws were simulated with `is_count_conspecificity=True`.
+        """
+        if self.conspecificity_weight_sums is None:
+            raise ValueError("Conspecificity not counted in the draws")
+        return self._estimate(self.conspecificity_weight_sums)
+
+def _calc_tree_sample_probabilities(task):
+    """
+    Calculates the probabilities for one tree of a sample of trees, given
+    as a newick string, for `TreeSamplePartitionProbabilityEstimator`.
+    Returns the speciation completion rate (estimated on the tree, if not
+    given), a dictionary of the partitions of the lineages, as lookup keys
+    (see `model._Partition.compile_lookup_key()`), to their probabilities
+    conditional on the species constraints (if any), and the conspecificity
+    probability matrix, with the lineages in the order given (None if not
+    requested).
+    """
+    (tree_str,
+            lineage_labels,
+            species_leafset_labels,
+            speciation_completion_rate,
+            speciation_rate_window,
+            underflow_protection,
+            is_calc_conspecificity) = task
+    tree = model.LineageTree.get(
+            data=tree_str,
+            schema="newick",
+            preserve_underscores=True)
+    tree.underflow_protection = underflow_protection
+    if speciation_completion_rate is None:
+        # as for a single tree, the rate is estimated on the tree of the
+        # constrained lineages
+        induced_tree = tree.extract_tree_with_taxa_labels(
+                labels=[label for leafset in species_leafset_labels for label in leafset])
+        induced_tree.underflow_protection = underflow_protection
+        initial_speciation_rate, min_speciation_rate, max_speciation_rate = speciation_rate_window
+        mle = SpeciationCompletionRateMaximumLikelihoodEstimator(
+                tree=induced_tree,
+                species_leafset_labels=species_leafset_labels,
+                initial_speciation_rate=initial_speciation_rate,
+                min_speciation_rate=min_speciation_rate,
+                max_speciation_rate=max_speciation_rate)
+        speciation_completion_rate, _ = mle.estimate_speciation_rate()
+    if species_leafset_labels is not None:
+        tree.set_node_constraints(species_leafset_labels=species_leafset_labels)
+    tree.speciation_completion_rate = speciation_completion_rate
+    partition_probability_map = tree.calc_label_partition_probability_map()
+    cond_prob = sum(partition_probability_map.values())
+    partition_probs = dict((k, tree.as_float(prob / cond_prob)) for k, prob in partition_probability_map.items())
+    conspecificity = None
+    if is_calc_conspecificity:
+        leaf_labels = [nd.taxon.label for nd in tree.leaf_node_iter()]
+        if sorted(leaf_labels) != sorted(lineage_labels):
+            raise ValueError("Lineages of tree do not match those of the first tree of the sample")
+        leaf_indexes = dict((label, idx) for idx, label in enumerate(leaf_labels))
+        order = numpy.array([leaf_indexes[label] for label in lineage_labels], dtype=numpy.intp)
+        conspecificity = tree.calc_conspecificity_probability_matrix()[numpy.ix_(order, order)]
+    return speciation_completion_rate, partition_probs, conspecificity
+
+class TreeSamplePartitionProbabilityEstimator(object):
+    """
+    Integrates the probabilities of the partitions of the lineages into
+    species, and optionally of each pair of lineages being conspecific,
+    conditional on the species constraints (if any), over a sample of trees
+    (e.g., from the posterior distribution of the population tree), as the
+    means of the probabilities over the trees, with their variances across
+    the trees.
+
+    With no speciation completion rate given, it is estimated on each tree
+    as for a single tree, from the species constraints.
+
+    Trees are calculated independently, optionally spread over a pool of
+    `num_processes` processes, and added to running sums as they are done,
+    with no more than `max_pending_trees` trees in flight at any one time,
+    so the memory required is bounded by the number of distinct partitions,
+    not the number of trees.
+    """
+
+    def __init__(self,
+            lineage_labels,
+            species_leafset_labels=None,
+            speciation_completion_rate=None,
+            speciation_completion_rate_estimation_initial=None,
+            speciation_completion_rate_estimation_min=None,
+            speciation_completion_rate_estimation_max=None,
+            underflow_protection=False,
+            is_calc_conspecificity=False,
+            num_processes=1,
+            max_pending_trees=None):
+        if speciation_completion_rate is None and species_leafset_labels is None:
+            raise ValueError("Speciation completion rate must be given if there are no species constraints")
+        self.lineage_labels = list(lineage_labels)
+        self.species_leafset_labels = species_leafset_labels
+        self.speciation_completion_rate = speciation_completion_rate
+        self.speciation_rate_window = (
+                speciation_completion_rate_estimation_initial,
+                speciation_completion_rate_estimation_min,
+                speciation_completion_rate_estimation_max)
+        self.underflow_protection = underflow_protection
+        self.is_calc_conspecificity = is_calc_conspecificity
+        self.num_processes = num_processes
+        if max_pending_trees is None:
+            max_pending_trees = 2 * num_processes
+        self.max_pending_trees = max_pending_trees
+        self.clear()
+
+    def clear(self):
+        self.num_trees = 0
+        # sums over the trees of the probabilities (and of their squares)
+        self.speciation_completion_rate_sums = (0.0, 0.0)
+        self.partition_prob_sums = {}
+        self.conspecificity_prob_sums = None
+
+    def _compose_task(self, tree):
+        return (tree.as_string(schema="newick"),
+                self.lineage_labels,
+                self.species_leafset_labels,
+                self.speciation_completion_rate,
+                self.speciation_rate_window,
+                self.underflow_protection,
+                self.is_calc_conspecificity)
+
+    def add_trees(self, trees):
+        """
+        Adds the probabilities calculated on each of `trees`, which may be
+        given by a generator reading trees from a file, and is only read as
+        far as the trees in flight require.
+        """
+        tasks = (self._compose_task(tree) for tree in trees)
+        if self.num_processes > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.num_processes) as executor:
+                pending = collections.deque()
+                for task in tasks:
+                    if len(pending) >= self.max_pending_trees:
+                        self._add_tree_result(pending.popleft().result())
+                    pending.append(executor.submit(_calc_tree_sample_probabilities, task))
+                while pending:
+                    self._add_tree_result(pending.popleft().result())
+        else:
+            for task in tasks:
+                self._add_tree_result(_calc_tree_sample_probabilities(task))
+
+    def _add_tree_result(self, tree_result):
+        speciation_completion_rate, partition_probs, conspecificity = tree_result
+        self.num_trees += 1
+        self.speciation_completion_rate_sums = self._add_sums(self.speciation_completion_rate_sums, speciation_completion_rate)
+        for k, prob in partition_probs.items():
+            self.partition_prob_sums[k] = self._add_sums(self.partition_prob_sums.get(k, (0.0, 0.0)), prob)
+        if conspecificity is not None:
+            if self.conspecificity_prob_sums is None:
+                self.conspecificity_prob_sums = (numpy.zeros_like(conspecificity), numpy.zeros_like(conspecificity))
+            self.conspecificity_prob_sums = self._add_sums(self.conspecificity_prob_sums, conspecificity)
+
+    def _add_sums(self, sums, value):
+        return (sums[0] + value, sums[1] + value * value)
+
+    def _estimate(self, sums):
+        # mean over the trees, and variance across them (with the number of
+        # trees as the denominator)
+        if not self.num_trees:
+            raise ValueError("No trees added")
+        mean = sums[0] / self.num_trees
+        variance = sums[1] / self.num_trees - mean * mean
+        if isinstance(variance, float):
+            return mean, max(variance, 0.0)
+        return mean, numpy.maximum(variance, 0.0)
+
+    def estimate_speciation_completion_rate(self):
+        """
+        Returns the mean of the speciation completion rates used over the
+        trees, and their variance across the trees.
+        """
+        return self._estimate(self.speciation_completion_rate_sums)
+
+    def estimate_partition_probabilities(self):
+        """
+        Returns a list of tuples of the partitions with a nonzero probability
+        on any of the trees, as lookup keys (see
+        `model._Partition.compile_lookup_key()`), their mean probabilities
+        over the trees and the variances of their probabilities across the
+        trees, in decreasing order of mean probability.
+        """
+        results = [(k,) + self._estimate(sums) for k, sums in self.partition_prob_sums.items()]
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results
+
+    def estimate_conspecificity_probability_matrix(self):
+        """
+        Returns a tuple of the n x n NumPy arrays of the mean probability over
+        the trees of each pair of lineages being conspecific, in the order of
+        `lineage_labels`, and of the variances across the trees. Only
+        available with `is_calc_conspecificity=True`.
+        """
+        if self.conspecificity_prob_sums is None:
+            raise ValueError("Conspecificity not calculated on the trees")
+        return self._estimate(self.conspecificity_prob_sums)
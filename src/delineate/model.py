@@ -2,24 +2,41 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-from collections import defaultdict
-import copy
+from collections import OrderedDict
 import random
+import sys
 import math
 import decimal
+try:
+    import numpy as np
+except ImportError:
+    np = None
 import dendropy
 from delineate import utility
 
+_NEG_INF = float("-inf")
+_MIN_NORMAL_FLOAT_LOG = math.log(sys.float_info.min)
+# log of the ratio of the probability of the best partition to the first
+# threshold of `LineageTree.iter_label_partition_probabilities()`
+_PARTITION_ENUMERATION_LOG_RATIO = math.log(10.0)
+# slack for rounding in the bounds on partition probabilities
+_PARTITION_BOUND_LOG_TOLERANCE = 1e-8
+# cap on the estimated numbers of states of partition maps, so that sums of
+# them stay finite
+_MAX_PART_MAP_STATE_COUNT_ESTIMATE = 1e300
+# status of the open subset of the partitions counted by
+# `LineageTree.calc_partition_map_state_counts()`: joined since it last
+# passed through an edge on which speciation is allowed, or not
+_PART_STATE_FRESH = 1
+_PART_STATE_STALE = 2
+# default bounds on the number of values held by the probability cache of a
+# tree, and on the total number of probabilities they hold
+_PROBABILITY_CACHE_MAX_SIZE = 256
+_PROBABILITY_CACHE_MAX_COST = 1 << 20
+
 ################################################################################
 ## Functions in support of calculating the joint probability
 
-def _gen_from_sub_list(sub_list, open_el):
-    # print('sub_list={}'.format(sub_list))
-    sub_list.sort()
-    sub_list = tuple(sub_list)
-    new_ot_ind = -1 if open_el is None else sub_list.index(open_el)
-    return _Partition(data=(new_ot_ind, sub_list))
-
 def _del_part_maps(nd):
     try:
         delattr(nd, 'tipward_part_map')
@@ -30,48 +47,527 @@ def _del_part_maps(nd):
     except AttributeError:
         pass
 
-def _merge_into_first(src_and_dest_dict, second):
-    first = copy.copy(src_and_dest_dict)
+class _PartMapPool(object):
+    """
+    Partition maps that are no longer needed, kept cleared for reuse as the
+    maps that the partitions of other nodes are written into, so that
+    working through a tree allocates no more maps than are held at once.
+    """
+
+    def __init__(self):
+        self._free_maps = []
+        self.num_maps_allocated = 0
+
+    def acquire(self):
+        try:
+            return self._free_maps.pop()
+        except IndexError:
+            self.num_maps_allocated += 1
+            return {}
+
+    def release(self, part_map):
+        part_map.clear()
+        self._free_maps.append(part_map)
+
+def _merge_part_maps(first, second, dest, merge_constraints=None, constraint_index=None):
+    # writes the merge of the two maps into `dest` (see
+    # `_iter_merged_items()`); as the subsets of each side of the merge are
+    # on disjoint lineages, each pair of partitions merged gives a
+    # different partition, so there is nothing to accumulate
+    for part, fprob, sprob in _iter_merged_items(first.items(), second.items(), merge_constraints, constraint_index):
+        dest[part] = fprob * sprob
+    return dest
+
+def _close_part_map(map_with_open, dest, remain_open_prob, close_prob=None):
+    # writes the map through an edge into `dest`, with the open subsets
+    # closed on the edge with a probability of `close_prob`; if None, as
+    # when speciation is not allowed on the edge, only the partitions with
+    # an open subset are kept. Only the partitions closed on the edge can
+    # coincide with others of the map
+    for part, prob in map_with_open.items():
+        if close_prob is None:
+            if part[0]:
+                dest[part] = prob * remain_open_prob
+            continue
+        if part[0]:
+            dest[part] = prob * remain_open_prob
+            part = _bitmask_partition_closed(part)
+            prob = prob * close_prob
+        prev = dest.get(part, None)
+        dest[part] = prob if prev is None else prev + prob
+    return dest
+
+def _merge_close_part_maps(first, second, dest, remain_open_prob, close_prob,
+        merge_constraints=None, constraint_index=None):
+    # as `_merge_part_maps()` followed by `_close_part_map()`, without
+    # holding the merged map; with `remain_open_prob` of None, as at the
+    # root, the open subsets are all closed
+    for part, fprob, sprob in _iter_merged_items(first.items(), second.items(), merge_constraints, constraint_index):
+        prob = fprob * sprob
+        if close_prob is None:
+            if part[0]:
+                dest[part] = prob * remain_open_prob
+            continue
+        if part[0]:
+            if remain_open_prob is not None:
+                dest[part] = prob * remain_open_prob
+            part = _bitmask_partition_closed(part)
+            prob = prob * close_prob
+        prev = dest.get(part, None)
+        dest[part] = prob if prev is None else prev + prob
+    return dest
+
+def _prune_part_map(part_map, rel_epsilon, is_log):
+    # drops the partitions of a map with a probability less than
+    # `rel_epsilon` times the greatest in the map; returns the total
+    # probability dropped
+    if not part_map:
+        return 0.0
+    max_prob = max(part_map.values())
+    if is_log:
+        min_prob = max_prob + math.log(rel_epsilon)
+    else:
+        min_prob = max_prob * rel_epsilon
+    to_del = [part for part, prob in part_map.items() if prob < min_prob]
+    pruned_prob = 0.0
+    for part in to_del:
+        prob = part_map.pop(part)
+        pruned_prob += math.exp(prob) if is_log else float(prob)
+    return pruned_prob
+
+def _part_map_lineage_mask(part_map):
+    # the lineages partitioned by the partitions of a map
+    mask = 0
+    for part in part_map:
+        for subset in part:
+            mask |= subset
+        break
+    return mask
+
+def _compile_merge_constraints(constraint_index, first_map, second_map):
+    # The only subsets joined by a merge are the open subsets, so a pair of
+    # lineages, one on each side of the merge, is conspecific after it if
+    # and only if both are in the open subsets of their sides. The
+    # constraints on such pairs are therefore given by the lineages of each
+    # side that must be in its open subset, and the pairs of lineages that
+    # must not both be. Returns None if any constraint is on a pair of
+    # lineages that is not split by the merge (see
+    # `_compile_constraint_index()`).
+    first_mask = _part_map_lineage_mask(first_map)
+    second_mask = _part_map_lineage_mask(second_map)
+    first_required = 0
+    second_required = 0
+    not_consp_pairs = []
+    for pairs, is_consp in ((constraint_index[1], True), (constraint_index[2], False)):
+        for a, b in pairs:
+            pair_mask = a | b
+            first_lineage = pair_mask & first_mask
+            second_lineage = pair_mask & second_mask
+            if not first_lineage or not second_lineage:
+                return None
+            if is_consp:
+                first_required |= first_lineage
+                second_required |= second_lineage
+            else:
+                not_consp_pairs.append((first_lineage, second_lineage))
+    first_open_mask = first_required
+    second_open_mask = second_required
+    for first_lineage, second_lineage in not_consp_pairs:
+        first_open_mask |= first_lineage
+        second_open_mask |= second_lineage
+    return first_required, second_required, not_consp_pairs, first_open_mask, second_open_mask
+
+def _is_merge_compatible(merge_constraints, first_open, second_open):
+    first_required, second_required, not_consp_pairs = merge_constraints[:3]
+    if first_open & first_required != first_required or second_open & second_required != second_required:
+        return False
+    for first_lineage, second_lineage in not_consp_pairs:
+        if first_open & first_lineage and second_open & second_lineage:
+            return False
+    return True
+
+def _bucket_part_map_items(items, open_mask):
+    # groups the items of a partition map by which of the lineages of
+    # `open_mask` are in the open subsets of their partitions
+    buckets = {}
+    for part, prob in items:
+        try:
+            buckets[part[0] & open_mask].append((part, prob))
+        except KeyError:
+            buckets[part[0] & open_mask] = [(part, prob)]
+    return buckets
+
+def _iter_merged_items(first_items, second_items, merge_constraints=None, constraint_index=None):
+    # yields each partition given by merging a partition of each of two
+    # maps (given by collections of their items) that does not violate the
+    # constraints of the node, with the probabilities of the two. These are
+    # either compiled for the merge (see `_compile_merge_constraints()`),
+    # in which case the items are grouped so that the pairs of partitions
+    # that would violate them are never combined, or, if they could not
+    # be, given by `constraint_index`, against which each partition merged
+    # is checked. All the merges of partition maps go through here, so
+    # that they are all under the same constraints
+    if merge_constraints is not None:
+        first_open_mask, second_open_mask = merge_constraints[3:]
+        second_buckets = _bucket_part_map_items(second_items, second_open_mask)
+        for first_open, first_bucket in _bucket_part_map_items(first_items, first_open_mask).items():
+            for second_open, second_bucket in second_buckets.items():
+                if _is_merge_compatible(merge_constraints, first_open, second_open):
+                    for fpart, fprob in first_bucket:
+                        for spart, sprob in second_bucket:
+                            yield _bitmask_partition_extension(fpart, spart), fprob, sprob
+        return
+    for fpart, fprob in first_items:
+        for spart, sprob in second_items:
+            part = _bitmask_partition_extension(fpart, spart)
+            if constraint_index is not None and _bitmask_partition_violates_constraints(part, constraint_index):
+                continue
+            yield part, fprob, sprob
+
+def _estimate_part_map_state_counts(max_num_lineages):
+    # numbers of partitions (with at most one open subset) of 0 to
+    # `max_num_lineages` lineages, i.e. the Bell numbers B(n+1), as floats
+    # capped at `_MAX_PART_MAP_STATE_COUNT_ESTIMATE`, from the Bell triangle
+    counts = [1.0]
+    row = [1.0]
+    while len(counts) <= max_num_lineages:
+        if row[-1] >= _MAX_PART_MAP_STATE_COUNT_ESTIMATE:
+            counts.append(_MAX_PART_MAP_STATE_COUNT_ESTIMATE)
+            continue
+        next_row = [row[-1]]
+        for v in row:
+            next_row.append(min(next_row[-1] + v, _MAX_PART_MAP_STATE_COUNT_ESTIMATE))
+        row = next_row
+        counts.append(row[-1])
+    return counts
+
+def _log_add(a, b):
+    if a < b:
+        a, b = b, a
+    if b == _NEG_INF:
+        return a
+    return a + math.log1p(math.exp(b - a))
+
+def _log_merge_part_maps(first, second, dest, merge_constraints=None, constraint_index=None):
+    # as `_merge_part_maps()`, on log probabilities
+    for part, fprob, sprob in _iter_merged_items(first.items(), second.items(), merge_constraints, constraint_index):
+        dest[part] = fprob + sprob
+    return dest
+
+def _log_merge_close_part_maps(first, second, dest, remain_open_prob, close_prob,
+        merge_constraints=None, constraint_index=None):
+    # as `_merge_close_part_maps()`, on log probabilities
+    for part, fprob, sprob in _iter_merged_items(first.items(), second.items(), merge_constraints, constraint_index):
+        prob = fprob + sprob
+        if close_prob is None:
+            if part[0]:
+                dest[part] = prob + remain_open_prob
+            continue
+        if part[0]:
+            if remain_open_prob is not None:
+                dest[part] = prob + remain_open_prob
+            part = _bitmask_partition_closed(part)
+            prob = prob + close_prob
+        prev = dest.get(part, None)
+        dest[part] = prob if prev is None else _log_add(prev, prob)
+    return dest
+
+def _log_group_part_map(part_map):
+    # groups the partitions of a map by their closed form, with the total
+    # probability of each group, most probable first
+    groups = {}
+    for part, prob in part_map.items():
+        closed_part = _bitmask_partition_closed(part) if part[0] else part
+        try:
+            group = groups[closed_part]
+        except KeyError:
+            groups[closed_part] = [prob, [(part, prob)]]
+        else:
+            group[0] = _log_add(group[0], prob)
+            group[1].append((part, prob))
+    return sorted(groups.values(), key=lambda group: group[0], reverse=True)
+
+def _log_bounded_merge_into_first(src_and_dest_dict, second, log_min_prob, merge_constraints=None, constraint_index=None):
+    # as `_log_merge_part_maps()`, into the first map, but only combining the groups of
+    # partitions (see `_log_group_part_map()`) with a product of total
+    # probabilities of at least `log_min_prob`; returns whether any
+    # combinations with nonzero probability were skipped (which, as the
+    # bounds are on the groups, may include ones violating the constraints)
+    first_groups = _log_group_part_map(src_and_dest_dict)
+    second_groups = _log_group_part_map(second)
     src_and_dest_dict.clear()
     dest = src_and_dest_dict
-    for fpart, fprob in first.items():
-        # print('fpart = {}'.format(fpart))
-        for spart, sprob in second.items():
-            # print('spart = {}'.format(spart))
-            dest[fpart.create_extension(spart)] += fprob * sprob
+    is_skipped = False
+    for first_prob, first_parts in first_groups:
+        for second_idx, (second_prob, second_parts) in enumerate(second_groups):
+            if first_prob + second_prob < log_min_prob:
+                is_skipped = is_skipped or first_prob + second_prob > _NEG_INF
+                break
+            for k, fprob, sprob in _iter_merged_items(first_parts, second_parts, merge_constraints, constraint_index):
+                prob = fprob + sprob
+                prev = dest.get(k, None)
+                dest[k] = prob if prev is None else _log_add(prev, prob)
+        if second_idx == 0 and first_prob + second_prob < log_min_prob:
+            # and so for all the less probable groups of the first map
+            break
+    return is_skipped
+
+def _log_close_part_map(map_with_open, dest, remain_open_prob, close_prob=None):
+    # as `_close_part_map()`, on log probabilities
+    for part, prob in map_with_open.items():
+        if close_prob is None:
+            if part[0]:
+                dest[part] = prob + remain_open_prob
+            continue
+        if part[0]:
+            dest[part] = prob + remain_open_prob
+            part = _bitmask_partition_closed(part)
+            prob = prob + close_prob
+        prev = dest.get(part, None)
+        dest[part] = prob if prev is None else _log_add(prev, prob)
     return dest
 
-def _create_closed_map(
-        map_with_open,
-        remain_open_prob,
-        as_working_value_type,
-        allow_closing=True):
-    ret = defaultdict(lambda:as_working_value_type(0.0))
-    if allow_closing:
-        close_prob = as_working_value_type(1.0) - remain_open_prob
-        for part, prob in map_with_open.items():
-            if part.is_open:
-                ret[part] += prob * remain_open_prob
-                ret[part.create_closed()] += prob * close_prob
+def _log_prob_sp(scaled_brlen):
+    if scaled_brlen <= 0.0:
+        return _NEG_INF
+    return math.log(-math.expm1(-scaled_brlen))
+
+################################################################################
+## Bitmask-encoded partitions
+##
+## Lineages are indexed by integers, and each subset of a partition is the
+## integer bitmask of the lineages in it. A partition (of the lineages of a
+## subtree) is a tuple of ints: the first element is the mask of the open
+## subset (the lineages still connected to the subtree root; 0 if there is no
+## such subset), followed by the masks of the closed subsets in ascending
+## order, so that equal partitions are equal tuples.
+
+def _bitmask_partition_extension(first, second):
+    return (first[0] | second[0],) + tuple(sorted(first[1:] + second[1:]))
+
+def _bitmask_partition_closed(part):
+    return (0,) + tuple(sorted(part))
+
+def _compile_constraint_index(constraints):
+    # the mask of all the lineages under the constraints, with the pairs of
+    # bits of the lineages of each constraint (see
+    # `LineageTree.set_node_constraints()`)
+    constrained_mask = 0
+    indexed = []
+    for key in ('conspecific', 'not_conspecific'):
+        pairs = []
+        for a, b in constraints.get(key, []):
+            pairs.append((1 << a, 1 << b))
+            constrained_mask |= (1 << a) | (1 << b)
+        indexed.append(pairs)
+    return constrained_mask, indexed[0], indexed[1]
+
+def _bitmask_partition_violates_constraints(part, constraint_index):
+    # the subset holding each lineage under the constraints is found in a
+    # single pass over the subsets, so each constraint is then checked
+    # directly; as the subsets are disjoint, two lineages are in the same
+    # subset if and only if the subsets holding them are equal
+    constrained_mask, consp_pairs, not_consp_pairs = constraint_index
+    holders = {}
+    for subset in part:
+        held = subset & constrained_mask
+        while held:
+            low_bit = held & -held
+            holders[low_bit] = subset
+            held ^= low_bit
+    for a, b in consp_pairs:
+        if holders[a] != holders[b]:
+            return True
+    for a, b in not_consp_pairs:
+        if holders[a] == holders[b]:
+            return True
+    return False
+
+def _bitmask_lowest_index(mask):
+    return (mask & -mask).bit_length() - 1
+
+def _bitmask_labels(mask, leaf_labels):
+    labels = []
+    while mask:
+        low_bit = mask & -mask
+        labels.append(leaf_labels[low_bit.bit_length() - 1])
+        mask ^= low_bit
+    return labels
+
+def _bitmask_partition_lookup_key(part, leaf_labels, subset_label_sets=None):
+    if subset_label_sets is None:
+        return frozenset(frozenset(_bitmask_labels(subset, leaf_labels)) for subset in part if subset)
+    # the same subsets recur across many partitions, so build each label set only once
+    key = []
+    for subset in part:
+        if not subset:
+            continue
+        try:
+            key.append(subset_label_sets[subset])
+        except KeyError:
+            label_set = frozenset(_bitmask_labels(subset, leaf_labels))
+            subset_label_sets[subset] = label_set
+            key.append(label_set)
+    return frozenset(key)
+
+################################################################################
+## Functions in support of calculating conspecificity probabilities
+##
+## The state of the lineage at a node is the (constrained) species that it is
+## connected to, i.e. without any intervening speciation event, or None if it
+## is not connected to any constrained species. State probabilities are
+## dictionaries keyed by state.
+
+def _merge_species_states(first, second):
+    # lineages connected to two different species cannot be joined; returns
+    # False in that case
+    if first is None:
+        return second
+    if second is None or second == first:
+        return first
+    return False
+
+def _merge_part_map_state_counts(first, second):
+    # the numbers of states of the map formed by merging maps with numbers of
+    # states `first` and `second` (see
+    # `LineageTree.calc_partition_map_state_counts()`); as the lineages of
+    # the two maps are distinct, each pair of states gives a distinct state
+    merged = {}
+    for (first_status, first_sp), first_count in first.items():
+        for (second_status, second_sp), second_count in second.items():
+            if first_status is None:
+                k = (second_status, second_sp)
+            elif second_status is None:
+                k = (first_status, first_sp)
             else:
-                ret[part] += prob
-    else:
-        for part, prob in map_with_open.items():
-            if part.is_open:
-                ret[part] += prob * remain_open_prob
+                sp = _merge_species_states(first_sp, second_sp)
+                if sp is False:
+                    continue
+                k = (_PART_STATE_FRESH, sp)
+            merged[k] = merged.get(k, 0) + first_count * second_count
+    return merged
+
+def _close_part_map_state_counts(counts, is_speciation_allowed):
+    # the numbers of states through an edge of a map with numbers of states
+    # `counts`: an open subset that has not passed through an edge on which
+    # it could have been closed since it was last joined with another can
+    # be closed, giving partitions not given by closing it anywhere else
+    if not is_speciation_allowed:
+        return dict(counts)
+    closed = {}
+    for (status, sp), count in counts.items():
+        if status is None:
+            k = (None, None)
+        else:
+            k = (_PART_STATE_STALE, sp)
+            if status == _PART_STATE_FRESH:
+                closed[(None, None)] = closed.get((None, None), 0) + count
+        closed[k] = closed.get(k, 0) + count
+    return closed
+
+def _combine_species_state_probs(first, second):
+    # probabilities of the states of the lineage formed by joining two
+    # lineages with state probabilities `first` and `second`
+    first_none = first.get(None, 0.0)
+    second_none = second.get(None, 0.0)
+    ret = {None: first_none * second_none}
+    for sp, prob in first.items():
+        if sp is not None:
+            ret[sp] = prob * (second_none + second.get(sp, 0.0))
+    for sp, prob in second.items():
+        if sp is not None:
+            ret[sp] = ret.get(sp, 0.0) + first_none * prob
     return ret
 
-def _enforce_constraints(partition_table, constraints):
-    consp_constraints = constraints.get('conspecific', [])
-    not_consp_constraints = constraints.get('not_conspecific', [])
-    to_del = []
-    for k in partition_table.keys():
-        if k.violates_constraints(consp_constraints, not_consp_constraints):
-            to_del.append(k)
-    for k in to_del:
-        del partition_table[k]
-    return len(to_del)
+def _mask_invalid_species_states(partial_species, probs):
+    # a node must be connected to the species that have leaves both below
+    # and outside of it, of which there can only be one
+    if partial_species:
+        for sp in probs:
+            if len(partial_species) > 1 or sp != partial_species[0]:
+                probs[sp] = 0.0
+
+def _normalize_species_state_probs(probs):
+    # scales the probabilities to a maximum of 1 to prevent underflow,
+    # returning the log of the scaling factor
+    max_prob = max(probs.values())
+    if max_prob <= 0.0:
+        return 0.0
+    for sp in probs:
+        probs[sp] /= max_prob
+    return math.log(max_prob)
 
+################################################################################
+## Functions in support of finding the maximum probability partition
+##
+## The probability of a partition of the lineages of a subtree in which all
+## species are complete (i.e., will not be joined by any lineages outside of
+## the subtree) is carried as a pair of log probabilities: of the node being
+## connected to one of the species, and of it being connected to none. The
+## probability of the partition of the whole tree is a linear function of
+## these, with a coefficient for the first that is no greater than that for
+## the second, so only the pairs on the upper convex hull for such functions
+## can ever be part of the best partition.
+
+def _prune_partition_value_points(points):
+    points = [p for p in points if p[0] > _NEG_INF or p[1] > _NEG_INF]
+    if len(points) <= 1:
+        return points
+    max_log_prob = max(max(p[0], p[1]) for p in points)
+    scaled_points = sorted((math.exp(p[0] - max_log_prob), math.exp(p[1] - max_log_prob), p) for p in points)
+    hull = []
+    for point in scaled_points:
+        if hull and hull[-1][0] == point[0]:
+            hull.pop()
+        while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (point[1] - hull[-2][1])
+                - (hull[-1][1] - hull[-2][1]) * (point[0] - hull[-2][0])) >= 0:
+            hull.pop()
+        hull.append(point)
+    # best points for the probability of the node being connected
+    # weighted by 0 and by 1, respectively, relative to being unconnected
+    first_idx = max(range(len(hull)), key=lambda idx: (hull[idx][1], idx))
+    last_idx = max(range(len(hull)), key=lambda idx: (hull[idx][0] + hull[idx][1], idx))
+    return [point[2] for point in hull[first_idx:last_idx+1]]
+
+## The best partitions of the lineages below the children of a node seen so
+## far are carried as a tuple of: the points of the partitions with only
+## complete species, the best partitions with a species crossing the node, by
+## the species constraint it is under (see `_merge_species_states()`), and the
+## best partition with no species connected to the node (None if there is
+## none). Each is given with the choices made for the children.
+_EMPTY_MAX_PARTITION_VALUES = ([(_NEG_INF, 0.0, ())], {}, (0.0, ()))
+
+def _fold_max_partition_values(values, c_points, c_crossing):
+    # `c_points` and `c_crossing` are the points and crossing values of the
+    # next child, through the edge subtending it
+    union_points, crossing, no_crossing = values
+    c_best_empty = max(((e, ch) for _, e, ch in c_points), default=None)
+    next_crossing = {}
+    def _update(sp, v, choices):
+        if sp is not False and (sp not in next_crossing or v > next_crossing[sp][0]):
+            next_crossing[sp] = (v, choices)
+    for sp, (v, choices) in crossing.items():
+        if c_best_empty is not None:
+            _update(sp, v + c_best_empty[0], choices + (c_best_empty[1],))
+        if sp is None:
+            c_candidates = c_crossing
+        else:
+            c_candidates = [c_sp for c_sp in (None, sp) if c_sp in c_crossing]
+        for c_sp in c_candidates:
+            c_v, c_choice = c_crossing[c_sp]
+            _update(_merge_species_states(sp, c_sp), v + c_v, choices + (c_choice,))
+    if no_crossing is not None:
+        for c_sp, (c_v, c_choice) in c_crossing.items():
+            _update(c_sp, no_crossing[0] + c_v, no_crossing[1] + (c_choice,))
+    if no_crossing is not None and c_best_empty is not None:
+        no_crossing = (no_crossing[0] + c_best_empty[0], no_crossing[1] + (c_best_empty[1],))
+    else:
+        no_crossing = None
+    union_points = _prune_partition_value_points([
+            (_log_add(o + c_e, e + c_o), e + c_e, choices + (c_choice,))
+            for o, e, choices in union_points
+            for c_o, c_e, c_choice in c_points])
+    return union_points, next_crossing, no_crossing
 
 # noinspection PyProtectedMember
 class _Partition(object):
@@ -103,70 +599,11 @@ class _Partition(object):
     def _label_subsets(self):
         return self._data[1]
 
-    def violates_constraints(self, consp_constraints, not_consp_constraints):
-        s_t = self._label_subsets
-        for cc in consp_constraints:
-            first, second = cc
-            ff, sf = False, False
-            for sub in s_t:
-                if first in sub:
-                    ff = True
-                    if second in sub:
-                        break
-                    elif sf:
-                        return True
-                    if sf:
-                        break
-                if second in sub:
-                    sf = True
-                    if ff:
-                        return True
-        for cc in not_consp_constraints:
-            first, second = cc
-            for sub in s_t:
-                if first in sub:
-                    if second in sub:
-                        return True
-                    break
-                elif second in sub:
-                    break
-        return False
-
     def create_closed(self):
         asl = list(self._data)
         asl[0] = -1
         return _Partition(data=tuple(asl))
 
-    def create_extension(self, other):
-        new_sub = []
-        new_ot = None
-        s_subs = self._label_subsets
-        o_subs = other._label_subsets
-        if self.is_open:
-            s_opind = self.index_of_open_el
-            s_op_el = s_subs[s_opind]
-            if other.is_open:
-                for el in s_subs:
-                    if el is not s_op_el:
-                        new_sub.append(el)
-                o_opind = other.index_of_open_el
-                o_op_el = o_subs[o_opind]
-                for el in o_subs:
-                    if el is not o_op_el:
-                        new_sub.append(el)
-                ls_op_el = list(s_op_el)
-                ls_op_el.extend(o_op_el)
-                ls_op_el.sort()
-                new_ot = tuple(ls_op_el)
-                new_sub.append(new_ot)
-                return _gen_from_sub_list(new_sub, new_ot)
-            new_ot = s_op_el
-        elif other.is_open:
-            return other.create_extension(self)
-        new_sub.extend(s_subs)
-        new_sub.extend(o_subs)
-        return _gen_from_sub_list(new_sub, new_ot)
-
     @property
     def is_open(self):
         return self.index_of_open_el >= 0
@@ -192,38 +629,251 @@ class _Partition(object):
         return _Partition.compile_lookup_key(self._data[1])
 
 ################################################################################
-## _Cache class
+## _PartitionProbabilityMap and _Cache classes
+
+class _PartitionProbabilityMap(dict):
+    """
+    The probabilities of partitions, by lookup key, with a probability of
+    `zero` for any partition not in it, which, unlike a `defaultdict`, is
+    not added by looking it up (so a cached map is not changed by lookups).
+    """
+
+    def __init__(self, zero):
+        dict.__init__(self)
+        self.zero = zero
+
+    def __missing__(self, key):
+        return self.zero
 
 class _Cache(object):
+    """
+    A bounded cache of the results of calculations on a tree, by key, which
+    evicts the least recently used values first when it holds more than
+    `max_size` values, or when the total cost of the values (the number of
+    probabilities they hold) is more than `max_cost`. A value that costs more
+    than `max_cost` on its own is not cached at all.
+    """
 
-    def __init__(self):
-        self._calc_fns = {}
-        self._values = {}
+    def __init__(self, max_size=_PROBABILITY_CACHE_MAX_SIZE, max_cost=_PROBABILITY_CACHE_MAX_COST):
+        self.max_size = max_size
+        self.max_cost = max_cost
+        self._values = OrderedDict()
+        self.total_cost = 0
+        self.num_hits = 0
+        self.num_misses = 0
 
-    def clear(self, key=None):
-        if key is None:
-            self._values = {}
-        else:
-            self._values.pop(key, None)
+    def __len__(self):
+        return len(self._values)
 
-    def recalc(self, key=None):
-        if key is None:
-            self._values = {}
-            for k in self._calc_fns:
-                self._values[k] = self._calc_fns[k]()
-        else:
-            self._values[key] = self._calc_fns[key]
+    def __contains__(self, key):
+        return key in self._values
 
-    def add(self, key, calc_fn):
-        self._calc_fns[key] = calc_fn
-        self._values.pop(key, None)
+    def clear(self):
+        self._values.clear()
+        self.total_cost = 0
 
-    def __getitem__(self, key):
+    def get(self, key, calc_fn, cost_fn=None):
+        """
+        Returns the value cached under `key`, or else calculates it with
+        `calc_fn()` and caches it, at a cost given by `cost_fn(value)` (1 by
+        default).
+        """
         try:
-            return self._values[key]
+            value, _ = self._values[key]
         except KeyError:
-            self._values[key] = self._calc_fns[key]()
-            return self._values[key]
+            self.num_misses += 1
+        else:
+            self._values.move_to_end(key)
+            self.num_hits += 1
+            return value
+        value = calc_fn()
+        cost = 1 if cost_fn is None else cost_fn(value)
+        if cost <= self.max_cost and self.max_size > 0:
+            self._values[key] = (value, cost)
+            self.total_cost += cost
+            while len(self._values) > self.max_size or self.total_cost > self.max_cost:
+                _, (_, evicted_cost) = self._values.popitem(last=False)
+                self.total_cost -= evicted_cost
+        return value
+
+################################################################################
+## Probability arithmetic
+
+class _ProbabilityArithmetic(object):
+    """
+    Arithmetic on probabilities in the working value type of the tree (plain
+    floats or `decimal.Decimal`).
+    """
+
+    def __init__(self, as_working_value_type):
+        self.as_working_value_type = as_working_value_type
+        self.zero = as_working_value_type(0.0)
+        self.one = as_working_value_type(1.0)
+
+    def mul(self, a, b):
+        return a * b
+
+    def add(self, a, b):
+        return a + b
+
+    def edge_probs(self, edge_length, speciation_completion_rate):
+        """
+        Returns the probabilities of no speciation event and of at least one
+        speciation event on an edge of length `edge_length` under the
+        speciation completion rate `speciation_completion_rate`.
+        """
+        scaled_brlen = edge_length * speciation_completion_rate
+        if isinstance(self.one, decimal.Decimal) and -scaled_brlen < _MIN_NORMAL_FLOAT_LOG:
+            # would underflow as a float
+            prob_no_sp = decimal.Decimal(-scaled_brlen).exp()
+        else:
+            prob_no_sp = self.as_working_value_type(math.exp(-scaled_brlen))
+        return prob_no_sp, self.one - prob_no_sp
+
+    def as_working_value(self, v):
+        return v
+
+    def as_log(self, v):
+        if v <= 0:
+            return _NEG_INF
+        if isinstance(v, decimal.Decimal):
+            return float(v.ln())
+        return math.log(v)
+
+class _LogProbabilityArithmetic(object):
+    """
+    Arithmetic on log-transformed probabilities, with sums calculated by
+    log-sum-exp. Values are only converted to the working value type
+    (`decimal.Decimal`, which does not underflow) when reported.
+    """
+
+    zero = _NEG_INF
+    one = 0.0
+
+    def mul(self, a, b):
+        return a + b
+
+    def add(self, a, b):
+        return _log_add(a, b)
+
+    def edge_probs(self, edge_length, speciation_completion_rate):
+        scaled_brlen = edge_length * speciation_completion_rate
+        return -scaled_brlen, _log_prob_sp(scaled_brlen)
+
+    def as_working_value(self, v):
+        if v > _MIN_NORMAL_FLOAT_LOG:
+            # exact conversion of a float that has not underflowed
+            return decimal.Decimal(math.exp(v))
+        return decimal.Decimal(v).exp()
+
+    def as_log(self, v):
+        return v
+
+_FLOAT_ARITHMETIC = _ProbabilityArithmetic(float)
+_LOG_ARITHMETIC = _LogProbabilityArithmetic()
+
+class _LogDualProbabilityArithmetic(object):
+    """
+    Forward-mode differentiation of log probabilities with respect to the
+    speciation completion rate: each value is a tuple of the log probability
+    and its first and second derivatives with respect to the rate.
+    """
+
+    zero = (_NEG_INF, 0.0, 0.0)
+    one = (0.0, 0.0, 0.0)
+
+    def mul(self, a, b):
+        return (a[0] + b[0], a[1] + b[1], a[2] + b[2])
+
+    def add(self, a, b):
+        if a[0] < b[0]:
+            a, b = b, a
+        if b[0] == _NEG_INF:
+            return a
+        # derivatives of the sum are the derivatives of the terms, weighted
+        # by the share of each term in the sum
+        r = math.exp(b[0] - a[0])
+        b_wt = r / (1.0 + r)
+        a_wt = 1.0 - b_wt
+        d1 = a_wt * a[1] + b_wt * b[1]
+        d2 = a_wt * (a[2] + a[1] * a[1]) + b_wt * (b[2] + b[1] * b[1]) - d1 * d1
+        return (a[0] + math.log1p(r), d1, d2)
+
+    def edge_probs(self, edge_length, speciation_completion_rate):
+        scaled_brlen = edge_length * speciation_completion_rate
+        prob_no_sp = (-scaled_brlen, -edge_length, 0.0)
+        if scaled_brlen <= 0.0:
+            return prob_no_sp, self.zero
+        # log(1 - exp(-x)) has derivatives exp(-x)/(1 - exp(-x)) and
+        # -exp(-x)/(1 - exp(-x))^2 with respect to x
+        q = math.exp(-scaled_brlen)
+        p_sp = -math.expm1(-scaled_brlen)
+        prob_sp = (math.log(p_sp),
+                edge_length * q / p_sp,
+                -edge_length * edge_length * q / (p_sp * p_sp))
+        return prob_no_sp, prob_sp
+
+    def as_working_value(self, v):
+        return v
+
+    def as_log(self, v):
+        return v
+
+_LOG_DUAL_ARITHMETIC = _LogDualProbabilityArithmetic()
+
+class _ArrayProbabilityArithmetic(object):
+    """
+    Arithmetic on NumPy arrays of probabilities, with one element for each
+    speciation completion rate of an array of rates, so that a calculation
+    over all the rates is carried out in a single pass.
+    """
+
+    def __init__(self, shape):
+        self.zero = np.zeros(shape)
+        self.one = np.ones(shape)
+
+    def mul(self, a, b):
+        return a * b
+
+    def add(self, a, b):
+        return a + b
+
+    def edge_probs(self, edge_length, speciation_completion_rate):
+        prob_no_sp = np.exp(-edge_length * speciation_completion_rate)
+        return prob_no_sp, 1.0 - prob_no_sp
+
+    def as_working_value(self, v):
+        return v
+
+    def as_log(self, v):
+        with np.errstate(divide="ignore"):
+            return np.log(v)
+
+class _ArrayLogProbabilityArithmetic(object):
+    """
+    As `_ArrayProbabilityArithmetic`, but on log-transformed probabilities.
+    """
+
+    def __init__(self, shape):
+        self.zero = np.full(shape, _NEG_INF)
+        self.one = np.zeros(shape)
+
+    def mul(self, a, b):
+        return a + b
+
+    def add(self, a, b):
+        return np.logaddexp(a, b)
+
+    def edge_probs(self, edge_length, speciation_completion_rate):
+        scaled_brlen = edge_length * speciation_completion_rate
+        with np.errstate(divide="ignore"):
+            return -scaled_brlen, np.log(-np.expm1(-scaled_brlen))
+
+    def as_working_value(self, v):
+        return np.exp(v)
+
+    def as_log(self, v):
+        return v
 
 ################################################################################
 ## Enum class
@@ -239,6 +889,60 @@ class SF(object):
     CA_FLAG = 3   # flag for a common ancestor of all selected tips
 
 
+################################################################################
+## LineageIndex
+
+class LineageIndex(object):
+    """
+    Dense integer indexes of lineages, by (normalized) label, so that
+    lineages can be handled as ints, and sets of lineages as ints used as
+    bitsets (with the bit of each lineage given by its index), with labels
+    only needed again for output.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = []
+        self._label_indexes = {}
+        if labels is not None:
+            for label in labels:
+                self.add(label)
+
+    def add(self, label):
+        """
+        Returns the index of the lineage, indexing it first if needed.
+        """
+        try:
+            return self._label_indexes[label]
+        except KeyError:
+            idx = len(self.labels)
+            self._label_indexes[label] = idx
+            self.labels.append(label)
+            return idx
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self._label_indexes
+
+    def index(self, label):
+        return self._label_indexes[label]
+
+    def bit(self, label):
+        return 1 << self._label_indexes[label]
+
+    def mask(self, labels):
+        mask = 0
+        for label in labels:
+            mask |= 1 << self._label_indexes[label]
+        return mask
+
+    def mask_labels(self, mask):
+        return _bitmask_labels(mask, self.labels)
+
+    def bit_map(self):
+        return dict((label, 1 << idx) for idx, label in enumerate(self.labels))
+
 ################################################################################
 ## LineageEdge
 
@@ -252,7 +956,10 @@ class LineageEdge(dendropy.Edge):
         return self._length
     def _set_length(self, length):
         self._length = length
-        # to do! self.tree.invalidate_cache(self)
+        # the edge is given its length before it is given its tree
+        tree = getattr(self, "tree", None)
+        if tree is not None:
+            tree._tree_version += 1
     length = property(_get_length, _set_length)
 
 ################################################################################
@@ -263,6 +970,7 @@ class LineageNode(dendropy.Node):
     def __init__(self, tree, **kwargs):
         self.tree = tree
         self.marginal_prob_calc = {}
+        self.joint_prob_calc = {}
         dendropy.Node.__init__(self, **kwargs)
 
     def edge_factory(self, **kwargs):
@@ -279,13 +987,34 @@ class LineageTree(dendropy.Tree):
 
     def __init__(self, *args, **kwargs):
         self._speciation_completion_rate = None
+        # order in which partition maps are built (see
+        # `_iter_partition_map_schedule()`), and the peak number of partition
+        # states and number of partition maps allocated by the last
+        # calculation of all partition probabilities
+        self.partition_map_schedule = "postorder"
+        self.peak_num_live_partition_states = None
+        self.num_partition_maps_allocated = None
+        # shared with the controller when read through one
+        self._lineage_index = None
+        # clades collapsed into single lineages for the calculation of
+        # partition probabilities (see `_collapse_constrained_clades()`)
+        self._constrained_clades = {}
+        # relative probability below which partitions of subtrees are
+        # dropped as all partitions are calculated, if any, and the total
+        # probability dropped by the last calculation
+        self.partition_beam_epsilon = None
+        self.pruned_partition_probability = None
+        # incremented on every change to the tree that the cached
+        # probabilities depend on (other than the rate, numeric mode and
+        # constraints, which are part of their keys)
+        self._tree_version = 0
+        self._node_constraints_key = None
         self._setup_cache()
         self.all_monotypic = None
         self.is_annotate_leaf_constraint_status = kwargs.pop("is_annotate_leaf_constraint_status", True)
         self.is_paint_leaf_constraint_status = kwargs.pop("is_paint_leaf_constraint_status", True)
         dendropy.Tree.__init__(self, *args, **kwargs)
-        # self.decimal_value_type_tree_size_threshold = 100
-        self.is_use_decimal_value_type = None
+        self.underflow_protection = None
         self.metadata_keys = []
         if self.is_annotate_leaf_constraint_status:
             self.metadata_keys.append("status")
@@ -302,56 +1031,102 @@ class LineageTree(dendropy.Tree):
     ################################################################################
     ## Properties
 
+    def _get_lineage_index(self):
+        if self._lineage_index is None:
+            self._lineage_index = LineageIndex(nd.taxon.label for nd in self.leaf_node_iter())
+        return self._lineage_index
+    def _set_lineage_index(self, lineage_index):
+        self.clear_node_constraints()
+        self._lineage_index = lineage_index
+        # the constraints of cached probabilities are keyed by lineage index
+        self._tree_version += 1
+    lineage_index = property(_get_lineage_index, _set_lineage_index)
+
     def _get_speciation_completion_rate(self):
         return self._speciation_completion_rate
 
     def _set_speciation_completion_rate(self, value):
         self._speciation_completion_rate = value
-        self.invalidate_cache(self)
     speciation_completion_rate = property(_get_speciation_completion_rate, _set_speciation_completion_rate)
 
-    def _get_is_use_decimal_value_type(self):
-        return self._is_use_decimal_value_type
-    def _set_is_use_decimal_value_type(self, v):
-        self._is_use_decimal_value_type = v
-        self.invalidate_cache(self)
-        if self._is_use_decimal_value_type is None:
-            # if len(self.taxon_namespace) >= self.decimal_value_type_tree_size_threshold:
-            #     self._is_use_decimal_value_type = True
-            # else:
-            #     self._is_use_decimal_value_type = False
-            self._is_use_decimal_value_type = False
-        if self._is_use_decimal_value_type:
+    def _get_underflow_protection(self):
+        return self._underflow_protection
+    def _set_underflow_protection(self, v):
+        # True selects the default protection mode, log-space arithmetic
+        if v is True:
+            v = "log"
+        elif not v:
+            v = None
+        if v not in (None, "log", "decimal"):
+            raise ValueError("Unrecognized underflow protection mode: '{}'".format(v))
+        self._underflow_protection = v
+        if self._underflow_protection is None:
+            self.as_working_value_type = lambda x: x
+            self.as_float = lambda x: x
+        else:
             self.as_working_value_type = lambda x: decimal.Decimal(x)
             self.as_float = lambda x: float(x)
+        if self._underflow_protection == "log":
+            self._arithmetic = _LogProbabilityArithmetic()
         else:
-            self.as_working_value_type = lambda x: x
-            self.as_float = lambda x: x
+            self._arithmetic = _ProbabilityArithmetic(self.as_working_value_type)
+    underflow_protection = property(_get_underflow_protection, _set_underflow_protection)
+
+    def _get_is_use_log_value_type(self):
+        return self._underflow_protection == "log"
+    is_use_log_value_type = property(_get_is_use_log_value_type)
+
+    def _get_is_use_decimal_value_type(self):
+        return self._underflow_protection == "decimal"
+    def _set_is_use_decimal_value_type(self, v):
+        self.underflow_protection = "decimal" if v else None
     is_use_decimal_value_type = property(_get_is_use_decimal_value_type, _set_is_use_decimal_value_type)
 
     ################################################################################
     ## Cache
 
     def _setup_cache(self):
-        self._joint_probability_cache = _Cache()
-        self._joint_probability_cache.add(
-                "label_partition_probability_map",
-                self.calc_label_partition_probability_map)
-
-    def invalidate_cache(self, o):
-        # o = object that changed that required cache invalidation
-        self._joint_probability_cache.clear()
+        # probabilities calculated on the tree, by the kind of calculation,
+        # the rate, the numeric mode, the version of the tree and the
+        # arguments of the calculation, so that revisiting a rate (e.g., in
+        # estimating the rate, its confidence interval and its profile, and
+        # then calculating the partition probabilities under it) does not
+        # recalculate anything
+        self.probability_cache = _Cache()
+
+    def invalidate_cache(self, o=None):
+        # o = object that changed that required cache invalidation (changes
+        # to the branch lengths are picked up without it, but changes to the
+        # topology are not)
+        self._tree_version += 1
+        self.probability_cache.clear()
+
+    def _probability_cache_key(self, kind, *args):
+        # None for an array of rates, the results for which are not cached
+        rate = self._speciation_completion_rate
+        if np is not None and isinstance(rate, np.ndarray):
+            return None
+        return (kind, float(rate), self._underflow_protection, self._tree_version) + args
+
+    def _get_cached_probability(self, key, calc_fn, cost_fn=None):
+        if key is None:
+            return calc_fn()
+        return self.probability_cache.get(key, calc_fn, cost_fn)
 
     ################################################################################
     ## Node Constraints
 
     def clear_node_constraints(self):
+        self._constrained_clades = {}
+        self._node_constraints_key = None
         for nd in self:
             for attr in (
-                    "leaf_label_set",
+                    "leaf_lineage_mask",
                     "speciation_allowed",
                     "sp_set",
-                    "sp_constraints"):
+                    "sp_constraints",
+                    "sp_constraint_index",
+                    "known_tipward_sp"):
                 try:
                     delattr(nd, attr)
                 except AttributeError:
@@ -359,20 +1134,30 @@ class LineageTree(dendropy.Tree):
 
     def set_node_constraints(self, species_leafset_labels):
         # Set up per-node conspecific and non-conspecific constraints...
+        # Lineages are handled by their indexes in `lineage_index`, and sets of
+        # lineages (including the species, which are identified by them) as
+        # bitsets of these.
         self.clear_node_constraints()
+        lineage_index = self.lineage_index
         sls_by_species = {}
         self.all_monotypic = True
         for spls in species_leafset_labels:
             if len(spls) > 1:
                 self.all_monotypic = False
+            sp_mask = 0
             for sp in spls:
-                sls_by_species[sp] = spls
+                # lineages not on the tree can never be joined by the rest
+                # of their species
+                sp_mask |= 1 << lineage_index.add(sp)
+            for sp in spls:
+                sls_by_species[sp] = sp_mask
+        self._node_constraints_key = frozenset(sls_by_species.values())
         for nd in self.postorder_node_iter():
             nd.speciation_allowed = True
             if nd.is_leaf():
-                nd.leaf_label_set = frozenset([nd.taxon.label])
+                nd.leaf_lineage_mask = lineage_index.bit(nd.taxon.label)
                 sp = sls_by_species.get(nd.taxon.label)
-                nd.speciation_allowed = sp is None or len(sp) == 1
+                nd.speciation_allowed = sp is None or sp == nd.leaf_lineage_mask
                 if sp is None:
                     if self.is_annotate_leaf_constraint_status:
                         nd.annotations["status"] = "unconstrained"
@@ -396,101 +1181,578 @@ class LineageTree(dendropy.Tree):
                             nd.annotations[metadata_key] = child_nodes[0].annotations[metadata_key].value
                         else:
                             nd.annotations[metadata_key] = self.metadata_null_values[metadata_key]
-                lls = set()
                 nd.all_des_sp_known = True
                 assert len(nd.child_nodes()) == 2 # Not tested with polytomies yet...
                 lchild, rchild = nd.child_nodes()
                 nd.sp_set = lchild.sp_set.union(rchild.sp_set)
                 shared = lchild.sp_set.intersection(rchild.sp_set)
-                nd.leaf_label_set = frozenset(lchild.leaf_label_set.union(rchild.leaf_label_set))
+                nd.leaf_lineage_mask = lchild.leaf_lineage_mask | rchild.leaf_lineage_mask
                 if len(shared) > 1:
                     m = 'More than 1 species is conspecific with this ancestor. This is not allowed. Leaf sets of offending species are:'
                     for x in shared:
-                        m = m + '\n {}'.format(x)
+                        m = m + '\n {}'.format(frozenset(lineage_index.mask_labels(x)))
                     raise ValueError(m)
                 consp = []
                 nonconsp = []
                 for sp in lchild.sp_set:
-                    ll = next(iter(sp.intersection(lchild.leaf_label_set)))
+                    ll = _bitmask_lowest_index(sp & lchild.leaf_lineage_mask)
                     if sp in shared:
-                        rl = next(iter(sp.intersection(rchild.leaf_label_set)))
+                        rl = _bitmask_lowest_index(sp & rchild.leaf_lineage_mask)
                         consp.append((rl, ll))
                     else:
                         for rsp in rchild.sp_set:
                             if rsp not in shared:
-                                rl = next(iter(rsp.intersection(rchild.leaf_label_set)))
+                                rl = _bitmask_lowest_index(rsp & rchild.leaf_lineage_mask)
                                 nonconsp.append((ll, rl))
                 nd.speciation_allowed = True
                 for sp in nd.sp_set:
-                    if not nd.leaf_label_set.issuperset(sp):
+                    if sp & ~nd.leaf_lineage_mask:
                         nd.speciation_allowed = False
                 nd.sp_constraints = None
+                nd.sp_constraint_index = None
                 if nonconsp or consp:
                     nd.sp_constraints = {}
                     if nonconsp:
                         nd.sp_constraints['not_conspecific'] = nonconsp
                     if consp:
                         nd.sp_constraints['conspecific'] = consp
+                    nd.sp_constraint_index = _compile_constraint_index(nd.sp_constraints)
+        self._constrained_clades = self._collapse_constrained_clades()
+
+    def _collapse_constrained_clades(self):
+        """
+        Returns the nodes below the top of each of the largest clades all of
+        whose leaves belong to a single constrained species, by the top node.
+        Speciation is not allowed on any edge within such a clade, so the only
+        partition of its leaves is into a single open subset, with the
+        probability of no speciation on any of these edges: the clade can
+        stand in for all of them as a single (super-)leaf.
+        """
+        constrained_clades = {}
+        to_visit = [self.seed_node]
+        while to_visit:
+            nd = to_visit.pop()
+            if nd.is_leaf():
+                continue
+            if len(nd.sp_set) == 1 and not nd.leaf_lineage_mask & ~next(iter(nd.sp_set)):
+                constrained_clades[nd] = [desc for desc in nd.preorder_iter() if desc is not nd]
+            else:
+                to_visit.extend(nd.child_nodes())
+        return constrained_clades
 
     def _calc_new_nonconsp(self, nd, species):
         not_consp = []
         for c in nd.child_nodes():
             if species not in c.sp_set:
-                first_label = list(species)[0]
+                first_lineage = _bitmask_lowest_index(species)
                 for cs in c.sp_set:
-                    fcl = list(cs)[0]
-                    not_consp.append((first_label, fcl))
+                    fcl = _bitmask_lowest_index(cs)
+                    not_consp.append((first_lineage, fcl))
         return not_consp
 
     ################################################################################
     ## Joint Probability
 
     def calc_joint_probability_of_species(self, species_leafset_labels):
-        ppm = self.calc_label_partition_probability_map()
-        return ppm[species_leafset_labels]
-        # if not isinstance(taxon_labels, set):
-        #     taxon_labels = frozenset(frozenset(i) for i in taxon_labels)
-        # prob = self._joint_probability_cache["label_partition_probability_map"][taxon_labels]
-        # return prob
+        """
+        Calculates the joint probability of the partition of the tree lineages
+        into species given by `species_leafset_labels` (a collection of
+        collections of leaf labels), in a single postorder pass.
+
+        Unlike `calc_label_partition_probability_map()`, this does not
+        enumerate any other partitions, so is linear in the size of the tree.
+        As with that map, a partition that breaks the node constraints (see
+        `set_node_constraints()`) has a probability of 0.
+
+        The speciation completion rate may also be a NumPy array of rates, in
+        which case the probabilities under all the rates are calculated in the
+        same single pass, and returned as an array of floats.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        ar = self._get_arithmetic(self._speciation_completion_rate)
+        prob = self._calc_cached_joint_sp_prob("joint_probability", species_leafset_labels, ar)
+        return ar.as_working_value(prob)
+
+    def calc_joint_log_probability_of_species(self, species_leafset_labels):
+        """
+        As `calc_joint_probability_of_species()`, but returns the natural log
+        of the probability as a float (-inf if the probability is 0), or as an
+        array of floats given an array of rates. Under log-space underflow
+        protection, the log probability is returned directly, without ever
+        being exponentiated.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        ar = self._get_arithmetic(self._speciation_completion_rate)
+        prob = self._calc_cached_joint_sp_prob("joint_probability", species_leafset_labels, ar)
+        return ar.as_log(prob)
+
+    def calc_joint_log_probability_of_species_derivatives(self, species_leafset_labels):
+        """
+        Returns a tuple of the natural log of the joint probability of the
+        partition given by `species_leafset_labels` (as given by
+        `calc_joint_log_probability_of_species()`) and its first and second
+        derivatives with respect to the speciation completion rate, all
+        calculated in the same single postorder pass. The calculation is
+        carried out in log space irrespective of underflow protection.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        return self._calc_cached_joint_sp_prob("joint_log_probability_derivatives", species_leafset_labels, _LOG_DUAL_ARITHMETIC)
+
+    def _calc_cached_joint_sp_prob(self, kind, species_leafset_labels, ar):
+        # the partition is keyed by its species, with the number of labels
+        # given, which only differs from the number of labels of the species
+        # if it is not a partition (and so has a probability of 0)
+        species_leafset_labels = [tuple(sp_labels) for sp_labels in species_leafset_labels]
+        partition_key = (frozenset(frozenset(sp_labels) for sp_labels in species_leafset_labels),
+                sum(len(sp_labels) for sp_labels in species_leafset_labels))
+        return self._get_cached_probability(
+                self._probability_cache_key(kind, self._node_constraints_key, partition_key),
+                lambda: self._calc_joint_sp_prob(
+                    species_leafset_labels=species_leafset_labels,
+                    good_sp_rate=self._speciation_completion_rate,
+                    ar=ar))
+
+    def _get_arithmetic(self, good_sp_rate):
+        """
+        Returns the arithmetic for calculations under `good_sp_rate`: that of
+        the tree for a single rate, or array arithmetic for an array of rates
+        (in log space under either mode of underflow protection, as decimals
+        cannot be vectorized).
+        """
+        if np is None or not isinstance(good_sp_rate, np.ndarray):
+            return self._arithmetic
+        if self._underflow_protection is None:
+            return _ArrayProbabilityArithmetic(good_sp_rate.shape)
+        return _ArrayLogProbabilityArithmetic(good_sp_rate.shape)
+
+    def _calc_joint_sp_prob(self, species_leafset_labels, good_sp_rate, ar):
+        """
+        Each node is scored against the partition in one of three states: (1)
+        the lineage ancestral to the node belongs to a species that also has
+        leaves outside the subtree (the "crossing" species, of which there can
+        be at most one); (2) the lineage belongs to a species wholly contained
+        in the subtree; or (3) the lineage belongs to no sampled species at all
+        (i.e., all species of the subtree have been closed off by speciation
+        events). States (1) and (2) share the "open" slot, as a node with a
+        crossing species cannot be in any other state.
+
+        Under node constraints, the leaves of each constrained species must
+        all be in the same species of the partition, and no two constrained
+        species in the same one; and, as in building the partition
+        probability map, no species may be closed off on an edge on which
+        speciation is not allowed.
+
+        Returns the probability in the representation of the arithmetic `ar`.
+        """
+        label_species_map = {}
+        species_sizes = []
+        for sp_idx, sp_labels in enumerate(species_leafset_labels):
+            for label in sp_labels:
+                if label in label_species_map:
+                    # not a partition
+                    return ar.zero
+                label_species_map[label] = sp_idx
+            species_sizes.append(len(sp_labels))
+        # the species of the partition of the leaves of each constrained
+        # species, and the constrained species in each species of the
+        # partition
+        constrained_sp_species = {}
+        species_constrained_sp = {}
+        for nd in self.postorder_node_iter():
+            jpc = nd.joint_prob_calc
+            if nd.is_leaf():
+                sp_idx = label_species_map.get(nd.taxon.label, None)
+                if sp_idx is None:
+                    # leaf not in partition
+                    return ar.zero
+                constrained_sp = getattr(nd, "known_tipward_sp", None)
+                if constrained_sp is not None:
+                    if constrained_sp_species.setdefault(constrained_sp, sp_idx) != sp_idx:
+                        # constrained species split across species
+                        return ar.zero
+                    if species_constrained_sp.setdefault(sp_idx, constrained_sp) != constrained_sp:
+                        # two constrained species joined in a species
+                        return ar.zero
+                if species_sizes[sp_idx] > 1:
+                    jpc["crossing_species"] = sp_idx
+                    jpc["crossing_count"] = 1
+                else:
+                    jpc["crossing_species"] = None
+                jpc["prob_open"] = ar.one
+                jpc["prob_empty"] = ar.zero
+            else:
+                children = nd.child_nodes()
+                crossing_species = None
+                for c in children:
+                    c_sp = c.joint_prob_calc["crossing_species"]
+                    if c_sp is None:
+                        continue
+                    if crossing_species is None:
+                        crossing_species = c_sp
+                    elif crossing_species != c_sp:
+                        # two different species would be joined at this node
+                        return ar.zero
+                if crossing_species is None:
+                    prob_empty = ar.one
+                    prob_open = ar.zero
+                    for c in children:
+                        c_prob_open, c_prob_empty = self._joint_sp_prob_edge_probs(c, good_sp_rate, ar)
+                        prob_open = ar.add(ar.mul(prob_open, c_prob_empty), ar.mul(prob_empty, c_prob_open))
+                        prob_empty = ar.mul(prob_empty, c_prob_empty)
+                    jpc["crossing_species"] = None
+                else:
+                    prob_empty = ar.zero
+                    prob_open = ar.one
+                    crossing_count = 0
+                    for c in children:
+                        c_prob_open, c_prob_empty = self._joint_sp_prob_edge_probs(c, good_sp_rate, ar)
+                        if c.joint_prob_calc["crossing_species"] == crossing_species:
+                            prob_open = ar.mul(prob_open, c_prob_open)
+                            crossing_count += c.joint_prob_calc["crossing_count"]
+                        else:
+                            prob_open = ar.mul(prob_open, c_prob_empty)
+                    if crossing_count == species_sizes[crossing_species]:
+                        jpc["crossing_species"] = None
+                    else:
+                        jpc["crossing_species"] = crossing_species
+                        jpc["crossing_count"] = crossing_count
+                jpc["prob_open"] = prob_open
+                jpc["prob_empty"] = prob_empty
+        root_jpc = self.seed_node.joint_prob_calc
+        if root_jpc["crossing_species"] is not None:
+            # species includes labels not found on tree
+            return ar.zero
+        return ar.add(root_jpc["prob_open"], root_jpc["prob_empty"])
+
+    def _joint_sp_prob_edge_probs(self, nd, good_sp_rate, ar):
+        """
+        Returns the probabilities of the open and empty states at the top of
+        the edge subtending `nd`.
+        """
+        jpc = nd.joint_prob_calc
+        prob_no_sp, prob_sp = ar.edge_probs(nd.edge.length, good_sp_rate)
+        if jpc["crossing_species"] is not None or not getattr(nd, "speciation_allowed", True):
+            # species extends outside of the subtree, or is constrained to,
+            # so cannot be closed off
+            return ar.mul(jpc["prob_open"], prob_no_sp), ar.zero
+        return (ar.mul(jpc["prob_open"], prob_no_sp),
+                ar.add(jpc["prob_empty"], ar.mul(jpc["prob_open"], prob_sp)))
 
     def calc_label_partition_probability_map(self):
+        """
+        Returns the probabilities of all partitions of the lineages, by lookup
+        key. If `partition_beam_epsilon` is set, the partitions of the
+        lineages of each subtree with a probability less than this times the
+        greatest are dropped as they are built, and so are all the partitions
+        they are part of, with the total probability of those dropped no
+        more than `pruned_partition_probability`.
+
+        The map is cached (see `probability_cache`), and the same map is
+        returned for the same rate, numeric mode and constraints, so must not
+        be modified.
+        """
         if self._speciation_completion_rate is None:
             raise ValueError("Speciation completion rate not set")
-        partition_probability_map = self._calc_all_joint_sp_probs(good_sp_rate=self._speciation_completion_rate)
+        def _calc():
+            partition_probability_map = self._calc_all_joint_sp_probs(good_sp_rate=self._speciation_completion_rate)
+            return (partition_probability_map,
+                    self.pruned_partition_probability,
+                    self.peak_num_live_partition_states,
+                    self.num_partition_maps_allocated)
+        (partition_probability_map,
+                self.pruned_partition_probability,
+                self.peak_num_live_partition_states,
+                self.num_partition_maps_allocated) = self._get_cached_probability(
+                        self._probability_cache_key(
+                            "label_partition_probability_map",
+                            self._node_constraints_key,
+                            self.partition_beam_epsilon,
+                            self.partition_map_schedule),
+                        _calc,
+                        lambda value: len(value[0]))
         return partition_probability_map
 
-    def _calc_all_joint_sp_probs(self, good_sp_rate):
+    def _index_leaf_labels(self):
+        lineage_index = self.lineage_index
+        return lineage_index.labels, lineage_index.bit_map()
+
+    def _iter_partition_map_schedule(self):
+        """
+        Yields each node with its children, in the order in which the
+        partition maps are built and merged: the postorder of the tree, or,
+        if `partition_map_schedule` is "min-memory", the postorder in which
+        the children of each node are visited in the order that minimizes
+        the (estimated) peak number of partition states held at any one time,
+        as in Sethi-Ullman register allocation. The number of states of the
+        map of a subtree is estimated as the number of partitions of its
+        lineages, counting the lineages of each constrained species as one.
+        The clades collapsed by `_collapse_constrained_clades()` are yielded
+        as leaves, without their descendants.
+        """
+        def _children(nd):
+            # the clades collapsed into single lineages are built as leaves
+            return [] if nd in self._constrained_clades else nd.child_nodes()
+        if self.partition_map_schedule == "postorder":
+            to_visit = [(self.seed_node, False)]
+            while to_visit:
+                nd, is_expanded = to_visit.pop()
+                children = _children(nd)
+                if is_expanded or not children:
+                    yield nd, children
+                else:
+                    to_visit.append((nd, True))
+                    to_visit.extend((c, False) for c in reversed(children))
+            return
+        if self.partition_map_schedule != "min-memory":
+            raise ValueError("Unrecognized partition map schedule: '{}'".format(self.partition_map_schedule))
+        num_unconstrained_lineages = {}
         for nd in self.postorder_node_iter():
             if nd.is_leaf():
-                nd.tipward_part_map = defaultdict(lambda: self.as_working_value_type(0.0))
-                nd.tipward_part_map[_Partition(leaf_label=nd.taxon.label)] = self.as_working_value_type(1.0)
+                num_unconstrained_lineages[nd] = 1 if getattr(nd, "known_tipward_sp", None) is None else 0
             else:
-                children = nd.child_nodes()
-                nd.tipward_part_map = children[0].rootward_part_map
+                num_unconstrained_lineages[nd] = sum(num_unconstrained_lineages[c] for c in nd.child_nodes())
+        def _num_lineages(nd):
+            return num_unconstrained_lineages[nd] + len(getattr(nd, "sp_set", ()))
+        state_counts = _estimate_part_map_state_counts(_num_lineages(self.seed_node))
+        # estimated number of states of the map of each node, and peak
+        # number of states held while building it, with its children in the
+        # order that minimizes the latter
+        num_states = {}
+        peak_num_states = {}
+        ordered_children = {}
+        for nd in self.postorder_node_iter():
+            num_states[nd] = state_counts[_num_lineages(nd)]
+            if not _children(nd):
+                peak_num_states[nd] = num_states[nd]
+                continue
+            children = sorted(nd.child_nodes(), key=lambda c: peak_num_states[c] - num_states[c], reverse=True)
+            peak = 0.0
+            held = 0.0
+            for c in children:
+                peak = max(peak, held + peak_num_states[c])
+                held += num_states[c]
+            peak_num_states[nd] = max(peak, held + num_states[nd])
+            ordered_children[nd] = children
+        to_visit = [(self.seed_node, False)]
+        while to_visit:
+            nd, is_expanded = to_visit.pop()
+            if is_expanded or nd not in ordered_children:
+                yield nd, ordered_children.get(nd, [])
+            else:
+                to_visit.append((nd, True))
+                to_visit.extend((c, False) for c in reversed(ordered_children[nd]))
+
+    def calc_partition_map_state_counts(self):
+        """
+        Counts, exactly, the partition states that calculating the
+        probabilities of all the partitions of the lineages (see
+        `calc_label_partition_probability_map()`) builds, without building
+        them. Returns a tuple of: the numbers of states of the map of each
+        node, by node, as a pair of the numbers before and after the edge
+        subtending the node (None for the root); the peak number of states
+        held at any one time, following `partition_map_schedule`; the total
+        number of states formed, as a measure of the work done; and the
+        number of partitions.
+
+        States are counted by the species constraint of their open subset,
+        if any (see `_merge_species_states()`), which is all that decides
+        which pairs of states can be merged, and by whether that subset has
+        passed through an edge on which it could have been closed since it
+        was last joined with another. Closing it anywhere after that gives
+        the same partition as closing it there, so only partitions from
+        closing subsets that have not are counted, to count each once.
+        """
+        node_state_counts = {}
+        # numbers of states through the edge of each node, by status and
+        # species constraint of the open subset, until merged
+        node_counts = {}
+        num_live_states = 0
+        peak_num_live_states = 0
+        num_states_formed = 0
+        for nd, children in self._iter_partition_map_schedule():
+            if not children:
+                if nd.is_leaf():
+                    sp = getattr(nd, "known_tipward_sp", None)
+                else:
+                    # a collapsed clade, all of whose leaves are of a species
+                    sp = next(iter(nd.sp_set))
+                counts = {(_PART_STATE_FRESH, sp): 1}
+                num_live_states += 1
+            else:
+                counts = node_counts.pop(children[0])
+                for c in children[1:]:
+                    c_counts = node_counts.pop(c)
+                    num_merged_states = sum(counts.values()) + sum(c_counts.values())
+                    counts = _merge_part_map_state_counts(counts, c_counts)
+                    num_states = sum(counts.values())
+                    num_states_formed += num_states
+                    if c is not children[-1]:
+                        peak_num_live_states = max(peak_num_live_states, num_live_states + num_states)
+                        num_live_states += num_states - num_merged_states
+            num_states = sum(counts.values())
+            if nd is self.seed_node:
+                node_state_counts[nd] = (num_states, None)
+                if children:
+                    # the last merge is written straight into the map of the
+                    # (closed) partitions
+                    num_partitions = sum(count for (status, sp), count in counts.items() if status != _PART_STATE_STALE)
+                    peak_num_live_states = max(peak_num_live_states, num_live_states + num_partitions)
+                    num_live_states += num_partitions - num_merged_states
+                break
+            node_counts_through_edge = _close_part_map_state_counts(counts, getattr(nd, "speciation_allowed", True))
+            num_states_through_edge = sum(node_counts_through_edge.values())
+            node_state_counts[nd] = (num_states, num_states_through_edge)
+            num_states_formed += num_states_through_edge
+            peak_num_live_states = max(peak_num_live_states, num_live_states + num_states_through_edge)
+            if children:
+                # the last merge is written straight into the map through the
+                # edge, so the map before it is never held
+                num_live_states += num_states_through_edge - num_merged_states
+            else:
+                num_live_states += num_states_through_edge - num_states
+            node_counts[nd] = node_counts_through_edge
+        peak_num_live_states = max(peak_num_live_states, num_live_states)
+        num_partitions = sum(count for (status, sp), count in counts.items() if status != _PART_STATE_STALE)
+        return node_state_counts, peak_num_live_states, num_states_formed, num_partitions
+
+    def _calc_all_joint_sp_probs(self, good_sp_rate):
+        is_log = self.is_use_log_value_type
+        leaf_labels, leaf_label_bit_map = self._index_leaf_labels()
+        # the maps of the nodes are written into maps released by the nodes
+        # (or merges) done with them
+        part_map_pool = _PartMapPool()
+        # number of partition states held, and the most held at any one time
+        num_live_states = 0
+        peak_num_live_states = 0
+        pruned_prob = 0.0
+        for nd, children in self._iter_partition_map_schedule():
+            if nd is self.seed_node:
+                # all the open subsets are closed at the root
+                remain_open_prob = None
+                close_prob = 0.0 if is_log else self.as_working_value_type(1.0)
+            else:
+                scaled_brlen = nd.edge.length * good_sp_rate
+                is_speciation_allowed = getattr(nd, 'speciation_allowed', True)
+                if is_log:
+                    remain_open_prob = -scaled_brlen
+                    close_prob = _log_prob_sp(scaled_brlen) if is_speciation_allowed else None
+                else:
+                    remain_open_prob = self.as_working_value_type(math.exp(-scaled_brlen))
+                    close_prob = self.as_working_value_type(1.0) - remain_open_prob if is_speciation_allowed else None
+            # whether the map is through the edge already
+            is_closed = False
+            if nd.is_leaf():
+                nd.tipward_part_map = part_map_pool.acquire()
+                if is_log:
+                    nd.tipward_part_map[(leaf_label_bit_map[nd.taxon.label],)] = 0.0
+                else:
+                    nd.tipward_part_map[(leaf_label_bit_map[nd.taxon.label],)] = self.as_working_value_type(1.0)
+                num_live_states += 1
+            elif not children:
+                # a collapsed clade, with all its lineages in the open subset
+                mask = nd.leaf_lineage_mask
+                if is_log:
+                    prob = 0.0
+                    for desc in self._constrained_clades[nd]:
+                        prob -= desc.edge.length * good_sp_rate
+                else:
+                    prob = self.as_working_value_type(1.0)
+                    for desc in self._constrained_clades[nd]:
+                        prob *= self.as_working_value_type(math.exp(-desc.edge.length * good_sp_rate))
+                nd.tipward_part_map = part_map_pool.acquire()
+                nd.tipward_part_map[(mask,)] = prob
+                num_live_states += 1
+            else:
+                part_map = children[0].rootward_part_map
                 _del_part_maps(children[0])
                 constraints = getattr(nd, 'sp_constraints', None)
                 for c in children[1:]:
-                    _merge_into_first(nd.tipward_part_map, c.rootward_part_map)
-                    _del_part_maps(c)
+                    num_merged_states = len(part_map) + len(c.rootward_part_map)
+                    merge_constraints = None
+                    constraint_index = None
                     if constraints is not None:
-                        _enforce_constraints(nd.tipward_part_map, constraints)
+                        merge_constraints = _compile_merge_constraints(nd.sp_constraint_index,
+                                part_map, c.rootward_part_map)
+                        if merge_constraints is None:
+                            constraint_index = nd.sp_constraint_index
+                    merged_part_map = part_map_pool.acquire()
+                    if c is children[-1] and self.partition_beam_epsilon is None:
+                        # the last merge is written straight into the map
+                        # through the edge, unless it is to be pruned first
+                        if is_log:
+                            _log_merge_close_part_maps(part_map, c.rootward_part_map, merged_part_map,
+                                    remain_open_prob, close_prob, merge_constraints, constraint_index)
+                        else:
+                            _merge_close_part_maps(part_map, c.rootward_part_map, merged_part_map,
+                                    remain_open_prob, close_prob, merge_constraints, constraint_index)
+                        is_closed = True
+                    elif is_log:
+                        _log_merge_part_maps(part_map, c.rootward_part_map, merged_part_map,
+                                merge_constraints, constraint_index)
+                    else:
+                        _merge_part_maps(part_map, c.rootward_part_map, merged_part_map,
+                                merge_constraints, constraint_index)
+                    # the maps merged are held until the merge is complete
+                    peak_num_live_states = max(peak_num_live_states, num_live_states + len(merged_part_map))
+                    num_live_states += len(merged_part_map) - num_merged_states
+                    part_map_pool.release(part_map)
+                    part_map_pool.release(c.rootward_part_map)
+                    _del_part_maps(c)
+                    part_map = merged_part_map
+                if is_closed and nd is not self.seed_node:
+                    nd.rootward_part_map = part_map
+                    continue
+                nd.tipward_part_map = part_map
+                if self.partition_beam_epsilon is not None:
+                    # as the probabilities of the partitions of the lineages
+                    # of any subtree sum to no more than 1, those of all the
+                    # partitions dropped sum to no more than those dropped
+                    num_states = len(nd.tipward_part_map)
+                    pruned_prob += _prune_part_map(nd.tipward_part_map, self.partition_beam_epsilon, is_log)
+                    num_live_states -= num_states - len(nd.tipward_part_map)
             if nd is self.seed_node:
                 break
-            c_brlen = nd.edge.length
-            scaled_brlen = c_brlen * good_sp_rate
-            prob_no_sp = self.as_working_value_type(math.exp(-scaled_brlen))
-            nd.rootward_part_map = _create_closed_map(nd.tipward_part_map,
-                                                      prob_no_sp,
-                                                      self.as_working_value_type,
-                                                      getattr(nd, 'speciation_allowed', True))
-        final_part_map = defaultdict(lambda:self.as_working_value_type(0.0))
+            if is_log:
+                nd.rootward_part_map = _log_close_part_map(nd.tipward_part_map,
+                                                           part_map_pool.acquire(),
+                                                           remain_open_prob,
+                                                           close_prob)
+            else:
+                nd.rootward_part_map = _close_part_map(nd.tipward_part_map,
+                                                       part_map_pool.acquire(),
+                                                       remain_open_prob,
+                                                       close_prob)
+            peak_num_live_states = max(peak_num_live_states, num_live_states + len(nd.rootward_part_map))
+            num_live_states += len(nd.rootward_part_map) - len(nd.tipward_part_map)
+            # the map through the edge is all that is needed from here on
+            part_map_pool.release(nd.tipward_part_map)
+            del nd.tipward_part_map
+        self.peak_num_live_partition_states = max(peak_num_live_states, num_live_states)
+        self.num_partition_maps_allocated = part_map_pool.num_maps_allocated
+        self.pruned_partition_probability = pruned_prob if self.partition_beam_epsilon is not None else None
+        final_part_map = _PartitionProbabilityMap(self.as_working_value_type(0.0))
         # use lookup key as key
-        for part, prob in self.seed_node.tipward_part_map.items():
-            k = part.create_closed() if part.is_open else part
-            final_part_map[k.lookup_key()] += prob
-        # if self.is_use_decimal_value_type:
-        #     for part in final_part_map:
-        #         final_part_map[part] = float(final_part_map[part])
+        if is_closed:
+            closed_part_map = self.seed_node.tipward_part_map
+        else:
+            closed_part_map = {}
+            for part, prob in self.seed_node.tipward_part_map.items():
+                if part[0]:
+                    part = _bitmask_partition_closed(part)
+                if part not in closed_part_map:
+                    closed_part_map[part] = prob
+                elif is_log:
+                    closed_part_map[part] = _log_add(closed_part_map[part], prob)
+                else:
+                    closed_part_map[part] += prob
+        subset_label_sets = {}
+        for part, prob in closed_part_map.items():
+            if is_log:
+                prob = self._arithmetic.as_working_value(prob)
+            final_part_map[_bitmask_partition_lookup_key(part, leaf_labels, subset_label_sets)] = prob
         _del_part_maps(self.seed_node)
         return final_part_map
 
@@ -501,20 +1763,28 @@ class LineageTree(dendropy.Tree):
         """
         Calculates the marginal probability that there is a "good" species with the tip labels
         that correspond to the set `selected_tip_labels`.
+
+        The calculation is carried out on plain floats unless log-space
+        underflow protection is in effect, in which case it is carried out on
+        log probabilities, with the result returned in the working value type.
+        As with `calc_joint_probability_of_species()`, the speciation
+        completion rate may be a NumPy array of rates, giving an array of
+        probabilities.
         """
+        ar = self._get_marginal_arithmetic()
         num_sel = len(selected_tip_labels)
         sel_as_flag = SF.CA_FLAG if num_sel == 1 else SF.SEL_DES
-        total_prob = 0.0
+        total_prob = ar.zero
         for nd in self.postorder_node_iter():
             if nd.is_leaf():
                 if nd.taxon.label in selected_tip_labels:
                     nd.marginal_prob_calc["num_sel"] = 1
                     nd.marginal_prob_calc["anc_status"] = sel_as_flag
-                    nd.marginal_prob_calc["accum_prob"] = 1.0
+                    nd.marginal_prob_calc["accum_prob"] = ar.one
                 else:
                     nd.marginal_prob_calc["num_sel"] = 0
                     nd.marginal_prob_calc["anc_status"] = SF.UNSET
-                    nd.marginal_prob_calc["accum_prob"] = 0.0
+                    nd.marginal_prob_calc["accum_prob"] = ar.zero
             else:
                 nd.marginal_prob_calc["num_sel"] = 0
                 for c in nd.child_nodes():
@@ -525,29 +1795,718 @@ class LineageTree(dendropy.Tree):
                     nd.marginal_prob_calc["anc_status"] = SF.CA_FLAG
                 else:
                     nd.marginal_prob_calc["anc_status"] = SF.SEL_DES
-                total_prob += self._marginal_species_prob_accum_prob(nd, self._speciation_completion_rate)
-        total_prob += self.seed_node.marginal_prob_calc["accum_prob"]
-        return total_prob
+                total_prob = ar.add(total_prob, self._marginal_species_prob_accum_prob(nd, self._speciation_completion_rate, ar))
+        total_prob = ar.add(total_prob, self.seed_node.marginal_prob_calc["accum_prob"])
+        return ar.as_working_value(total_prob)
 
-    def _marginal_species_prob_accum_prob(self, nd, good_sp_rate):
+    def calc_clade_marginal_probabilities_of_species(self):
+        """
+        Calculates, for every node of the tree at once, the marginal
+        probability that the leaves descending from the node are exactly the
+        leaves of one "good" species (i.e., the probability given by
+        `calc_marginal_probability_of_species()` for the leaf set of the
+        node). Returns a dictionary mapping each node to its probability;
+        for a leaf node, this is the probability that its lineage is a
+        species on its own.
+
+        The lineage at a node belongs to a species made up of exactly the
+        leaves of its subtree if it is connected (i.e., without a speciation
+        event in between) to all of the leaves of its subtree, and to none
+        of the leaves outside of its subtree. The first is calculated for
+        all nodes in a postorder pass, and the second in a preorder pass, so
+        the calculation is linear in the size of the tree overall.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        ar = self._get_marginal_arithmetic()
+        edge_probs = {}
+        prob_all_connected = {}
+        # probability that a node is not connected to any of the leaves
+        # of its subtree through the edge subtending it
+        prob_none_connected_through_edge = {}
+        for nd in self.postorder_node_iter():
+            prob_all_connected[nd] = ar.one
+            if nd.is_leaf():
+                prob_none_connected = ar.zero
+            else:
+                prob_none_connected = ar.one
+                for c in nd.child_nodes():
+                    prob_no_sp = edge_probs[c][0]
+                    prob_all_connected[nd] = ar.mul(prob_all_connected[nd], ar.mul(prob_no_sp, prob_all_connected[c]))
+                    prob_none_connected = ar.mul(prob_none_connected, prob_none_connected_through_edge[c])
+            if nd is not self.seed_node:
+                prob_no_sp, prob_sp = ar.edge_probs(nd.edge.length, self._speciation_completion_rate)
+                edge_probs[nd] = (prob_no_sp, prob_sp)
+                prob_none_connected_through_edge[nd] = ar.add(prob_sp, ar.mul(prob_no_sp, prob_none_connected))
+        # probability that a node is not connected to any of the leaves
+        # outside of its subtree
+        prob_isolated = {self.seed_node: ar.one}
+        clade_probs = {}
+        for nd in self.preorder_node_iter():
+            clade_probs[nd] = ar.as_working_value(ar.mul(prob_all_connected[nd], prob_isolated[nd]))
+            children = nd.child_nodes()
+            if not children:
+                continue
+            # products over the siblings preceding and following each child
+            suffix_probs = [ar.one]
+            for c in reversed(children[1:]):
+                suffix_probs.append(ar.mul(suffix_probs[-1], prob_none_connected_through_edge[c]))
+            suffix_probs.reverse()
+            prefix_prob = prob_isolated[nd]
+            for c, suffix_prob in zip(children, suffix_probs):
+                prob_no_sp, prob_sp = edge_probs[c]
+                prob_isolated[c] = ar.add(prob_sp, ar.mul(prob_no_sp, ar.mul(prefix_prob, suffix_prob)))
+                prefix_prob = ar.mul(prefix_prob, prob_none_connected_through_edge[c])
+        return clade_probs
+
+    def _get_marginal_arithmetic(self):
+        if self.is_use_log_value_type or (np is not None and isinstance(self._speciation_completion_rate, np.ndarray)):
+            return self._get_arithmetic(self._speciation_completion_rate)
+        return _FLOAT_ARITHMETIC
+
+    def _marginal_species_prob_accum_prob(self, nd, good_sp_rate, ar):
         """
         Fills in the accum_prob slot for nd, and returns any contribution to
         the probability of the selected taxa being a good species.
         """
-        ap = 1.0
-        ret = 0.0
+        ap = ar.one
+        ret = ar.zero
         for child in nd.child_nodes():
-            c_brlen = child.edge.length
-            scaled_brlen = c_brlen * good_sp_rate
-            prob_no_sp = math.exp(-scaled_brlen)
-            prob_sp = 1.0 - prob_no_sp
+            prob_no_sp, prob_sp = ar.edge_probs(child.edge.length, good_sp_rate)
             if child.marginal_prob_calc["anc_status"] & SF.SEL_DES:
                 if child.marginal_prob_calc["anc_status"] & SF.CA_BIT:
-                    ret = prob_sp * child.marginal_prob_calc["accum_prob"]
-                contrib = prob_no_sp * child.marginal_prob_calc["accum_prob"]
+                    ret = ar.mul(prob_sp, child.marginal_prob_calc["accum_prob"])
+                contrib = ar.mul(prob_no_sp, child.marginal_prob_calc["accum_prob"])
             else:
-                contrib = prob_sp + prob_no_sp * child.marginal_prob_calc["accum_prob"]
-            ap *= contrib
+                contrib = ar.add(prob_sp, ar.mul(prob_no_sp, child.marginal_prob_calc["accum_prob"]))
+            ap = ar.mul(ap, contrib)
         nd.marginal_prob_calc["accum_prob"] = ap
         return ret
 
+    ################################################################################
+    ## Maximum Probability Partition
+
+    def calc_max_probability_partition(self):
+        """
+        Finds the partition of the lineages into species with the highest
+        probability (of those consistent with the species constraints set on
+        the tree by `set_node_constraints()`, if any), without enumerating
+        partitions. Returns a tuple of the partition, as a lookup key (see
+        `_Partition.compile_lookup_key()`), and its probability in the
+        working value type.
+
+        The probability of a partition is a sum over the speciation events
+        that produce it, so the partition is found by maximizing over the
+        states of the partitions of the subtrees, with the sums taken within
+        them, rather than over individual speciation events. Each node keeps
+        the best partition of its subtree with a species crossing it (i.e.,
+        to be joined by lineages outside of the subtree), for each species
+        constraint that the crossing species may be under, and the possibly
+        best partitions with only complete species (see
+        `_prune_partition_value_points()`). The best partition is then
+        traced back from the root.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        crossing_values, complete_values = self._calc_max_partition_inside_values()[:2]
+        root_points = complete_values[self.seed_node]
+        if not root_points:
+            raise ValueError("Species constraints have zero probability")
+        point_idx = max(range(len(root_points)), key=lambda idx: _log_add(root_points[idx][0], root_points[idx][1]))
+        log_prob = _log_add(root_points[point_idx][0], root_points[point_idx][1])
+        # trace back
+        species_leafsets = []
+        to_visit = [(self.seed_node, ("complete", point_idx), None)]
+        while to_visit:
+            nd, choice, crossing_leafset = to_visit.pop()
+            if choice[0] == "crossing":
+                choices = crossing_values[nd][choice[1]][1]
+            else:
+                choices = complete_values[nd][choice[1]][2]
+                if not nd.is_leaf() and choices[0] == "close":
+                    crossing_leafset = []
+                    species_leafsets.append(crossing_leafset)
+                choices = choices[1:]
+            if nd.is_leaf():
+                if crossing_leafset is None:
+                    species_leafsets.append([nd.taxon.label])
+                else:
+                    crossing_leafset.append(nd.taxon.label)
+                continue
+            for c, c_choice in zip(nd.child_nodes(), choices):
+                to_visit.append((c, c_choice, crossing_leafset if c_choice[0] == "crossing" else None))
+        partition = _Partition.compile_lookup_key(species_leafsets)
+        return partition, self._log_as_working_value(log_prob)
+
+    def _calc_max_partition_inside_values(self):
+        """
+        Returns, for each node, the log probabilities (with the choices made
+        for each child: the crossing species, or the index of the complete
+        partition point) of the best partitions of the lineages below it
+        with a crossing species, by species constraint, and the points of
+        the possibly best partitions with only complete species, and, for
+        each node other than the root, both through the edge subtending it.
+        """
+        partial_species = self._calc_species_states()[1]
+        crossing_values = {}
+        complete_values = {}
+        edge_values = {}
+        for nd in self.postorder_node_iter():
+            is_speciation_allowed = getattr(nd, "speciation_allowed", True)
+            if nd.is_leaf():
+                crossing_values[nd] = {getattr(nd, "known_tipward_sp", None): (0.0, ())}
+                complete_values[nd] = [(0.0, _NEG_INF, ())] if is_speciation_allowed else []
+            else:
+                values = _EMPTY_MAX_PARTITION_VALUES
+                for c in nd.child_nodes():
+                    values = _fold_max_partition_values(values, *edge_values[c])
+                union_points, crossing = values[:2]
+                nd_partial_species = partial_species[nd]
+                crossing_values[nd] = dict((sp, v) for sp, v in crossing.items()
+                        if not nd_partial_species or (len(nd_partial_species) == 1 and sp == nd_partial_species[0]))
+                if is_speciation_allowed:
+                    points = [(o, e, ("union",) + choices) for o, e, choices in union_points]
+                    if crossing:
+                        v, choices = max(crossing.values(), key=lambda x: x[0])
+                        points.append((v, _NEG_INF, ("close",) + choices))
+                    complete_values[nd] = _prune_partition_value_points(points)
+                else:
+                    complete_values[nd] = []
+            if nd is self.seed_node:
+                break
+            log_prob_no_sp, log_prob_sp = _LOG_ARITHMETIC.edge_probs(nd.edge.length, self._speciation_completion_rate)
+            edge_values[nd] = (
+                    [(log_prob_no_sp + o, _log_add(e, log_prob_sp + o), ("complete", idx))
+                        for idx, (o, e, _) in enumerate(complete_values[nd])],
+                    dict((sp, (log_prob_no_sp + v, ("crossing", sp)))
+                        for sp, (v, _) in crossing_values[nd].items()),
+                    )
+        return crossing_values, complete_values, edge_values
+
+    def _calc_max_partition_outside_bounds(self, crossing_values, edge_values):
+        """
+        Returns, for each node other than the root, upper bounds on the
+        factor by which the probability of any partition of the lineages
+        below it (through the edge subtending it) is multiplied, over all
+        the partitions of the rest of the lineages, as log probabilities:
+        when the parent node is not connected to any of its species, when it
+        is connected to one that is complete, and when it is joined by a
+        crossing species, by species constraint.
+
+        The bounds are found by maximizing over the partitions of the rest of
+        the tree in a preorder pass, as in
+        `calc_max_probability_partition()`, but with each node keeping only
+        the greatest factors of being connected and of being unconnected to a
+        complete species, separately.
+        """
+        root = self.seed_node
+        # greatest factors of the node being connected to a complete species,
+        # being connected to none, and being connected to a crossing species
+        open_factors = {root: 0.0}
+        empty_factors = {root: 0.0}
+        crossing_factors = {root: dict((sp, 0.0 if getattr(root, "speciation_allowed", True) else _NEG_INF)
+                for sp in crossing_values[root])}
+        bounds = {}
+        for nd in self.preorder_node_iter():
+            children = nd.child_nodes()
+            nd_open_factor = open_factors[nd]
+            nd_empty_factor = empty_factors[nd]
+            nd_crossing_factors = crossing_factors[nd]
+            def _crossing_factor(sp):
+                # a species that cannot cross the node can still be closed at it
+                return nd_crossing_factors.get(sp, nd_open_factor)
+            for c in children:
+                values = _EMPTY_MAX_PARTITION_VALUES
+                for sib in children:
+                    if sib is not c:
+                        values = _fold_max_partition_values(values, *edge_values[sib])
+                sib_points, sib_crossing, sib_no_crossing = values
+                sib_no_crossing = _NEG_INF if sib_no_crossing is None else sib_no_crossing[0]
+                empty_bound = max([_log_add(nd_open_factor + o, nd_empty_factor + e) for o, e, _ in sib_points]
+                        + [_crossing_factor(sp) + v for sp, (v, _) in sib_crossing.items()])
+                open_bound = nd_open_factor + sib_no_crossing
+                crossing_bounds = {}
+                for c_sp in edge_values[c][1]:
+                    crossing_bound = sib_no_crossing + _crossing_factor(c_sp)
+                    for sp, (v, _) in sib_crossing.items():
+                        merged_sp = _merge_species_states(sp, c_sp)
+                        if merged_sp is not False:
+                            crossing_bound = max(crossing_bound, v + _crossing_factor(merged_sp))
+                    crossing_bounds[c_sp] = crossing_bound
+                bounds[c] = (empty_bound, open_bound, crossing_bounds)
+                log_prob_no_sp, log_prob_sp = _LOG_ARITHMETIC.edge_probs(c.edge.length, self._speciation_completion_rate)
+                if getattr(c, "speciation_allowed", True):
+                    open_factors[c] = _log_add(log_prob_no_sp + open_bound, log_prob_sp + empty_bound)
+                    empty_factors[c] = empty_bound
+                else:
+                    open_factors[c] = _NEG_INF
+                    empty_factors[c] = _NEG_INF
+                crossing_factors[c] = dict((sp, max(open_factors[c], log_prob_no_sp + crossing_bounds.get(sp, _NEG_INF)))
+                        for sp in crossing_values[c])
+        return bounds
+
+    ################################################################################
+    ## Partitions in Order of Probability
+
+    def iter_label_partition_probabilities(self, min_probability=None):
+        """
+        Yields the partitions of the lineages into species (consistent with
+        the species constraints set on the tree by `set_node_constraints()`,
+        if any), as tuples of the partition, as a lookup key (see
+        `_Partition.compile_lookup_key()`), and its probability in the
+        working value type, in decreasing order of probability, down to (and
+        including) `min_probability`, if given. Partitions with zero
+        probability are not yielded.
+
+        Partitions are enumerated lazily, in rounds with successively lower
+        thresholds, starting at a tenth of the probability of the best
+        partition, each aimed at about twice as many partitions as the last,
+        until the remaining partitions run out or fall below
+        `min_probability`. In each round, the partitions of the lineages of
+        each subtree that cannot be part of any partition above the
+        threshold, by the upper bounds of
+        `_calc_max_partition_outside_bounds()`, are dropped as soon as they
+        are formed (or not formed at all), so the work done is proportional
+        to the number of partitions above the threshold rather than to all
+        of them.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        crossing_values, complete_values, edge_values = self._calc_max_partition_inside_values()
+        root_points = complete_values[self.seed_node]
+        if not root_points:
+            raise ValueError("Species constraints have zero probability")
+        max_log_prob = max(_log_add(o, e) for o, e, _ in root_points)
+        outside_bounds = self._calc_max_partition_outside_bounds(crossing_values, edge_values)
+        if min_probability is None:
+            min_log_prob = _NEG_INF
+        else:
+            min_log_prob = _FLOAT_ARITHMETIC.as_log(min_probability)
+        # no partition with nonzero probability is less probable than the
+        # least probable speciation history that is possible, so a threshold
+        # below that (with room for rounding) enumerates all of them
+        min_nonzero_log_prob = -1.0
+        for nd in self.postorder_node_iter():
+            if nd is self.seed_node:
+                break
+            min_nonzero_log_prob += min(log_prob
+                    for log_prob in _LOG_ARITHMETIC.edge_probs(nd.edge.length, self._speciation_completion_rate)
+                    if log_prob > _NEG_INF)
+        reported = set()
+        prev_log_ratio = 0.0
+        prev_num_reported = 1
+        log_ratio = _PARTITION_ENUMERATION_LOG_RATIO
+        while True:
+            log_threshold = max(max_log_prob - log_ratio, min_log_prob, min_nonzero_log_prob)
+            log_probs, is_exhaustive = self._calc_label_partition_log_probs_above(log_threshold, outside_bounds)
+            log_probs = sorted(((k, v) for k, v in log_probs.items() if k not in reported),
+                    key=lambda x: x[1],
+                    reverse=True)
+            for key, log_prob in log_probs:
+                reported.add(key)
+                yield key, self._log_as_working_value(log_prob)
+            if is_exhaustive or log_threshold <= max(min_log_prob, min_nonzero_log_prob):
+                return
+            # aim the next round at about twice as many partitions, supposing
+            # that their number grows exponentially as the threshold is
+            # lowered, but lower it no more than twice as far
+            if len(reported) > prev_num_reported:
+                step = (log_ratio - prev_log_ratio) * math.log(2) / math.log(len(reported) / prev_num_reported)
+                step = min(step, log_ratio)
+            else:
+                step = log_ratio
+            prev_log_ratio = log_ratio
+            prev_num_reported = len(reported)
+            log_ratio += step
+
+    def _calc_label_partition_log_probs_above(self, log_threshold, outside_bounds):
+        """
+        Returns the log probabilities of all the partitions with a log
+        probability no less than `log_threshold`, by lookup key, and whether
+        these are all the partitions with nonzero probability.
+        """
+        leaf_labels, leaf_label_bit_map = self._index_leaf_labels()
+        leaf_species = dict((leaf_label_bit_map[nd.taxon.label], getattr(nd, "known_tipward_sp", None))
+                for nd in self.leaf_node_iter())
+        subset_species = {}
+        def _get_subset_species(subset):
+            # the species constraint of the lineages in the subset, or False if
+            # they are under different constraints
+            try:
+                return subset_species[subset]
+            except KeyError:
+                pass
+            sp = None
+            mask = subset
+            while mask:
+                low_bit = mask & -mask
+                sp = _merge_species_states(sp, leaf_species[low_bit])
+                if sp is False:
+                    break
+                mask ^= low_bit
+            subset_species[subset] = sp
+            return sp
+        is_exhaustive = True
+        # greatest total probability of a group of partitions (see
+        # `_log_group_part_map()`) of each node, through the edge subtending it
+        max_group_log_probs = {}
+        for nd in self.postorder_node_iter():
+            if nd.is_leaf():
+                nd.tipward_part_map = {(leaf_label_bit_map[nd.taxon.label],): 0.0}
+            else:
+                children = nd.child_nodes()
+                if nd is self.seed_node:
+                    log_factor = 0.0
+                else:
+                    # greatest factor for any partition of the node
+                    log_prob_no_sp = -nd.edge.length * self._speciation_completion_rate
+                    empty_bound, open_bound, crossing_bounds = outside_bounds[nd]
+                    log_factor = max([empty_bound, log_prob_no_sp + open_bound]
+                            + [log_prob_no_sp + bound for bound in crossing_bounds.values()])
+                nd.tipward_part_map = children[0].rootward_part_map
+                _del_part_maps(children[0])
+                constraints = getattr(nd, 'sp_constraints', None)
+                for c_idx, c in enumerate(children[1:], 1):
+                    log_min_prob = log_threshold - _PARTITION_BOUND_LOG_TOLERANCE - log_factor
+                    for other_c in children[c_idx+1:]:
+                        log_min_prob -= max_group_log_probs[other_c]
+                    merge_constraints = None
+                    constraint_index = None
+                    if constraints is not None:
+                        merge_constraints = _compile_merge_constraints(nd.sp_constraint_index,
+                                nd.tipward_part_map, c.rootward_part_map)
+                        if merge_constraints is None:
+                            constraint_index = nd.sp_constraint_index
+                    if _log_bounded_merge_into_first(nd.tipward_part_map, c.rootward_part_map, log_min_prob,
+                            merge_constraints, constraint_index):
+                        is_exhaustive = False
+                    _del_part_maps(c)
+            if nd is self.seed_node:
+                break
+            scaled_brlen = nd.edge.length * self._speciation_completion_rate
+            nd.rootward_part_map = _log_close_part_map(nd.tipward_part_map,
+                                                       {},
+                                                       -scaled_brlen,
+                                                       _log_prob_sp(scaled_brlen) if getattr(nd, 'speciation_allowed', True) else None)
+            # bound the probability of the partitions that each group of
+            # partitions of the lineages below the node can be part of
+            empty_bound, open_bound, crossing_bounds = outside_bounds[nd]
+            part_bounds = {}
+            part_log_probs = {}
+            for part, prob in nd.rootward_part_map.items():
+                if part[0]:
+                    bound = max(open_bound, crossing_bounds.get(_get_subset_species(part[0]), _NEG_INF))
+                    closed_part = _bitmask_partition_closed(part)
+                else:
+                    bound = empty_bound
+                    closed_part = part
+                part_bounds[closed_part] = _log_add(part_bounds.get(closed_part, _NEG_INF), prob + bound)
+                part_log_probs[closed_part] = _log_add(part_log_probs.get(closed_part, _NEG_INF), prob)
+            to_del = []
+            for part in nd.rootward_part_map:
+                closed_part = _bitmask_partition_closed(part) if part[0] else part
+                bound = part_bounds[closed_part]
+                if bound < log_threshold - _PARTITION_BOUND_LOG_TOLERANCE:
+                    to_del.append(part)
+                    if bound > _NEG_INF:
+                        is_exhaustive = False
+            for part in to_del:
+                del nd.rootward_part_map[part]
+            max_group_log_probs[nd] = max((prob for closed_part, prob in part_log_probs.items()
+                    if part_bounds[closed_part] >= log_threshold - _PARTITION_BOUND_LOG_TOLERANCE), default=_NEG_INF)
+        closed_part_map = {}
+        for part, prob in self.seed_node.tipward_part_map.items():
+            if part[0]:
+                part = _bitmask_partition_closed(part)
+            closed_part_map[part] = _log_add(closed_part_map.get(part, _NEG_INF), prob)
+        _del_part_maps(self.seed_node)
+        log_probs = {}
+        subset_label_sets = {}
+        for part, prob in closed_part_map.items():
+            if prob >= log_threshold and prob > _NEG_INF:
+                log_probs[_bitmask_partition_lookup_key(part, leaf_labels, subset_label_sets)] = prob
+            elif prob > _NEG_INF:
+                is_exhaustive = False
+        return log_probs, is_exhaustive
+
+    ################################################################################
+    ## Sampling Partitions
+
+    def sample_label_partitions(self, num_samples, rng=None):
+        """
+        Draws `num_samples` independent samples from the distribution of the
+        partitions of the lineages into species (conditional on the species
+        constraints set on the tree by `set_node_constraints()`, if any).
+        Returns a list of the partitions, as lookup keys (see
+        `_Partition.compile_lookup_key()`). `rng` is the random number
+        generator to use (e.g., a seeded `random.Random` instance; the
+        `random` module by default).
+
+        No partitions are enumerated. The probabilities of the states of
+        each node given the subtree below it (see
+        `_calc_species_state_inside_probs()`) sum over all the partitions of
+        the subtree, so each sample is drawn exactly by stochastic traceback
+        from the root: the states at the top of the edges subtending the
+        children of each node are drawn given the state of the node, and
+        then whether there is a speciation event on each edge and the state
+        of the child, given the state at the top of the edge.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        if rng is None:
+            rng = random
+        node_states, partial_species = self._calc_species_states()
+        in_probs, _, _, edge_probs, through_edge_probs, _ = \
+                self._calc_species_state_inside_probs(node_states, partial_species)
+        # probabilities of the states of each node given the subtrees of
+        # each of the leading subsets of its children
+        prefix_probs = {}
+        for nd in self.postorder_node_iter():
+            if nd.is_leaf():
+                continue
+            probs = [{None: 1.0}]
+            for c in nd.child_nodes():
+                probs.append(_combine_species_state_probs(probs[-1], through_edge_probs[c]))
+            prefix_probs[nd] = probs
+        def _choose(weighted):
+            return rng.choices([x for x, _ in weighted], [w for _, w in weighted])[0]
+        root_states = list(in_probs[self.seed_node].items())
+        samples = []
+        for _ in range(num_samples):
+            species_leafsets = [[]]
+            to_visit = [(self.seed_node, _choose(root_states), species_leafsets[0])]
+            while to_visit:
+                nd, sp, leafset = to_visit.pop()
+                if nd.is_leaf():
+                    leafset.append(nd.taxon.label)
+                    continue
+                children = nd.child_nodes()
+                probs = prefix_probs[nd]
+                for c_idx in range(len(children) - 1, -1, -1):
+                    c = children[c_idx]
+                    if sp is None:
+                        candidates = [(None, None)]
+                    else:
+                        candidates = [(None, sp), (sp, None), (sp, sp)]
+                    sp, edge_sp = _choose([((rest_sp, c_sp), probs[c_idx].get(rest_sp, 0.0) * through_edge_probs[c].get(c_sp, 0.0))
+                            for rest_sp, c_sp in candidates])
+                    prob_no_sp, prob_sp = edge_probs[c]
+                    if edge_sp is None:
+                        # joined to the node without any constrained species,
+                        # or closed off by a speciation event on the edge
+                        choices = [((False, None), prob_no_sp * in_probs[c].get(None, 0.0))]
+                        choices.extend(((True, c_sp), prob_sp * prob) for c_sp, prob in in_probs[c].items()
+                                if c_sp not in partial_species[c])
+                        is_closed, c_sp = _choose(choices)
+                    else:
+                        is_closed, c_sp = False, edge_sp
+                    if is_closed:
+                        c_leafset = []
+                        species_leafsets.append(c_leafset)
+                    else:
+                        c_leafset = leafset
+                    to_visit.append((c, c_sp, c_leafset))
+            samples.append(_Partition.compile_lookup_key(leafset for leafset in species_leafsets if leafset))
+        return samples
+
+    ################################################################################
+    ## Conspecificity Probability
+
+    def calc_conspecificity_probability_matrix(self):
+        """
+        Calculates the marginal probability of each pair of lineages being
+        conspecific (i.e., belonging to the same species), conditional on the
+        species constraints set on the tree by `set_node_constraints()`, if
+        any. Returns an n x n NumPy array, with the lineages (rows and
+        columns) in the order of `leaf_node_iter()`.
+
+        No partitions are enumerated. Two lineages are conspecific if and
+        only if there is no speciation event on the path between them, so a
+        postorder pass builds, for each node and each lineage below it, the
+        probability of the lineage being connected to the node (by the state
+        of the node; see `_combine_species_state_probs()`), which are then
+        combined for all pairs of lineages at their common ancestor, with
+        the probability of the rest of the tree (from a preorder pass).
+        """
+        if np is None:
+            raise ImportError("NumPy is required for conspecificity probability matrices")
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        leaf_nodes = list(self.leaf_node_iter())
+        leaf_indexes = dict((nd, idx) for idx, nd in enumerate(leaf_nodes))
+        node_states, partial_species = self._calc_species_states()
+        in_probs, in_log_scales, in_log_norms, edge_probs, through_edge_probs, total_log_prob = \
+                self._calc_species_state_inside_probs(node_states, partial_species)
+        def _siblings_state_probs(children, excluded):
+            probs = {None: 1.0}
+            log_scale = 0.0
+            for c in children:
+                if c not in excluded:
+                    probs = _combine_species_state_probs(probs, through_edge_probs[c])
+                    log_scale += in_log_scales[c]
+            return probs, log_scale
+        # outside probabilities (of the rest of the tree given the state of
+        # the node), scaled
+        out_probs = {self.seed_node: dict((sp, 1.0) for sp in node_states[self.seed_node])}
+        out_log_scales = {self.seed_node: 0.0}
+        for nd in self.preorder_node_iter():
+            children = nd.child_nodes()
+            for c in children:
+                sib_probs, sib_log_scale = _siblings_state_probs(children, (c,))
+                prob_no_sp, prob_sp = edge_probs[c]
+                nd_out_probs = out_probs[nd]
+                rest_prob = sum(prob * nd_out_probs.get(sp, 0.0) for sp, prob in sib_probs.items())
+                probs = {}
+                for sp in node_states[c]:
+                    if sp is None:
+                        joined_prob = rest_prob
+                        closed_prob = rest_prob
+                    else:
+                        joined_prob = (sib_probs.get(None, 0.0) + sib_probs.get(sp, 0.0)) * nd_out_probs.get(sp, 0.0)
+                        closed_prob = 0.0 if sp in partial_species[c] else rest_prob
+                    probs[sp] = prob_sp * closed_prob + prob_no_sp * joined_prob
+                _mask_invalid_species_states(partial_species[c], probs)
+                out_log_scales[c] = out_log_scales[nd] + sib_log_scale + _normalize_species_state_probs(probs)
+                out_probs[c] = probs
+        # probabilities of each lineage below a node being connected to it,
+        # by the state of the node: rows are lineages, and columns states
+        conspecificity = np.zeros((len(leaf_nodes), len(leaf_nodes)))
+        path_probs = {}
+        for nd in self.postorder_node_iter():
+            if nd.is_leaf():
+                path_probs[nd] = ([leaf_indexes[nd]], np.array([[in_probs[nd].get(sp, 0.0) for sp in node_states[nd]]]))
+                continue
+            children = nd.child_nodes()
+            state_indexes = dict((sp, idx) for idx, sp in enumerate(node_states[nd]))
+            valid = dict((sp, 1.0) for sp in node_states[nd])
+            _mask_invalid_species_states(partial_species[nd], valid)
+            nd_out_probs = out_probs[nd]
+            log_scale = out_log_scales[nd] + sum(in_log_scales[c] for c in children) - total_log_prob
+            for c1_idx, c1 in enumerate(children):
+                for c2 in children[c1_idx+1:]:
+                    sib_probs, _ = _siblings_state_probs(children, (c1, c2))
+                    weights = np.zeros((len(node_states[c1]), len(node_states[c2])))
+                    for sp1_idx, sp1 in enumerate(node_states[c1]):
+                        for sp2_idx, sp2 in enumerate(node_states[c2]):
+                            joined = _merge_species_states(sp1, sp2)
+                            if joined is False:
+                                continue
+                            for sib_sp, sib_prob in sib_probs.items():
+                                sp = _merge_species_states(joined, sib_sp)
+                                if sp is not False:
+                                    weights[sp1_idx, sp2_idx] += sib_prob * valid[sp] * nd_out_probs.get(sp, 0.0)
+                    weights *= edge_probs[c1][0] * edge_probs[c2][0] * math.exp(log_scale)
+                    rows1, probs1 = path_probs[c1]
+                    rows2, probs2 = path_probs[c2]
+                    block = probs1.dot(weights).dot(probs2.T)
+                    conspecificity[np.ix_(rows1, rows2)] = block
+                    conspecificity[np.ix_(rows2, rows1)] = block.T
+            if nd is self.seed_node:
+                break
+            rows = []
+            probs = []
+            for c in children:
+                sib_probs, _ = _siblings_state_probs(children, (c,))
+                prob_no_sp = edge_probs[c][0]
+                transfer = np.zeros((len(node_states[c]), len(node_states[nd])))
+                for sp_idx, sp in enumerate(node_states[c]):
+                    if sp is None:
+                        for sib_sp, sib_prob in sib_probs.items():
+                            transfer[sp_idx, state_indexes[sib_sp]] += prob_no_sp * sib_prob * valid[sib_sp]
+                    else:
+                        transfer[sp_idx, state_indexes[sp]] = prob_no_sp * (sib_probs.get(None, 0.0) + sib_probs.get(sp, 0.0)) * valid[sp]
+                c_rows, c_probs = path_probs.pop(c)
+                rows.extend(c_rows)
+                probs.append(c_probs.dot(transfer) / math.exp(in_log_norms[nd]))
+            path_probs[nd] = (rows, np.vstack(probs))
+        np.clip(conspecificity, 0.0, 1.0, out=conspecificity)
+        np.fill_diagonal(conspecificity, 1.0)
+        return conspecificity
+
+    def calc_probability_of_constraints(self):
+        """
+        Calculates the total probability of all the partitions that are
+        consistent with the species constraints set on the tree by
+        `set_node_constraints()` (1 if there are none), without enumerating
+        them. Returns the probability in the working value type.
+        """
+        if self._speciation_completion_rate is None:
+            raise ValueError("Speciation completion rate not set")
+        def _calc():
+            node_states, partial_species = self._calc_species_states()
+            return self._calc_species_state_inside_probs(node_states, partial_species)[-1]
+        total_log_prob = self._get_cached_probability(
+                self._probability_cache_key("log_probability_of_constraints", self._node_constraints_key),
+                _calc)
+        return self._log_as_working_value(total_log_prob)
+
+    def _log_as_working_value(self, log_prob):
+        if self._underflow_protection is None:
+            return math.exp(log_prob)
+        return _LOG_ARITHMETIC.as_working_value(log_prob)
+
+    def _calc_species_states(self):
+        """
+        Returns, for each node, the list of its states (see
+        `_combine_species_state_probs()`), and the list of species that have
+        leaves both below and outside of it (and so to which it must be
+        connected).
+        """
+        # number of leaves of each species below each node
+        sp_counts = {}
+        for nd in self.postorder_node_iter():
+            if nd.is_leaf():
+                sp = getattr(nd, "known_tipward_sp", None)
+                sp_counts[nd] = {} if sp is None else {sp: 1}
+            else:
+                sp_counts[nd] = {}
+                for c in nd.child_nodes():
+                    for sp, count in sp_counts[c].items():
+                        sp_counts[nd][sp] = sp_counts[nd].get(sp, 0) + count
+        root_sp_counts = sp_counts[self.seed_node]
+        node_states = {}
+        partial_species = {}
+        for nd in self.postorder_node_iter():
+            node_states[nd] = [None] + list(sp_counts[nd])
+            partial_species[nd] = [sp for sp, count in sp_counts[nd].items() if count < root_sp_counts[sp]]
+        return node_states, partial_species
+
+    def _calc_species_state_inside_probs(self, node_states, partial_species):
+        """
+        Returns the (scaled) probabilities of the states of each node given
+        the subtree below it, with the logs of the scaling factors, the
+        edge probabilities, the probabilities of the states at the top of
+        each edge, and the log of the total probability of the constraints.
+        """
+        in_probs = {}
+        in_log_scales = {}
+        in_log_norms = {}
+        edge_probs = {}
+        through_edge_probs = {}
+        for nd in self.postorder_node_iter():
+            if nd.is_leaf():
+                probs = {getattr(nd, "known_tipward_sp", None): 1.0}
+                log_scale = 0.0
+            else:
+                probs = {None: 1.0}
+                log_scale = 0.0
+                for c in nd.child_nodes():
+                    probs = _combine_species_state_probs(probs, through_edge_probs[c])
+                    log_scale += in_log_scales[c]
+            _mask_invalid_species_states(partial_species[nd], probs)
+            in_log_norms[nd] = _normalize_species_state_probs(probs)
+            in_probs[nd] = probs
+            in_log_scales[nd] = log_scale + in_log_norms[nd]
+            if nd is self.seed_node:
+                break
+            prob_no_sp, prob_sp = _FLOAT_ARITHMETIC.edge_probs(nd.edge.length, self._speciation_completion_rate)
+            edge_probs[nd] = (prob_no_sp, prob_sp)
+            # a species can only be closed off if it is wholly below the node
+            through_probs = dict((sp, prob_no_sp * prob) for sp, prob in probs.items())
+            through_probs[None] = through_probs.get(None, 0.0) + prob_sp * sum(prob for sp, prob in probs.items() if sp not in partial_species[nd])
+            through_edge_probs[nd] = through_probs
+        total_prob = sum(in_probs[self.seed_node].values())
+        if total_prob <= 0.0:
+            raise ValueError("Species constraints have zero probability")
+        total_log_prob = in_log_scales[self.seed_node] + math.log(total_prob)
+        return in_probs, in_log_scales, in_log_norms, edge_probs, through_edge_probs, total_log_prob
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Compares the memory used in calculating the probabilities of all the
+partitions of the tips of a tree when the partition map of each node is
+copied and reallocated on every merge and closing (as was done before the
+maps were pooled) with that used by `LineageTree`, which writes the maps
+into maps released by other nodes, and writes the last merge of each node
+straight into the map through its edge.
+
+    python part_map_benchmark.py ../data/five_leaf.tre 0.02
+
+Each approach is run in a fresh process, once to find the increase in its
+peak resident set size, and once under `tracemalloc` to count the maps
+allocated and the peak traced memory.
+"""
+from __future__ import print_function
+from collections import defaultdict
+import copy
+import math
+import resource
+import subprocess
+import sys
+import tracemalloc
+from delineate import model
+
+PIPELINES = ("copying", "pooled")
+
+class _CountingDefaultDict(defaultdict):
+    num_allocated = 0
+
+    def __init__(self, *args):
+        _CountingDefaultDict.num_allocated += 1
+        defaultdict.__init__(self, *args)
+
+    def __copy__(self):
+        _CountingDefaultDict.num_allocated += 1
+        return _CountingDefaultDict(self.default_factory, self)
+
+def _copying_merge_into_first(src_and_dest_dict, second):
+    first = copy.copy(src_and_dest_dict)
+    src_and_dest_dict.clear()
+    for fpart, fprob in first.items():
+        for spart, sprob in second.items():
+            src_and_dest_dict[model._bitmask_partition_extension(fpart, spart)] += fprob * sprob
+
+def _copying_create_closed_map(map_with_open, remain_open_prob):
+    ret = _CountingDefaultDict(lambda: 0.0)
+    close_prob = 1.0 - remain_open_prob
+    for part, prob in map_with_open.items():
+        if part[0]:
+            ret[part] += prob * remain_open_prob
+            ret[model._bitmask_partition_closed(part)] += prob * close_prob
+        else:
+            ret[part] += prob
+    return ret
+
+def calc_copying(tree, rate):
+    leaf_labels, leaf_label_bit_map = tree._index_leaf_labels()
+    for nd in tree.postorder_node_iter():
+        if nd.is_leaf():
+            nd.tipward_part_map = _CountingDefaultDict(lambda: 0.0)
+            nd.tipward_part_map[(leaf_label_bit_map[nd.taxon.label],)] = 1.0
+        else:
+            children = nd.child_nodes()
+            nd.tipward_part_map = children[0].rootward_part_map
+            model._del_part_maps(children[0])
+            for c in children[1:]:
+                _copying_merge_into_first(nd.tipward_part_map, c.rootward_part_map)
+                model._del_part_maps(c)
+        if nd is tree.seed_node:
+            break
+        nd.rootward_part_map = _copying_create_closed_map(nd.tipward_part_map,
+                                                          math.exp(-nd.edge.length * rate))
+        del nd.tipward_part_map
+    final_part_map = defaultdict(lambda: 0.0)
+    closed_part_map = {}
+    for part, prob in tree.seed_node.tipward_part_map.items():
+        if part[0]:
+            part = model._bitmask_partition_closed(part)
+        closed_part_map[part] = closed_part_map.get(part, 0.0) + prob
+    subset_label_sets = {}
+    for part, prob in closed_part_map.items():
+        final_part_map[model._bitmask_partition_lookup_key(part, leaf_labels, subset_label_sets)] = prob
+    model._del_part_maps(tree.seed_node)
+    return len(final_part_map), _CountingDefaultDict.num_allocated
+
+def calc_pooled(tree, rate):
+    final_part_map = tree._calc_all_joint_sp_probs(rate)
+    return len(final_part_map), tree.num_partition_maps_allocated
+
+def run_pipeline(pipeline, filename, rate):
+    tree = model.LineageTree.get(path=filename, schema="newick")
+    calc_fn = calc_copying if pipeline == "copying" else calc_pooled
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    calc_fn(tree, rate)
+    rss_increase = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    _CountingDefaultDict.num_allocated = 0
+    tracemalloc.start()
+    num_partitions, num_maps = calc_fn(tree, rate)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # ru_maxrss is in kilobytes on Linux
+    print("{}\t{}\t{}\t{}".format(num_partitions, num_maps, traced_peak, rss_increase * 1024))
+
+def main(filename, rate):
+    print("pipeline\tpartitions\tmaps allocated\tpeak traced bytes\tpeak RSS increase (bytes)")
+    for pipeline in PIPELINES:
+        out = subprocess.check_output([sys.executable, __file__, "--pipeline", pipeline, filename, str(rate)])
+        fields = out.decode("utf-8").strip().split("\t")
+        print("\t".join([pipeline] + fields))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    pipeline = None
+    if args and args[0] == "--pipeline":
+        pipeline = args[1]
+        args = args[2:]
+    try:
+        filename = args[0]
+        rate = float(args[1])
+        assert rate > 0.0
+        assert pipeline is None or pipeline in PIPELINES
+    except:
+        sys.exit('''Expecting 2 args:
+    1. the filepath to a rooted newick tree with branch lengths, and
+    2. a rate of good speciation events (branch length multiplier).
+''')
+    if pipeline is None:
+        main(filename, rate)
+    else:
+        run_pipeline(pipeline, filename, rate)
@@ -4,9 +4,13 @@ import os
 import math
 import random
 import unittest
+from unittest import mock
 import json
+import decimal
+import numpy
 import dendropy
 from delineate import model
+from delineate import estimate
 if __name__ == "__main__":
     # For:
     #   python tests/test_probabilities.py
@@ -18,6 +22,35 @@ else:
     #   python -m unittest tests/test_probabilities.py
     from . import _pathmap
 
+def _iter_reference_trees():
+    # Yields each tree of the reference joint species probabilities, with the
+    # labels of its lineages in leaf order.
+    with open(os.path.join(_pathmap.TESTS_DATA_DIR, "joint_probability_of_species.json")) as src:
+        test_ref = json.load(src)
+    for test_tree_set in test_ref:
+        tree = model.LineageTree.get(
+                data=test_tree_set["tree"],
+                schema="newick",
+                taxon_namespace=dendropy.TaxonNamespace(test_tree_set["taxon_namespace"]),
+                )
+        labels = [nd.taxon.label for nd in tree.leaf_node_iter()]
+        yield tree, labels
+
+def _iter_constraint_cases(tree, labels, constraints=None):
+    # Yields None with the node constraints of `tree` cleared, and then each
+    # of `constraints` (by default, a partial partition of the first four
+    # lineages) with the node constraints set to it; the node constraints are
+    # cleared again at the end.
+    if constraints is None:
+        constraints = [[labels[:2], [labels[3]]]]
+    for species_leafset_labels in [None] + list(constraints):
+        if species_leafset_labels is None:
+            tree.clear_node_constraints()
+        else:
+            tree.set_node_constraints(model._Partition.compile_lookup_key(species_leafset_labels))
+        yield species_leafset_labels
+    tree.clear_node_constraints()
+
 class LineageTreeBasicMarginalSpeciesProbabilities(unittest.TestCase):
 
     # Expected results have been independently calculated by JS and MTH, manually
@@ -116,6 +149,21 @@ class LineageTreeMultiMarginalSpeciesProbabilities(unittest.TestCase):
                         obs_probability = tree.calc_marginal_probability_of_species(species_labels)
                         self.assertAlmostEqual(expected_probability, obs_probability, 8)
 
+class LineageTreeCladeMarginalSpeciesProbabilities(unittest.TestCase):
+
+    def test_probs(self):
+        for tree, _ in _iter_reference_trees():
+            for underflow_protection in (None, "log"):
+                tree.underflow_protection = underflow_protection
+                for speciation_rate in (0.01, 0.1, 1.0):
+                    tree.speciation_completion_rate = speciation_rate
+                    clade_probs = tree.calc_clade_marginal_probabilities_of_species()
+                    self.assertEqual(len(clade_probs), len(tree.nodes()))
+                    for nd in tree:
+                        selected_tip_labels = set(leaf.taxon.label for leaf in nd.leaf_iter())
+                        expected_probability = tree.calc_marginal_probability_of_species(selected_tip_labels)
+                        self.assertAlmostEqual(float(expected_probability), float(clade_probs[nd]), 12)
+
 class LineageTreeJointSpeciesProbabilities(unittest.TestCase):
 
     # Tests to see if changing the branch lengths and/or speciation rate will
@@ -197,6 +245,686 @@ class LineageTreeJointSpeciesProbabilitiesWithConstraints(unittest.TestCase):
                         self.assertAlmostEqual(tree.as_working_value_type(expected_probability), obs_probability, 8)
 
 
+class LineageTreeJointSpeciesProbabilitiesAgainstEnumeration(unittest.TestCase):
+
+    # The single-partition calculation should agree with the probabilities of
+    # the partitions as enumerated by the full partition probability map.
+    def test_probs(self):
+        for tree, labels in _iter_reference_trees():
+            for speciation_rate in (0.01, 0.1, 1.0):
+                tree.speciation_completion_rate = speciation_rate
+                partition_probability_map = tree.calc_label_partition_probability_map()
+                total_prob = 0.0
+                for species_leafset_labels, expected_probability in partition_probability_map.items():
+                    obs_probability = tree.calc_joint_probability_of_species(species_leafset_labels)
+                    self.assertAlmostEqual(expected_probability, obs_probability, 12)
+                    total_prob += obs_probability
+                self.assertAlmostEqual(total_prob, 1.0, 10)
+                self.assertEqual(tree.calc_joint_probability_of_species([labels[:-1]]), 0.0)
+                self.assertEqual(tree.calc_joint_probability_of_species([labels, labels[:1]]), 0.0)
+
+    # Partitions that break the node constraints are not in the map, and so
+    # should have a probability of 0.
+    def test_probs_with_constraints(self):
+        with open(os.path.join(_pathmap.TESTS_DATA_DIR, "joint_probability_of_species.json")) as src:
+            test_ref = json.load(src)
+        for test_tree_set in test_ref:
+            taxon_namespace = dendropy.TaxonNamespace(test_tree_set["taxon_namespace"])
+            tree = model.LineageTree.get(
+                    data=test_tree_set["tree"],
+                    schema="newick",
+                    taxon_namespace=taxon_namespace,
+                    )
+            tree.speciation_completion_rate = 0.1
+            all_partitions = list(tree.calc_label_partition_probability_map())
+            species_configurations = test_tree_set["branch_length_configurations"][0]["speciation_rate_configurations"][0]["species_configurations"]
+            for species_configuration in species_configurations[:4]:
+                species = species_configuration["species"]
+                # fully and partially specified constraints
+                for constrained_species in (species, [sp for sp in species if len(sp) > 1]):
+                    tree.set_node_constraints(species_leafset_labels=constrained_species)
+                    partition_probability_map = tree.calc_label_partition_probability_map()
+                    for species_leafset_labels in all_partitions:
+                        obs_probability = tree.calc_joint_probability_of_species(species_leafset_labels)
+                        self.assertAlmostEqual(partition_probability_map[species_leafset_labels], obs_probability, 12)
+            tree.clear_node_constraints()
+
+
+class LineageTreeLogSpaceProbabilities(unittest.TestCase):
+
+    def test_probs_against_float(self):
+        for tree, labels in _iter_reference_trees():
+            for speciation_rate in (0.01, 0.1, 1.0):
+                tree.underflow_protection = None
+                tree.speciation_completion_rate = speciation_rate
+                expected_map = tree.calc_label_partition_probability_map()
+                expected_marginals = [tree.calc_marginal_probability_of_species(labels[:i]) for i in range(1, len(labels)+1)]
+                tree.underflow_protection = "log"
+                tree.speciation_completion_rate = speciation_rate
+                obs_map = tree.calc_label_partition_probability_map()
+                self.assertEqual(set(expected_map), set(obs_map))
+                for species_leafset_labels, expected_probability in expected_map.items():
+                    self.assertAlmostEqual(expected_probability, float(obs_map[species_leafset_labels]), 12)
+                    obs_probability = tree.calc_joint_probability_of_species(species_leafset_labels)
+                    self.assertAlmostEqual(expected_probability, float(obs_probability), 12)
+                    obs_log_probability = tree.calc_joint_log_probability_of_species(species_leafset_labels)
+                    if expected_probability == 0:
+                        self.assertEqual(obs_log_probability, float("-inf"))
+                    else:
+                        self.assertAlmostEqual(math.log(expected_probability), obs_log_probability, 10)
+                for i, expected_probability in enumerate(expected_marginals):
+                    self.assertAlmostEqual(expected_probability,
+                            float(tree.calc_marginal_probability_of_species(labels[:i+1])), 12)
+
+    def test_underflow(self):
+        # All lineages form a single species if and only if there is no
+        # speciation event anywhere on the tree.
+        tree = model.LineageTree.get(
+                path=os.path.join(_pathmap.TESTS_DATA_DIR, "five_leaf.tre"),
+                schema="newick",
+                )
+        labels = [t.label for t in tree.taxon_namespace]
+        tree_length = tree.length()
+        tree.speciation_completion_rate = 2000.0 / tree_length
+        self.assertEqual(tree.calc_joint_probability_of_species([labels]), 0.0)
+        tree.underflow_protection = "log"
+        self.assertAlmostEqual(tree.calc_joint_log_probability_of_species([labels]), -2000.0, 8)
+        prob = tree.calc_joint_probability_of_species([labels])
+        self.assertGreater(prob, 0)
+        self.assertAlmostEqual(float(prob.ln()), -2000.0, 8)
+        partition_probability_map = tree.calc_label_partition_probability_map()
+        self.assertEqual(partition_probability_map[model._Partition.compile_lookup_key([labels])], prob)
+
+
+class LineageTreeSpeciationRateProfile(unittest.TestCase):
+
+    def test_profile(self):
+        speciation_rates = numpy.array([0.001, 0.01, 0.1, 1.0, 10.0])
+        for tree, _ in _iter_reference_trees():
+            tree.speciation_completion_rate = 0.1
+            partitions = list(tree.calc_label_partition_probability_map())
+            for underflow_protection in (None, "log", "decimal"):
+                tree.underflow_protection = underflow_protection
+                for species_leafset_labels in partitions:
+                    selected_tip_labels = max(species_leafset_labels, key=len)
+                    tree.speciation_completion_rate = speciation_rates
+                    obs_lnls = tree.calc_joint_log_probability_of_species(species_leafset_labels)
+                    obs_marginals = tree.calc_marginal_probability_of_species(selected_tip_labels)
+                    self.assertEqual(obs_lnls.shape, speciation_rates.shape)
+                    for speciation_rate, obs_lnl, obs_marginal in zip(speciation_rates, obs_lnls, obs_marginals):
+                        tree.speciation_completion_rate = float(speciation_rate)
+                        self.assertAlmostEqual(tree.calc_joint_log_probability_of_species(species_leafset_labels), obs_lnl, 10)
+                        self.assertAlmostEqual(float(tree.calc_marginal_probability_of_species(selected_tip_labels)), obs_marginal, 12)
+
+    def test_warm_start(self):
+        tree = model.LineageTree.get(
+                path=os.path.join(_pathmap.TESTS_DATA_DIR, "five_leaf.tre"),
+                schema="newick",
+                )
+        labels = sorted(t.label for t in tree.taxon_namespace)
+        species_leafset_labels = model._Partition.compile_lookup_key([labels[:2], labels[2:]])
+        mle = estimate.SpeciationCompletionRateMaximumLikelihoodEstimator(
+                tree=tree,
+                species_leafset_labels=species_leafset_labels,
+                initial_speciation_rate=0.01,
+                min_speciation_rate=1e-8,
+                max_speciation_rate=100.0)
+        expected_rate, expected_lnl = mle.estimate_speciation_rate()
+        speciation_rates = mle.compose_speciation_rate_grid(50)
+        lnls = mle.calc_speciation_rate_profile(speciation_rates)
+        self.assertTrue(max(lnls) <= expected_lnl + 1e-8)
+        obs_rate, obs_lnl = mle.estimate_speciation_rate(profile=(speciation_rates, lnls))
+        self.assertAlmostEqual(expected_lnl, obs_lnl, 6)
+        self.assertAlmostEqual(expected_rate, obs_rate, 3)
+
+class LineageTreeJointProbabilityDerivatives(unittest.TestCase):
+
+    def test_derivatives(self):
+        for tree, _ in _iter_reference_trees():
+            tree.underflow_protection = "log"
+            tree.speciation_completion_rate = 0.1
+            partitions = [k for k, v in tree.calc_label_partition_probability_map().items() if v > 0]
+            for species_leafset_labels in partitions:
+                def lnl(speciation_rate):
+                    tree.speciation_completion_rate = speciation_rate
+                    return tree.calc_joint_log_probability_of_species(species_leafset_labels)
+                for speciation_rate in (0.01, 0.1, 1.0):
+                    h = speciation_rate * 1e-4
+                    tree.speciation_completion_rate = speciation_rate
+                    obs_lnl, obs_d1, obs_d2 = tree.calc_joint_log_probability_of_species_derivatives(species_leafset_labels)
+                    self.assertAlmostEqual(lnl(speciation_rate), obs_lnl, 10)
+                    expected_d1 = (lnl(speciation_rate + h) - lnl(speciation_rate - h)) / (2 * h)
+                    expected_d2 = (lnl(speciation_rate + h) - 2 * lnl(speciation_rate) + lnl(speciation_rate - h)) / (h * h)
+                    self.assertAlmostEqual(expected_d1, obs_d1, delta=1e-5 * max(1.0, abs(obs_d1)))
+                    self.assertAlmostEqual(expected_d2, obs_d2, delta=1e-3 * max(1.0, abs(obs_d2)))
+
+    def test_newton_estimate(self):
+        tree = model.LineageTree.get(
+                path=os.path.join(_pathmap.TESTS_DATA_DIR, "five_leaf.tre"),
+                schema="newick",
+                )
+        labels = sorted(t.label for t in tree.taxon_namespace)
+        species_leafset_labels = model._Partition.compile_lookup_key([labels[:2], labels[2:]])
+        mle = estimate.SpeciationCompletionRateMaximumLikelihoodEstimator(
+                tree=tree,
+                species_leafset_labels=species_leafset_labels,
+                initial_speciation_rate=0.01,
+                min_speciation_rate=1e-8,
+                max_speciation_rate=100.0)
+        expected_rate, expected_lnl = mle.estimate_speciation_rate()
+        obs_rate, obs_lnl = mle.estimate_speciation_rate(method="newton")
+        self.assertAlmostEqual(expected_lnl, obs_lnl, 6)
+        self.assertAlmostEqual(expected_rate, obs_rate, 3)
+        tree.speciation_completion_rate = obs_rate
+        _, d1, _ = tree.calc_joint_log_probability_of_species_derivatives(species_leafset_labels)
+        self.assertAlmostEqual(d1, 0.0, 5)
+        self.assertGreater(mle.estimate_standard_error(obs_rate), 0.0)
+
+class LineageTreeConspecificityProbabilities(unittest.TestCase):
+
+    def test_probs_against_enumeration(self):
+        for tree, labels in _iter_reference_trees():
+            tree.speciation_completion_rate = 0.5
+            constraints = []
+            for species_leafset_labels, prob in tree.calc_label_partition_probability_map().items():
+                if prob > 0 and len(species_leafset_labels) > 1:
+                    # constrain all but the last lineage to this partition
+                    constraints.append([sp - {labels[-1]} for sp in species_leafset_labels if sp - {labels[-1]}])
+                    break
+            for species_leafset_labels in _iter_constraint_cases(tree, labels, constraints):
+                partition_probability_map = tree.calc_label_partition_probability_map()
+                total_prob = sum(partition_probability_map.values())
+                expected = numpy.zeros((len(labels), len(labels)))
+                for partition, prob in partition_probability_map.items():
+                    for sp in partition:
+                        for label1 in sp:
+                            for label2 in sp:
+                                expected[labels.index(label1), labels.index(label2)] += prob / total_prob
+                obs = tree.calc_conspecificity_probability_matrix()
+                self.assertEqual(obs.shape, (len(labels), len(labels)))
+                for i in range(len(labels)):
+                    for j in range(len(labels)):
+                        self.assertAlmostEqual(expected[i, j], obs[i, j], 12)
+
+class LineageTreeMaximumProbabilityPartition(unittest.TestCase):
+
+    def test_against_enumeration(self):
+        for tree, labels in _iter_reference_trees():
+            for rate in (0.1, 0.5, 5.0):
+                tree.speciation_completion_rate = rate
+                constraints = []
+                for species_leafset_labels, prob in tree.calc_label_partition_probability_map().items():
+                    if prob > 0 and len(species_leafset_labels) > 1:
+                        constraints.append([sp - {labels[-1]} for sp in species_leafset_labels if sp - {labels[-1]}])
+                        break
+                for species_leafset_labels in _iter_constraint_cases(tree, labels, constraints):
+                    partition_probability_map = tree.calc_label_partition_probability_map()
+                    expected_prob = max(partition_probability_map.values())
+                    obs_partition, obs_prob = tree.calc_max_probability_partition()
+                    self.assertAlmostEqual(expected_prob, obs_prob, 12)
+                    self.assertAlmostEqual(expected_prob, partition_probability_map[obs_partition], 12)
+                    self.assertAlmostEqual(sum(partition_probability_map.values()), tree.calc_probability_of_constraints(), 12)
+
+class LineageTreePartitionsInOrderOfProbability(unittest.TestCase):
+
+    def test_against_enumeration(self):
+        for tree, labels in _iter_reference_trees():
+            tree.underflow_protection = "log"
+            for rate in (0.1, 0.5, 5.0):
+                tree.speciation_completion_rate = rate
+                constraints = []
+                for species_leafset_labels, prob in tree.calc_label_partition_probability_map().items():
+                    if prob > 0 and len(species_leafset_labels) > 1:
+                        constraints.append([sp - {labels[-1]} for sp in species_leafset_labels if sp - {labels[-1]}])
+                        break
+                for species_leafset_labels in _iter_constraint_cases(tree, labels, constraints):
+                    partition_probability_map = dict((k, prob)
+                            for k, prob in tree.calc_label_partition_probability_map().items()
+                            if prob > 0)
+                    obs = list(tree.iter_label_partition_probabilities())
+                    self.assertEqual(len(obs), len(partition_probability_map))
+                    for idx, (partition, prob) in enumerate(obs):
+                        self.assertAlmostEqual(partition_probability_map[partition], prob, 12)
+                        if idx > 0:
+                            self.assertLessEqual(prob, obs[idx-1][1] * decimal.Decimal("1.000000001"))
+                    expected_probs = sorted(partition_probability_map.values(), reverse=True)
+                    min_probability = expected_probs[min(3, len(expected_probs)-1)] * decimal.Decimal("0.999999999")
+                    obs = list(tree.iter_label_partition_probabilities(min_probability=min_probability))
+                    self.assertEqual(len(obs), len([prob for prob in expected_probs if prob >= min_probability]))
+
+class LineageTreePartitionSampling(unittest.TestCase):
+
+    def test_against_enumeration(self):
+        num_samples = 2000
+        for tree, labels in _iter_reference_trees():
+            for rate in (0.01, 0.1):
+                tree.speciation_completion_rate = rate
+                for species_leafset_labels in _iter_constraint_cases(tree, labels):
+                    partition_probability_map = tree.calc_label_partition_probability_map()
+                    total_prob = sum(partition_probability_map.values())
+                    samples = tree.sample_label_partitions(num_samples, rng=random.Random(1))
+                    self.assertEqual(samples, tree.sample_label_partitions(num_samples, rng=random.Random(1)))
+                    for partition in samples:
+                        self.assertGreater(partition_probability_map.get(partition, 0.0), 0.0)
+                    for partition, prob in partition_probability_map.items():
+                        prob /= total_prob
+                        freq = samples.count(partition) / num_samples
+                        self.assertLessEqual(abs(freq - prob), 5 * math.sqrt(prob * (1 - prob) / num_samples) + 1e-9)
+
+class SpeciesPartitionMonteCarloEstimation(unittest.TestCase):
+
+    def test_against_enumeration(self):
+        for tree, labels in _iter_reference_trees():
+            tree.speciation_completion_rate = 0.1
+            for species_leafset_labels in _iter_constraint_cases(tree, labels):
+                partition_probability_map = tree.calc_label_partition_probability_map()
+                total_prob = sum(partition_probability_map.values())
+                mc = estimate.SpeciesPartitionMonteCarloEstimator(tree=tree, batch_size=700)
+                mc.simulate(5000, random_seed=1, is_count_conspecificity=True)
+                prob, se = mc.estimate_probability_of_constraints()
+                self.assertLessEqual(abs(prob - total_prob), 5 * se + 1e-12)
+                obs = mc.estimate_partition_probabilities()
+                for partition, prob, se in obs:
+                    expected_prob = partition_probability_map[partition] / total_prob
+                    self.assertLessEqual(abs(prob - expected_prob), 5 * se + 1e-3)
+                self.assertGreaterEqual(obs[0][1], obs[-1][1])
+                probs, ses = mc.estimate_conspecificity_probability_matrix()
+                expected_probs = tree.calc_conspecificity_probability_matrix()
+                self.assertTrue(numpy.all(numpy.abs(probs - expected_probs) <= 5 * ses + 1e-3))
+                if species_leafset_labels is None:
+                    expected_clade_probs = tree.calc_clade_marginal_probabilities_of_species()
+                    for nd, (prob, se) in mc.estimate_clade_marginal_probabilities_of_species().items():
+                        self.assertLessEqual(abs(prob - expected_clade_probs[nd]), 5 * se + 1e-3)
+                mc.clear()
+                mc.simulate(5000, random_seed=1)
+                self.assertEqual(obs, mc.estimate_partition_probabilities())
+
+class LineageTreePartitionMapSchedule(unittest.TestCase):
+
+    def test_schedules_agree(self):
+        for tree, labels in _iter_reference_trees():
+            tree.speciation_completion_rate = 0.5
+            for species_leafset_labels in _iter_constraint_cases(tree, labels):
+                expected = tree.calc_label_partition_probability_map()
+                tree.partition_map_schedule = "min-memory"
+                obs = tree.calc_label_partition_probability_map()
+                tree.partition_map_schedule = "postorder"
+                self.assertEqual(set(expected), set(obs))
+                for partition in expected:
+                    self.assertAlmostEqual(expected[partition], obs[partition], 14)
+                self.assertGreaterEqual(tree.peak_num_live_partition_states, len(obs))
+
+class LineageTreeConstrainedPartitionMerge(unittest.TestCase):
+
+    def test_against_enforcement_after_merge(self):
+        for tree, labels in _iter_reference_trees():
+            tree.speciation_completion_rate = 0.5
+            for species_leafset_labels in ([labels[:2], [labels[3]]], [labels[1:4], [labels[0]]]):
+                tree.set_node_constraints(model._Partition.compile_lookup_key(species_leafset_labels))
+                obs = tree.calc_label_partition_probability_map()
+                with mock.patch.object(model, "_compile_merge_constraints", return_value=None):
+                    expected = tree.calc_label_partition_probability_map()
+                self.assertEqual(set(expected), set(obs))
+                for partition in expected:
+                    self.assertAlmostEqual(expected[partition], obs[partition], 14)
+
+class LineageTreeCollapsedConstrainedClades(unittest.TestCase):
+
+    def test_against_full_tree(self):
+        tree = model.LineageTree.get(
+                data="((a:1.0,(b:0.5,c:0.3):0.2):0.4,((d:0.7,e:0.1):0.3,f:0.6):0.2);",
+                schema="newick",
+                )
+        tree.speciation_completion_rate = 0.8
+        tree.set_node_constraints(model._Partition.compile_lookup_key([["a", "b", "c"], ["d", "e"]]))
+        self.assertEqual(len(tree._constrained_clades), 2)
+        for underflow_protection in (None, "log"):
+            tree.underflow_protection = underflow_protection
+            obs = tree.calc_label_partition_probability_map()
+            constrained_clades = tree._constrained_clades
+            tree._constrained_clades = {}
+            expected = tree.calc_label_partition_probability_map()
+            tree._constrained_clades = constrained_clades
+            self.assertEqual(set(expected), set(obs))
+            for partition in expected:
+                self.assertAlmostEqual(float(expected[partition]), float(obs[partition]), 14)
+
+class LineageTreeBeamPrunedPartitionProbabilities(unittest.TestCase):
+
+    def test_pruned_probability_bound(self):
+        for tree, _ in _iter_reference_trees():
+            tree.speciation_completion_rate = 0.5
+            expected = tree.calc_label_partition_probability_map()
+            self.assertIs(tree.pruned_partition_probability, None)
+            for beam_epsilon in (1e-12, 1e-3, 1e-1):
+                tree.partition_beam_epsilon = beam_epsilon
+                obs = tree.calc_label_partition_probability_map()
+                self.assertLessEqual(set(obs), set(expected))
+                for partition in obs:
+                    self.assertLessEqual(obs[partition], expected[partition] * (1 + 1e-12))
+                missing_prob = sum(expected.values()) - sum(obs.values())
+                self.assertLessEqual(missing_prob, tree.pruned_partition_probability + 1e-12)
+            self.assertLess(len(obs), len(expected))
+            tree.partition_beam_epsilon = None
+
+class LineageTreePartitionMapStateCounts(unittest.TestCase):
+
+    def test_against_partition_maps(self):
+        for tree, labels in _iter_reference_trees():
+            tree.speciation_completion_rate = 0.5
+            for species_leafset_labels in _iter_constraint_cases(tree, labels,
+                    ([labels[:2], [labels[3]]], [labels[1:4], [labels[0]]])):
+                for partition_map_schedule in ("postorder", "min-memory"):
+                    tree.partition_map_schedule = partition_map_schedule
+                    node_state_counts, peak_num_states, num_states_formed, num_partitions = tree.calc_partition_map_state_counts()
+                    partition_probability_map = tree.calc_label_partition_probability_map()
+                    self.assertEqual(num_partitions, len(partition_probability_map))
+                    self.assertEqual(peak_num_states, tree.peak_num_live_partition_states)
+                    self.assertEqual(node_state_counts[tree.seed_node][1], None)
+                    self.assertGreaterEqual(num_states_formed, num_partitions)
+
+class LineageTreeSharedLineageIndex(unittest.TestCase):
+
+    def test_index_order_independence(self):
+        for tree, labels in _iter_reference_trees():
+            self.assertEqual(tree.lineage_index.labels, labels)
+            tree.speciation_completion_rate = 0.5
+            species_leafset_labels = model._Partition.compile_lookup_key([labels[:2], [labels[3]]])
+            tree.set_node_constraints(species_leafset_labels)
+            expected = tree.calc_label_partition_probability_map()
+            lineage_index = model.LineageIndex(reversed(labels))
+            tree.lineage_index = lineage_index
+            self.assertIs(tree.lineage_index, lineage_index)
+            self.assertEqual(lineage_index.mask_labels(lineage_index.mask(labels[:2])), list(reversed(labels[:2])))
+            tree.set_node_constraints(species_leafset_labels)
+            self.assertEqual(tree.seed_node.leaf_lineage_mask, (1 << len(labels)) - 1)
+            obs = tree.calc_label_partition_probability_map()
+            self.assertEqual(set(expected), set(obs))
+            for partition in expected:
+                self.assertAlmostEqual(expected[partition], obs[partition], 14)
+
+class IndexedConstraintChecking(unittest.TestCase):
+
+    def test_against_subset_scans(self):
+        rng = random.Random(1)
+        num_lineages = 8
+        for _ in range(200):
+            subset_indexes = [rng.randrange(4) for _ in range(num_lineages)]
+            subsets = [[idx for idx in range(num_lineages) if subset_indexes[idx] == sub_idx] for sub_idx in range(4)]
+            subsets = [subset for subset in subsets if subset]
+            constraints = {
+                    "conspecific": [tuple(rng.sample(range(num_lineages), 2)) for _ in range(rng.randrange(3))],
+                    "not_conspecific": [tuple(rng.sample(range(num_lineages), 2)) for _ in range(rng.randrange(3))],
+                    }
+            expected = (any(subset_indexes[a] != subset_indexes[b] for a, b in constraints["conspecific"])
+                    or any(subset_indexes[a] == subset_indexes[b] for a, b in constraints["not_conspecific"]))
+            part = (0,) + tuple(sum(1 << idx for idx in subset) for subset in subsets)
+            constraint_index = model._compile_constraint_index(constraints)
+            self.assertEqual(model._bitmask_partition_violates_constraints(part, constraint_index), expected)
+
+class TreeSamplePartitionProbabilityEstimation(unittest.TestCase):
+
+    def test_against_single_trees(self):
+        scales = (0.5, 1.0, 2.0)
+        # each reference tree, once for each scaling of its branch lengths
+        for scaled_trees in zip(*[_iter_reference_trees() for _ in scales]):
+            trees = []
+            for scale, (tree, labels) in zip(scales, scaled_trees):
+                for edge in tree.postorder_edge_iter():
+                    if edge.length is not None:
+                        edge.length *= scale
+                trees.append(tree)
+            species_leafset_labels = model._Partition.compile_lookup_key([labels[:2], [labels[3]]])
+            expected_probs = []
+            expected_conspecificity = []
+            for tree in trees:
+                tree.set_node_constraints(species_leafset_labels)
+                tree.speciation_completion_rate = 0.3
+                partition_probability_map = tree.calc_label_partition_probability_map()
+                total_prob = sum(partition_probability_map.values())
+                expected_probs.append(dict((k, prob / total_prob) for k, prob in partition_probability_map.items()))
+                expected_conspecificity.append(tree.calc_conspecificity_probability_matrix())
+            results = []
+            for num_processes in (1, 2):
+                estimator = estimate.TreeSamplePartitionProbabilityEstimator(
+                        lineage_labels=labels,
+                        species_leafset_labels=species_leafset_labels,
+                        speciation_completion_rate=0.3,
+                        is_calc_conspecificity=True,
+                        num_processes=num_processes,
+                        max_pending_trees=1)
+                estimator.add_trees(iter(trees))
+                self.assertEqual(estimator.num_trees, len(trees))
+                obs = estimator.estimate_partition_probabilities()
+                self.assertEqual(set(k for k, _, _ in obs), set(expected_probs[0]))
+                for partition, mean, variance in obs:
+                    values = [probs.get(partition, 0.0) for probs in expected_probs]
+                    self.assertAlmostEqual(mean, numpy.mean(values), 12)
+                    self.assertAlmostEqual(variance, numpy.var(values), 12)
+                self.assertGreaterEqual(obs[0][1], obs[-1][1])
+                means, variances = estimator.estimate_conspecificity_probability_matrix()
+                self.assertTrue(numpy.allclose(means, numpy.mean(expected_conspecificity, axis=0)))
+                self.assertTrue(numpy.allclose(variances, numpy.var(expected_conspecificity, axis=0)))
+                results.append(obs)
+            self.assertEqual(results[0], results[1])
+
+class SharedSpeciationRateEstimation(unittest.TestCase):
+
+    def test_against_single_trees(self):
+        trees = []
+        species_leafset_labels_list = []
+        for tree, _ in _iter_reference_trees():
+            trees.append(tree)
+            species_leafset_labels = [[nd.taxon.label for nd in c.leaf_iter()] for c in tree.seed_node.child_nodes()]
+            species_leafset_labels_list.append(model._Partition.compile_lookup_key(species_leafset_labels))
+        expected_lnl = 0.0
+        for tree, species_leafset_labels in zip(trees, species_leafset_labels_list):
+            tree.speciation_completion_rate = 0.3
+            expected_lnl += tree.calc_joint_log_probability_of_species(species_leafset_labels)
+        estimates = []
+        for num_processes in (1, 2):
+            with estimate.SharedSpeciationCompletionRateMaximumLikelihoodEstimator(
+                    trees=trees,
+                    species_leafset_labels_list=species_leafset_labels_list,
+                    initial_speciation_rate=0.01,
+                    min_speciation_rate=1e-8,
+                    max_speciation_rate=100.0,
+                    num_processes=num_processes) as mle:
+                self.assertAlmostEqual(mle.calc_log_likelihood(0.3), expected_lnl, 10)
+                rate, lnl = mle.estimate_speciation_rate(method="newton")
+                _, d1, _ = mle.calc_log_likelihood_derivatives(rate)
+                self.assertAlmostEqual(d1, 0.0, 4)
+                self.assertTrue(mle.estimate_standard_error(rate) > 0)
+                estimates.append((rate, lnl))
+        self.assertEqual(estimates[0], estimates[1])
+        single_mle = estimate.SpeciationCompletionRateMaximumLikelihoodEstimator(
+                tree=trees[0],
+                species_leafset_labels=species_leafset_labels_list[0],
+                initial_speciation_rate=0.01,
+                min_speciation_rate=1e-8,
+                max_speciation_rate=100.0)
+        with estimate.SharedSpeciationCompletionRateMaximumLikelihoodEstimator(
+                trees=trees[:1],
+                species_leafset_labels_list=species_leafset_labels_list[:1],
+                initial_speciation_rate=0.01,
+                min_speciation_rate=1e-8,
+                max_speciation_rate=100.0) as mle:
+            expected_rate, expected_lnl = single_mle.estimate_speciation_rate(method="newton")
+            rate, lnl = mle.estimate_speciation_rate(method="newton")
+            self.assertAlmostEqual(rate, expected_rate, 8)
+            self.assertAlmostEqual(lnl, expected_lnl, 10)
+
+    def test_degenerate_partitions(self):
+        trees = [model.LineageTree.get(
+                    path=os.path.join(_pathmap.TESTS_DATA_DIR, "five_leaf.tre"),
+                    schema="newick",
+                    ) for _ in range(2)]
+        labels = [t.label for t in trees[0].taxon_namespace]
+        for species_leafset_labels, expected_rate in (
+                ([labels], 0.0),
+                ([[label] for label in labels], float("inf")),
+                ):
+            with estimate.SharedSpeciationCompletionRateMaximumLikelihoodEstimator(
+                    trees=trees,
+                    species_leafset_labels_list=[species_leafset_labels] * len(trees),
+                    initial_speciation_rate=0.01,
+                    min_speciation_rate=1e-8,
+                    max_speciation_rate=100.0) as mle:
+                rate, lnl = mle.estimate_speciation_rate()
+                self.assertEqual(rate, expected_rate)
+                self.assertAlmostEqual(lnl, 0.0, 12)
+
+    def test_worker_exit(self):
+        trees = []
+        species_leafset_labels_list = []
+        for tree, labels in list(_iter_reference_trees())[:2]:
+            trees.append(tree)
+            species_leafset_labels_list.append([[label] for label in labels])
+        with estimate.SharedSpeciationCompletionRateMaximumLikelihoodEstimator(
+                trees=trees,
+                species_leafset_labels_list=species_leafset_labels_list,
+                initial_speciation_rate=0.01,
+                min_speciation_rate=1e-8,
+                max_speciation_rate=100.0,
+                num_processes=2) as mle:
+            process, _ = mle._workers[-1]
+            process.terminate()
+            process.join()
+            with self.assertRaises(RuntimeError):
+                mle.calc_log_likelihood(0.3)
+
+class ReplicateSpeciationRateEstimation(unittest.TestCase):
+
+    def test_replicates(self):
+        trees = []
+        species_leafset_labels_list = []
+        for tree, _ in _iter_reference_trees():
+            trees.append(tree)
+            species_leafset_labels = [[nd.taxon.label for nd in c.leaf_iter()] for c in tree.seed_node.child_nodes()]
+            species_leafset_labels_list.append(model._Partition.compile_lookup_key(species_leafset_labels))
+        window = (0.01, 1e-8, 100.0)
+        results = []
+        for num_processes in (1, 2):
+            estimator = estimate.ReplicateSpeciationCompletionRateEstimator(
+                    method="newton",
+                    is_calc_standard_error=True,
+                    num_processes=num_processes,
+                    max_pending_replicates=2)
+            replicates = [(idx, estimator.compose_tree_replicate(tree, species_leafset_labels, window))
+                    for idx, (tree, species_leafset_labels) in enumerate(zip(trees, species_leafset_labels_list))]
+            replicates.extend((("bootstrap", idx), estimator.compose_bootstrap_replicate(trees[2], 0.01, 1, idx, window))
+                    for idx in range(6))
+            results.append(list(estimator.iter_estimates(iter(replicates))))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual([r[0] for r in results[0]], [replicate_id for replicate_id, _ in replicates])
+        for tree, species_leafset_labels, result in zip(trees, species_leafset_labels_list, results[0]):
+            mle = estimate.SpeciationCompletionRateMaximumLikelihoodEstimator(
+                    tree=tree,
+                    species_leafset_labels=species_leafset_labels,
+                    initial_speciation_rate=window[0],
+                    min_speciation_rate=window[1],
+                    max_speciation_rate=window[2])
+            expected_rate, expected_lnl = mle.estimate_speciation_rate(method="newton")
+            self.assertEqual(result[1:3], (expected_rate, expected_lnl))
+            self.assertIsNone(result[4])
+        # bootstrap replicates only depend on the seed and their index
+        estimator = estimate.ReplicateSpeciationCompletionRateEstimator(method="newton")
+        replicates = [(("bootstrap", idx), estimator.compose_bootstrap_replicate(trees[2], 0.01, 1, idx, window))
+                for idx in (4, 1)]
+        self.assertEqual(list(estimator.iter_estimates(replicates)),
+                [results[0][len(trees) + 4][:3] + (None, None), results[0][len(trees) + 1][:3] + (None, None)])
+
+class SpeciationRateConfidenceIntervalRoots(unittest.TestCase):
+
+    def test_against_minimization(self):
+        tree, _ = list(_iter_reference_trees())[2]
+        species_leafset_labels = model._Partition.compile_lookup_key(
+                [[nd.taxon.label for nd in c.leaf_iter()] for c in tree.seed_node.child_nodes()])
+        mle = estimate.SpeciationCompletionRateMaximumLikelihoodEstimator(
+                tree=tree,
+                species_leafset_labels=species_leafset_labels,
+                initial_speciation_rate=0.01,
+                min_speciation_rate=1e-8,
+                max_speciation_rate=1.0)
+        rate, lnl = mle.estimate_speciation_rate(method="newton")
+        num_evaluated = len(mle.log_likelihood_cache)
+        self.assertTrue(num_evaluated > 0)
+        ci = mle.estimate_confidence_interval(rate, lnl, method="root")
+        self.assertTrue(ci[0] < rate < ci[1])
+        for bound in ci:
+            self.assertAlmostEqual(mle.calc_log_likelihood(bound), lnl - 1.96, 6)
+        expected_ci = mle.estimate_confidence_interval(rate, lnl, method="minimize")
+        for bound, expected_bound in zip(ci, expected_ci):
+            self.assertAlmostEqual(bound, expected_bound, 4)
+        # the bounds are found again from the evaluations cached, in parallel
+        num_evaluated = len(mle.log_likelihood_cache)
+        for bound, expected_bound in zip(mle.estimate_confidence_interval(rate, lnl, method="root", num_processes=2), ci):
+            self.assertAlmostEqual(bound, expected_bound, 8)
+        self.assertTrue(len(mle.log_likelihood_cache) - num_evaluated <= 4)
+
+class LineageTreeProbabilityCache(unittest.TestCase):
+
+    def get_tree(self):
+        return model.LineageTree.get(
+                path=os.path.join(_pathmap.TESTS_DATA_DIR, "five_leaf.tre"),
+                schema="newick",
+                )
+
+    def test_joint_probabilities(self):
+        tree = self.get_tree()
+        labels = sorted(t.label for t in tree.taxon_namespace)
+        species_leafset_labels = [labels[:2], labels[2:]]
+        for underflow_protection in (None, "log", "decimal"):
+            tree.underflow_protection = underflow_protection
+            tree.speciation_completion_rate = 0.2
+            expected = tree.calc_joint_log_probability_of_species(species_leafset_labels)
+            tree.speciation_completion_rate = 0.3
+            tree.calc_joint_log_probability_of_species(species_leafset_labels)
+            # revisiting a rate, in any order of species, hits the cache
+            tree.speciation_completion_rate = 0.2
+            num_hits = tree.probability_cache.num_hits
+            self.assertEqual(tree.calc_joint_log_probability_of_species([labels[2:][::-1], labels[:2]]), expected)
+            self.assertEqual(tree.probability_cache.num_hits, num_hits + 1)
+            # but not for a collection of labels that is not a partition
+            self.assertEqual(tree.calc_joint_probability_of_species([labels[:2], labels[1:]]), 0)
+        # changing a branch length is picked up
+        tree.underflow_protection = None
+        nd = next(tree.leaf_node_iter())
+        nd.edge.length *= 2
+        other_tree = self.get_tree()
+        next(other_tree.leaf_node_iter()).edge.length *= 2
+        other_tree.speciation_completion_rate = 0.2
+        self.assertEqual(tree.calc_joint_probability_of_species(species_leafset_labels),
+                other_tree.calc_joint_probability_of_species(species_leafset_labels))
+
+    def test_partition_probability_map(self):
+        tree = self.get_tree()
+        labels = sorted(t.label for t in tree.taxon_namespace)
+        tree.set_node_constraints(species_leafset_labels=[labels[:2]])
+        tree.speciation_completion_rate = 0.2
+        expected = tree.calc_label_partition_probability_map()
+        num_partitions = len(expected)
+        self.assertEqual(expected[frozenset([frozenset(["x"])])], 0.0)
+        self.assertEqual(len(expected), num_partitions)
+        self.assertIs(tree.calc_label_partition_probability_map(), expected)
+        tree.set_node_constraints(species_leafset_labels=[labels[1:3]])
+        obs = tree.calc_label_partition_probability_map()
+        self.assertIsNot(obs, expected)
+        self.assertNotEqual(set(obs), set(expected))
+        # bounded by the number of values and of probabilities held
+        tree.probability_cache = model._Cache(max_size=2, max_cost=len(obs))
+        for speciation_rate in (0.1, 0.2, 0.3):
+            tree.speciation_completion_rate = speciation_rate
+            tree.calc_joint_probability_of_species([labels])
+        self.assertEqual(len(tree.probability_cache), 2)
+        tree.calc_label_partition_probability_map()
+        self.assertEqual(len(tree.probability_cache), 1)
+        self.assertEqual(tree.probability_cache.total_cost, len(obs))
+        tree.probability_cache.max_cost -= 1
+        tree.speciation_completion_rate = 0.4
+        tree.calc_label_partition_probability_map()
+        self.assertEqual(len(tree.probability_cache), 1)
+
 if __name__ == "__main__":
     unittest.main()
 